@@ -0,0 +1,943 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+
+import tools
+from data import MULTI_ANCHOR_SIZE_COCO, VOC_CLASSES
+from utils.nms import batched_nms
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='YOLO Benchmark')
+    parser.add_argument('-m', '--mode', default='nms',
+                        help='nms, latency, gt, fuse, export, amp, ema, accumulate, multiscale, rect, preprocess, cocoresults, cocomap, vocmap')
+    parser.add_argument('--num_boxes', default=5000, type=int,
+                        help='number of candidate boxes fed to NMS')
+    parser.add_argument('--num_classes', default=80, type=int,
+                        help='number of classes')
+    parser.add_argument('--nms_thresh', default=0.5, type=float,
+                        help='NMS threshold')
+    parser.add_argument('--diou_nms', action='store_true', default=False,
+                        help='use diou nms.')
+    parser.add_argument('--ciou_loss', action='store_true', default=False,
+                        help='use ciou loss in amp mode.')
+    parser.add_argument('--topk', default=1000, type=int,
+                        help='top-k candidates kept before NMS in latency mode')
+    parser.add_argument('--batch_size', default=64, type=int,
+                        help='batch size in gt mode')
+    parser.add_argument('--repeat', default=20, type=int,
+                        help='number of timed runs')
+    parser.add_argument('--iters', default=300, type=int,
+                        help='number of training iterations in amp mode')
+    parser.add_argument('-size', '--input_size', default=160, type=int,
+                        help='input size of the synthetic training images')
+    parser.add_argument('--accumulate', default=4, type=int,
+                        help='number of accumulated batches in accumulate mode')
+    parser.add_argument('--cuda', action='store_true', default=False,
+                        help='use cuda.')
+
+    return parser.parse_args()
+
+
+def py_cpu_nms(dets, scores, nms_thresh, diou=False):
+    """Pure Python (DIoU-)NMS baseline, the per-class routine used before BatchedNMS."""
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+
+        w = np.maximum(1e-28, xx2 - xx1)
+        h = np.maximum(1e-28, yy2 - yy1)
+        inter = w * h
+
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        if diou:
+            cw = np.maximum(x2[i], x2[order[1:]]) - np.minimum(x1[i], x1[order[1:]])
+            ch = np.maximum(y2[i], y2[order[1:]]) - np.minimum(y1[i], y1[order[1:]])
+            C = cw**2 + ch**2
+            D = ((x1[i] + x2[i]) / 2. - (x1[order[1:]] + x2[order[1:]]) / 2.)**2 + \
+                ((y1[i] + y2[i]) / 2. - (y1[order[1:]] + y2[order[1:]]) / 2.)**2
+            ovr = ovr - D / (C + 1e-20)
+        inds = np.where(ovr <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    return keep
+
+
+def per_class_nms(bboxes, scores, cls_inds, num_classes, nms_thresh, diou=False):
+    keep = np.zeros(len(bboxes), dtype=np.int64)
+    for i in range(num_classes):
+        inds = np.where(cls_inds == i)[0]
+        if len(inds) == 0:
+            continue
+        c_keep = py_cpu_nms(bboxes[inds], scores[inds], nms_thresh, diou)
+        keep[inds[c_keep]] = 1
+
+    return np.where(keep > 0)[0]
+
+
+def random_candidates(num_boxes, num_classes, clustered=True, seed=0):
+    """
+        clustered: many boxes around each object, like the raw outputs of a detector
+        scattered: few overlaps, like the low-score tail kept by conf_thresh=0.001
+    """
+    rng = np.random.RandomState(seed)
+    if clustered:
+        num_objects = max(num_boxes // 50, 1)
+        centers = rng.uniform(0.1, 0.9, size=[num_objects, 2])
+        sizes = rng.uniform(0.02, 0.4, size=[num_objects, 2])
+        obj_ind = rng.randint(num_objects, size=num_boxes)
+        ctr = centers[obj_ind] + rng.normal(scale=0.02, size=[num_boxes, 2])
+        wh = sizes[obj_ind] * rng.uniform(0.8, 1.2, size=[num_boxes, 2])
+        cls_inds = obj_ind % num_classes
+    else:
+        ctr = rng.uniform(0., 1., size=[num_boxes, 2])
+        wh = rng.uniform(0.01, 0.3, size=[num_boxes, 2])
+        cls_inds = rng.randint(num_classes, size=num_boxes)
+    bboxes = np.clip(np.concatenate([ctr - wh / 2, ctr + wh / 2], axis=1), 0., 1.).astype(np.float32)
+    scores = rng.uniform(0.001, 1., size=num_boxes).astype(np.float32)
+
+    return bboxes, scores, cls_inds.astype(np.int64)
+
+
+def timeit(fn, repeat, sync=None):
+    fn()
+    t0 = time.time()
+    for _ in range(repeat):
+        fn()
+        if sync is not None:
+            sync()
+    return (time.time() - t0) / repeat
+
+
+def bench_nms(args, device):
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    for clustered in [True, False]:
+        bboxes, scores, cls_inds = random_candidates(args.num_boxes, args.num_classes, clustered)
+        bboxes_t = torch.from_numpy(bboxes).to(device)
+        scores_t = torch.from_numpy(scores).to(device)
+        cls_inds_t = torch.from_numpy(cls_inds).to(device)
+
+        t_ref = timeit(lambda: per_class_nms(bboxes, scores, cls_inds, args.num_classes, args.nms_thresh, args.diou_nms), args.repeat)
+        t_new = timeit(lambda: batched_nms(bboxes_t, scores_t, cls_inds_t, args.nms_thresh, args.diou_nms), args.repeat, sync)
+        print('[NMS][%s][%d boxes][%d classes] per-class loop: %.2f ms || batched: %.2f ms || speedup: %.2fx'
+              % ('clustered' if clustered else 'scattered', args.num_boxes, args.num_classes,
+                 t_ref * 1000, t_new * 1000, t_ref / t_new))
+
+
+def loop_multi_gt_creator(input_size, strides, label_lists=[], anchor_size=None):
+    """The per-box loop used before the vectorized tools.multi_gt_creator, kept as its reference."""
+    # prepare the all empty gt datas
+    batch_size = len(label_lists)
+    h, w = input_size
+    num_scale = len(strides)
+    gt_tensor = []
+
+    # generate gt datas
+    all_anchor_size = anchor_size # get_total_anchor_size(multi_level=True, name=name, version=version)
+    anchor_number = len(all_anchor_size) // num_scale
+    for s in strides:
+        gt_tensor.append(np.zeros([batch_size, h//s, w//s, anchor_number, 1+1+4+1+4]))
+    for batch_index in range(batch_size):
+        for gt_label in label_lists[batch_index]:
+            # get a bbox coords
+            gt_class = int(gt_label[-1])
+            xmin, ymin, xmax, ymax = gt_label[:-1]
+            # compute the center, width and height
+            c_x = (xmax + xmin) / 2 * w
+            c_y = (ymax + ymin) / 2 * h
+            box_w = (xmax - xmin) * w
+            box_h = (ymax - ymin) * h
+
+            if box_w < 1. or box_h < 1.:
+                # print('A dirty data !!!')
+                continue    
+
+            # compute the IoU
+            anchor_boxes = tools.set_anchors(all_anchor_size)
+            gt_box = np.array([[0, 0, box_w, box_h]])
+            iou = tools.compute_iou(anchor_boxes, gt_box)
+
+            # We only consider those anchor boxes whose IoU is more than ignore thresh,
+            iou_mask = (iou > tools.ignore_thresh)
+
+            if iou_mask.sum() == 0:
+                # We assign the anchor box with highest IoU score.
+                index = np.argmax(iou)
+                # s_indx, ab_ind = index // num_scale, index % num_scale
+                s_indx = index // anchor_number
+                ab_ind = index - s_indx * anchor_number
+                # get the corresponding stride
+                s = strides[s_indx]
+                # get the corresponding anchor box
+                p_w, p_h = anchor_boxes[index, 2], anchor_boxes[index, 3]
+                # compute the gride cell location
+                c_x_s = c_x / s
+                c_y_s = c_y / s
+                grid_x = int(c_x_s)
+                grid_y = int(c_y_s)
+                # compute gt labels
+                tx = c_x_s - grid_x
+                ty = c_y_s - grid_y
+                tw = np.log(box_w / p_w)
+                th = np.log(box_h / p_h)
+                weight = 2.0 - (box_w / w) * (box_h / h)
+
+                if grid_y < gt_tensor[s_indx].shape[1] and grid_x < gt_tensor[s_indx].shape[2]:
+                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 0] = 1.0
+                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 1] = gt_class
+                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 2:6] = np.array([tx, ty, tw, th])
+                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 6] = weight
+                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 7:] = np.array([xmin, ymin, xmax, ymax])
+            
+            else:
+                # There are more than one anchor boxes whose IoU are higher than ignore thresh.
+                # But we only assign only one anchor box whose IoU is the best(objectness target is 1) and ignore other 
+                # anchor boxes whose(we set their objectness as -1 which means we will ignore them during computing obj loss )
+                # iou_ = iou * iou_mask
+                
+                # We get the index of the best IoU
+                best_index = np.argmax(iou)
+                for index, iou_m in enumerate(iou_mask):
+                    if iou_m:
+                        if index == best_index:
+                            # s_indx, ab_ind = index // num_scale, index % num_scale
+                            s_indx = index // anchor_number
+                            ab_ind = index - s_indx * anchor_number
+                            # get the corresponding stride
+                            s = strides[s_indx]
+                            # get the corresponding anchor box
+                            p_w, p_h = anchor_boxes[index, 2], anchor_boxes[index, 3]
+                            # compute the gride cell location
+                            c_x_s = c_x / s
+                            c_y_s = c_y / s
+                            grid_x = int(c_x_s)
+                            grid_y = int(c_y_s)
+                            # compute gt labels
+                            tx = c_x_s - grid_x
+                            ty = c_y_s - grid_y
+                            tw = np.log(box_w / p_w)
+                            th = np.log(box_h / p_h)
+                            weight = 2.0 - (box_w / w) * (box_h / h)
+
+                            if grid_y < gt_tensor[s_indx].shape[1] and grid_x < gt_tensor[s_indx].shape[2]:
+                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 0] = 1.0
+                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 1] = gt_class
+                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 2:6] = np.array([tx, ty, tw, th])
+                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 6] = weight
+                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 7:] = np.array([xmin, ymin, xmax, ymax])
+            
+                        else:
+                            # we ignore other anchor boxes even if their iou scores are higher than ignore thresh
+                            # s_indx, ab_ind = index // num_scale, index % num_scale
+                            s_indx = index // anchor_number
+                            ab_ind = index - s_indx * anchor_number
+                            s = strides[s_indx]
+                            c_x_s = c_x / s
+                            c_y_s = c_y / s
+                            grid_x = int(c_x_s)
+                            grid_y = int(c_y_s)
+                            gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 0] = -1.0
+                            gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 6] = -1.0
+
+    gt_tensor = [gt.reshape(batch_size, -1, 1+1+4+1+4) for gt in gt_tensor]
+    gt_tensor = np.concatenate(gt_tensor, 1)
+    
+    return gt_tensor
+
+
+def random_labels(batch_size, num_classes, max_objects=30, seed=0):
+    """Random normalized gt boxes, from tiny (dirty) ones to the whole image."""
+    rng = np.random.RandomState(seed)
+    label_lists = []
+    for _ in range(batch_size):
+        n = rng.randint(0, max_objects + 1)
+        ctr = rng.uniform(0., 1., size=[n, 2])
+        wh = rng.uniform(0., 1., size=[n, 2]) ** 2
+        x1y1 = np.clip(ctr - wh / 2, 0., 1.)
+        x2y2 = np.clip(ctr + wh / 2, 0., 0.999)
+        cls_inds = rng.randint(num_classes, size=[n, 1])
+        label = np.concatenate([x1y1, np.maximum(x1y1, x2y2), cls_inds], axis=1).astype(np.float32)
+        label_lists.append(label.tolist())
+
+    return label_lists
+
+
+def bench_gt(args):
+    strides = [8, 16, 32]
+    for size in range(320, 608 + 1, 96):
+        label_lists = random_labels(args.batch_size, args.num_classes, seed=size)
+        input_size = [size, size]
+        t_ref = timeit(lambda: loop_multi_gt_creator(input_size, strides, label_lists, MULTI_ANCHOR_SIZE_COCO), args.repeat)
+        t_new = timeit(lambda: tools.multi_gt_creator(input_size, strides, label_lists, MULTI_ANCHOR_SIZE_COCO), args.repeat)
+        print('[GT][%d][batch %d][%d boxes] loop: %.2f ms || vectorized: %.2f ms || speedup: %.2fx'
+              % (size, args.batch_size, sum(len(l) for l in label_lists), t_ref * 1000, t_new * 1000, t_ref / t_new))
+
+
+BACKBONES = {'yolo_v3_plus': 'd-53', 'yolo_v3_plus_x': 'csp-x', 'yolo_v3_plus_large': 'csp-l',
+             'yolo_v3_plus_medium': 'csp-m', 'yolo_v3_plus_small': 'csp-s',
+             'yolo_v3_slim': 'd-tiny', 'yolo_v3_slim_csp': 'csp-slim'}
+
+
+def build_model(version, device, input_size, num_classes, topk=None):
+    if version.startswith('yolo_v3_plus'):
+        from models.yolo_v3_plus import YOLOv3Plus
+        return YOLOv3Plus(device, input_size=input_size, num_classes=num_classes, anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone=BACKBONES[version], topk=topk)
+    elif version.startswith('yolo_v3_slim'):
+        from models.yolo_v3_slim import YOLOv3Slim
+        return YOLOv3Slim(device, input_size=input_size, num_classes=num_classes, anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone=BACKBONES[version], topk=topk)
+
+
+def host_postprocess(model, all_bbox, all_class):
+    """The post-processing used before: copy the full score maps to NumPy and threshold on host."""
+    all_bbox = all_bbox[0].to('cpu').numpy()
+    all_class = all_class[0].to('cpu').numpy()
+    cls_inds = np.argmax(all_class, axis=1)
+    scores = all_class[(np.arange(all_class.shape[0]), cls_inds)]
+    keep = np.where(scores >= model.conf_thresh)
+    bboxes, scores, cls_inds = all_bbox[keep], scores[keep], cls_inds[keep]
+    keep = model.nms_processor(torch.from_numpy(bboxes), torch.from_numpy(scores),
+                               torch.from_numpy(cls_inds), model.nms_thresh).numpy()
+
+    return bboxes[keep], scores[keep], cls_inds[keep]
+
+
+def bench_latency(args, device):
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    for version in ['yolo_v3_slim', 'yolo_v3_plus']:
+        for size in [416, 608]:
+            torch.manual_seed(0)
+            model = build_model(version, device, [size, size], args.num_classes).to(device).eval()
+            x = torch.randn(1, 3, size, size, device=device)
+
+            # grab the decoded maps fed to the post-processing
+            maps = {}
+            batch_postprocess = model.batch_postprocess
+            def capture(all_bbox, all_class):
+                maps['bbox'], maps['class'] = all_bbox, all_class
+                return batch_postprocess(all_bbox, all_class)
+            model.batch_postprocess = capture
+            with torch.no_grad():
+                t_forward = timeit(lambda: model(x), args.repeat, sync)
+            model.batch_postprocess = batch_postprocess
+
+            t_host = timeit(lambda: host_postprocess(model, maps['bbox'], maps['class']), args.repeat, sync)
+            t_device = timeit(lambda: model.batch_postprocess(maps['bbox'], maps['class']), args.repeat, sync)
+            model.topk = args.topk
+            t_topk = timeit(lambda: model.batch_postprocess(maps['bbox'], maps['class']), args.repeat, sync)
+            print('[Latency][%s][%d] forward: %.2f ms || postprocess host: %.2f ms || device: %.2f ms || device top-%d: %.2f ms'
+                  % (version, size, t_forward * 1000, t_host * 1000, t_device * 1000, args.topk, t_topk * 1000))
+
+
+def randomize_bn(model):
+    """Random BatchNorm statistics and affine parameters, like a trained model."""
+    torch.manual_seed(0)
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+
+
+def bench_fuse(args, device):
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    for version in ['yolo_v3_slim', 'yolo_v3_slim_csp', 'yolo_v3_plus', 'yolo_v3_plus_small']:
+        for size in [416, 608]:
+            model = build_model(version, device, [size, size], args.num_classes).to(device).eval()
+            randomize_bn(model)
+            x = torch.randn(1, 3, size, size, device=device)
+            with torch.no_grad():
+                t_bn = timeit(lambda: model(x), args.repeat, sync)
+                model.fuse()
+                t_fused = timeit(lambda: model(x), args.repeat, sync)
+            print('[Fuse][%s][%d] conv+bn: %.2f ms || fused: %.2f ms || speedup: %.2fx'
+                  % (version, size, t_bn * 1000, t_fused * 1000, t_bn / t_fused))
+
+
+def bench_export(args):
+    """ CPU latency of the eager model, of its TorchScript export and of its ONNX export under ONNX Runtime. """
+    import os
+    import tempfile
+    import export
+
+    device = torch.device('cpu')
+    out_dir = tempfile.mkdtemp()
+    for version in ['yolo_v3_slim', 'yolo_v3_plus']:
+        size = 416
+        model = export.build_deploy_model(version, device, [size, size], args.num_classes, MULTI_ANCHOR_SIZE_COCO)
+        model.eval().fuse()
+        export.export_torchscript(model, [size, size], os.path.join(out_dir, version + '.torchscript.pt'))
+        runs = {'eager': lambda x: [out.numpy() for out in model(x)],
+                'torchscript': export.torchscript_session(os.path.join(out_dir, version + '.torchscript.pt'))}
+        try:
+            import onnx
+            import onnxruntime
+        except ImportError:
+            print('onnx or onnxruntime is not installed, skip ONNX Runtime.')
+        else:
+            export.export_onnx(model, [size, size], os.path.join(out_dir, version + '.onnx'))
+            runs['onnxruntime'] = export.ort_session(os.path.join(out_dir, version + '.onnx'))
+
+        for batch_size in [1, 4]:
+            x = torch.randn(batch_size, 3, size, size)
+            for name, run in runs.items():
+                with torch.no_grad():
+                    t = timeit(lambda: run(x), args.repeat)
+                print('[Export][%s][%d][batch %d][%s] %.2f ms || %.2f ms / image'
+                      % (version, size, batch_size, name, t * 1000, t * 1000 / batch_size))
+
+
+def synthetic_batches(num_batches, batch_size, size, num_classes, seed=0):
+    """
+    A tiny synthetic detection dataset: the random gt boxes of random_labels,
+    painted with a color per class on a noisy background, with their targets.
+    """
+    rng = np.random.RandomState(seed)
+    colors = rng.uniform(-2., 2., size=[num_classes, 3]).astype(np.float32)
+    batches = []
+    for i in range(num_batches):
+        label_lists = random_labels(batch_size, num_classes, max_objects=5, seed=seed + i)
+        images = rng.normal(0., 0.5, size=[batch_size, 3, size, size]).astype(np.float32)
+        for image, labels in zip(images, label_lists):
+            for x1, y1, x2, y2, cls_ind in labels:
+                image[:, int(y1 * size):int(y2 * size) + 1, int(x1 * size):int(x2 * size) + 1] = colors[int(cls_ind)][:, None, None]
+        targets = tools.multi_gt_creator([size, size], [8, 16, 32], label_lists, MULTI_ANCHOR_SIZE_COCO)
+        batches.append((torch.from_numpy(images), torch.from_numpy(targets)))
+
+    return batches
+
+
+def train_losses(model, batches, iters, device, lr=1e-3, amp_dtype=None, ema=None):
+    """
+    Trains model with SGD on the batches, cycled, with the warmup of train.py
+    over the first fifth of the iterations, and returns the total loss of each iteration.
+    ema, a ModelEMA of model, is updated after each step.
+    """
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+    wp_iters = max(iters // 5, 1)
+    losses = []
+    for i in range(iters):
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr * pow(min(i * 1. / wp_iters, 1.), 4)
+        images, targets = batches[i % len(batches)]
+        images, targets = images.to(device), targets.to(device)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            total_loss = model(images, target=targets)[-1]
+        scaler.scale(total_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+        if ema is not None:
+            ema.update(model)
+        losses.append(total_loss.item())
+
+    return np.array(losses)
+
+
+def bench_amp(args, device):
+    """
+    Loss curves of fp32 and mixed precision training (bf16 on CPU, fp16 on GPU)
+    from the same initial weights, on a synthetic dataset.
+    """
+    import copy
+    from models.yolo_v3_slim import YOLOv3Slim
+
+    size = args.input_size
+    batches = synthetic_batches(16, 4, size, args.num_classes)
+    torch.manual_seed(0)
+    # trained from scratch, without the pretrained backbone
+    model = YOLOv3Slim(device, input_size=[size, size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny', ciou=args.ciou_loss).to(device).train()
+    model.trainable = True
+    amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+    curves = {}
+    for name, dtype in [('fp32', None), (str(amp_dtype).split('.')[-1], amp_dtype)]:
+        t0 = time.time()
+        # from scratch on 64 images, a larger lr diverges in fp32 too
+        curves[name] = train_losses(copy.deepcopy(model), batches, args.iters, device, lr=1e-4, amp_dtype=dtype)
+        t = (time.time() - t0) / args.iters
+        # mean loss over windows of 10% of the iterations
+        windows = curves[name][:args.iters // 10 * 10].reshape(10, -1).mean(1)
+        print('[AMP][%s][finite: %s][%.2f ms / iter] loss curve: %s'
+              % (name, np.isfinite(curves[name]).all(), t * 1000, ' '.join('%.2f' % l for l in windows)))
+
+    fp32, amp = curves.values()
+    w = max(args.iters // 10, 1)
+    smooth = lambda x: np.convolve(x, np.ones(w) / w, mode='valid')
+    rel_diff = np.abs(smooth(amp) - smooth(fp32)) / smooth(fp32)
+    print('[AMP] relative difference of the smoothed loss curves: mean %.3f || max %.3f || final %.3f'
+          % (rel_diff.mean(), rel_diff.max(), rel_diff[-1]))
+
+
+def bench_ema(args, device):
+    """
+    Held-out loss of the raw and of the EMA weights after training on a
+    synthetic dataset, the cost of an EMA update, and the EMA model at other sizes.
+    """
+    from models.yolo_v3_slim import YOLOv3Slim
+    from utils import ModelEMA
+
+    size = args.input_size
+    batches = synthetic_batches(17, 4, size, args.num_classes)
+    train_batches, val_batch = batches[:-1], batches[-1]
+    torch.manual_seed(0)
+    model = YOLOv3Slim(device, input_size=[size, size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny').to(device).train()
+    model.trainable = True
+    # a short ramp for the few iterations of the benchmark
+    ema = ModelEMA(model, decay=0.99, ramp=20)
+
+    t0 = time.time()
+    train_losses(model, train_batches, args.iters, device, lr=1e-4, ema=ema)
+    t_iter = (time.time() - t0) / args.iters
+    t_ema = timeit(lambda: ema.update(model), args.repeat)
+
+    def val_loss(net):
+        # the loss of the eval-mode network, i.e. with the BN running statistics
+        trainable, training = net.trainable, net.training
+        net.trainable = True
+        net.eval()
+        with torch.no_grad():
+            loss = net(val_batch[0].to(device), target=val_batch[1].to(device))[-1].item()
+        net.trainable = trainable
+        net.train(training)
+        return loss
+
+    print('[EMA][%d iters][held-out loss: raw %.2f || ema %.2f] update: %.2f ms || train step: %.2f ms'
+          % (args.iters, val_loss(model), val_loss(ema.ema), t_ema * 1000, t_iter * 1000))
+
+    # the EMA model keeps its own grid, the training model is not affected
+    for val_size in [size + 32, size]:
+        ema.ema.set_grid([val_size, val_size])
+        with torch.no_grad():
+            bboxes, scores, cls_inds = [out[0] for out in ema.ema(torch.randn(1, 3, val_size, val_size, device=device))]
+        print('[EMA][eval at %d] %d detections || training grid: %d cells'
+              % (val_size, len(bboxes), model.grid_cell.size(1)))
+
+
+def bench_accumulate(args, device):
+    """
+    The backward of one batch of batch_size images against the backward of
+    accumulate batches of batch_size / accumulate images.
+    """
+    from models.yolo_v3_slim import YOLOv3Slim
+
+    size = args.input_size
+    batch_size = 8
+    images, targets = synthetic_batches(1, batch_size, size, args.num_classes)[0]
+    images, targets = images.to(device), targets.to(device)
+    torch.manual_seed(0)
+    model = YOLOv3Slim(device, input_size=[size, size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny').to(device).eval()
+    model.trainable = True
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+
+    def full():
+        model.zero_grad()
+        model(images, target=targets)[-1].backward()
+
+    def accumulated():
+        model.zero_grad()
+        for x, t in zip(images.chunk(args.accumulate), targets.chunk(args.accumulate)):
+            (model(x, target=t)[-1] / args.accumulate).backward()
+
+    t_full = timeit(full, args.repeat, sync)
+    t_acc = timeit(accumulated, args.repeat, sync)
+    print('[Accumulate][batch %d = %d x %d] one batch: %.2f ms || accumulated: %.2f ms'
+          % (batch_size, args.accumulate, batch_size // args.accumulate, t_full * 1000, t_acc * 1000))
+
+
+def bench_multiscale(args, device):
+    """
+    Multi-scale batches of VOC-like images, made by BaseTransform at 640 and
+    interpolated to the batch size on the device, as train.py did, against
+    BaseTransform producing the batch size directly, as the dataloader
+    workers do now. Also times set_grid with and without the grid cache.
+    """
+    from data import BaseTransform
+    from models.yolo_v3_slim import YOLOv3Slim
+
+    batch_size = 16
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, (375, 500, 3), dtype=np.uint8) for _ in range(batch_size)]
+    transform = BaseTransform([640, 640])
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+
+    for size in [320, 416, 608]:
+        def interpolated():
+            x = torch.stack([torch.from_numpy(transform(im)[0]).permute(2, 0, 1) for im in images]).to(device)
+            return torch.nn.functional.interpolate(x, size=[size, size], mode='bilinear', align_corners=False)
+
+        def direct():
+            return torch.stack([torch.from_numpy(transform(im, size=[size, size])[0]).permute(2, 0, 1) for im in images]).to(device)
+
+        t_old = timeit(interpolated, args.repeat, sync)
+        t_new = timeit(direct, args.repeat, sync)
+        print('[Multi-scale][size %d][batch %d] 640 + interpolate: %.2f ms || resized in the transform: %.2f ms (%.2fx)'
+              % (size, batch_size, t_old * 1000, t_new * 1000, t_old / t_new))
+
+    model = YOLOv3Slim(device, input_size=[416, 416], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny')
+    sizes = [i * 32 for i in range(10, 20)]
+
+    def set_grids():
+        for size in sizes:
+            model.set_grid([size, size])
+
+    def create_grids():
+        for size in sizes:
+            model.create_grid([size, size])
+
+    t_cached = timeit(set_grids, args.repeat, sync)
+    t_create = timeit(create_grids, args.repeat, sync)
+    print('[Multi-scale][%d sizes] create_grid: %.3f ms || cached set_grid: %.3f ms'
+          % (len(sizes), t_create * 1000, t_cached * 1000))
+
+
+def bench_rect(args, device):
+    """
+    Throughput of the inference (BaseTransform, forward and postprocess) on
+    square inputs against the letterboxed stride-32 rectangles of rect=True,
+    for VOC/COCO-like val images and for 1080p video frames.
+    """
+    from data import BaseTransform
+
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    size = 416
+    rng = np.random.RandomState(0)
+    shape_sets = {'val': [(375, 500), (500, 375), (333, 500), (480, 640), (427, 640), (640, 480)],
+                  '1080p': [(1080, 1920)]}
+    model = build_model('yolo_v3_slim', device, [size, size], args.num_classes, topk=args.topk).to(device).eval()
+    model.fuse()
+    for name, shapes in shape_sets.items():
+        images = [rng.randint(0, 256, shape + (3,), dtype=np.uint8) for shape in shapes]
+        results = []
+        for rect in [False, True]:
+            transform = BaseTransform([size, size], rect=rect)
+
+            def infer():
+                for img in images:
+                    x = transform.preprocess(img)[0].unsqueeze(0).to(device)
+                    model(x)
+
+            with torch.no_grad():
+                t = timeit(infer, args.repeat, sync)
+            pixels = np.mean([np.prod(transform(img)[0].shape[:2]) for img in images])
+            # the scale of the transform is the fraction of the input taken by the image, on each side
+            padding = 1 - np.mean([np.prod(transform(img)[3][0, :2]) for img in images])
+            results.append((len(images) / t, pixels, padding))
+        print('[Rect][%s][%d] square: %.1f images/s, %.0f pixels, %.0f%% padding || rect: %.1f images/s, %.0f pixels, %.0f%% padding (%.2fx)'
+              % (name, size, results[0][0], results[0][1], results[0][2] * 100,
+                 results[1][0], results[1][1], results[1][2] * 100, results[1][0] / results[0][0]))
+
+
+
+def bench_preprocess(args, device):
+    """
+    BaseTransform followed by the BGR -> RGB copy, the permute and the stack of
+    the callers, against BaseTransform.preprocess writing each image into a
+    (pinned, with cuda) batch tensor, for a batch of VOC/COCO-like val images.
+    """
+    from data import BaseTransform
+
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    size = 416
+    rng = np.random.RandomState(0)
+    shapes = [(375, 500), (500, 375), (333, 500), (480, 640), (427, 640), (640, 480), (1080, 1920)]
+    images = [rng.randint(0, 256, shape + (3,), dtype=np.uint8) for shape in shapes]
+    for rect in [False, True]:
+        transform = BaseTransform([size, size], rect=rect)
+
+        def current():
+            for img in images:
+                x = torch.from_numpy(transform(img)[0][:, :, (2, 1, 0)]).permute(2, 0, 1).unsqueeze(0).to(device)
+
+        def fused():
+            for img in images:
+                x = transform.preprocess(img)[0].unsqueeze(0).to(device)
+
+        t_current = timeit(current, args.repeat, sync)
+        t_fused = timeit(fused, args.repeat, sync)
+        # the uint8 rounding of the resize, at most half a level
+        diff = np.mean([np.abs(transform.preprocess(img)[0].numpy() - transform(img)[0][:, :, (2, 1, 0)].transpose(2, 0, 1)).mean()
+                        for img in images])
+        print('[Preprocess][rect=%s][%d] BaseTransform + to rgb + permute: %.2f ms/image || preprocess: %.2f ms/image (%.2fx), mean abs diff %.4f'
+              % (rect, size, t_current / len(images) * 1000, t_fused / len(images) * 1000, t_current / t_fused, diff))
+
+    # a batch of same size images, written into one (pinned) batch tensor
+    transform = BaseTransform([size, size])
+    batch = images[:-1] * (args.batch_size // (len(images) - 1) + 1)
+    batch = batch[:args.batch_size]
+    buffer = torch.empty([len(batch), 3, size, size], dtype=torch.float32)
+    if device.type == 'cuda':
+        buffer = buffer.pin_memory()
+
+    def current_batch():
+        x = torch.stack([torch.from_numpy(transform(img)[0][:, :, (2, 1, 0)]).permute(2, 0, 1) for img in batch])
+        return x.to(device)
+
+    def fused_batch():
+        for i, img in enumerate(batch):
+            transform.preprocess(img, out=buffer[i])
+        return buffer.to(device, non_blocking=True)
+
+    t_current = timeit(current_batch, args.repeat, sync)
+    t_fused = timeit(fused_batch, args.repeat, sync)
+    print('[Preprocess][batch %d][%d] stack: %.2f ms || into the batch tensor: %.2f ms (%.2fx)'
+          % (len(batch), size, t_current * 1000, t_fused * 1000, t_current / t_fused))
+
+
+def bench_cocoresults(args):
+    """
+    Accumulation of the COCO detections of a val split: the per-detection
+    json dicts dumped to a file for COCO.loadRes(), against the Nx7 array of
+    COCOResults handed to it directly.
+    """
+    import json
+    import tempfile
+    from utils.cocoapi_evaluator import COCOResults
+
+    num_images, dets_per_image = 5000, 100
+    rng = np.random.RandomState(0)
+    class_ids = np.arange(1, 91)[:args.num_classes]
+    images = []
+    for _ in range(num_images):
+        bboxes, scores, cls_inds = random_candidates(dets_per_image, args.num_classes, seed=rng.randint(1 << 30))
+        images.append((int(rng.randint(1 << 20)), bboxes * 640., scores, cls_inds))
+
+    def dicts():
+        data_dict = []
+        for id_, bboxes, scores, cls_inds in images:
+            for i, box in enumerate(bboxes):
+                x1, y1, x2, y2 = float(box[0]), float(box[1]), float(box[2]), float(box[3])
+                data_dict.append({"image_id": id_, "category_id": int(class_ids[int(cls_inds[i])]),
+                                  "bbox": [x1, y1, x2 - x1, y2 - y1], "score": float(scores[i])})
+        with tempfile.TemporaryFile('w') as f:
+            json.dump(data_dict, f)
+
+    def array():
+        results = COCOResults()
+        for id_, bboxes, scores, cls_inds in images:
+            results.append(id_, bboxes, scores, class_ids[cls_inds])
+        return results.array()
+
+    repeat = max(1, args.repeat // 10)
+    t_dicts = timeit(dicts, repeat)
+    t_array = timeit(array, repeat)
+    print('[COCO results][%d images x %d detections] dicts + json: %.1f ms || COCOResults array: %.1f ms (%.1fx)'
+          % (num_images, dets_per_image, t_dicts * 1000, t_array * 1000, t_dicts / t_array))
+
+
+def coco_fixture(num_images=500, num_classes=20, seed=0):
+    """
+    Synthetic COCO ground truth with crowd boxes, and detections: jittered
+    and duplicated ground truth boxes, false positives and tied scores.
+    """
+    rng = np.random.RandomState(seed)
+    cat_ids = np.arange(1, num_classes + 1) * 2
+    gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd = [], [], [], []
+    dets = []
+    for img_id in range(1, num_images + 1):
+        num_gt = rng.randint(0, 15)
+        xy = rng.uniform(0, 500, size=[num_gt, 2])
+        wh = rng.uniform(5, 150, size=[num_gt, 2])
+        boxes = np.round(np.concatenate([xy, wh], axis=1), 2)
+        cats = cat_ids[rng.randint(num_classes, size=num_gt)]
+        gt_img_ids += [img_id] * num_gt
+        gt_cat_ids += cats.tolist()
+        gt_boxes += boxes.tolist()
+        gt_crowd += (rng.uniform(size=num_gt) < 0.1).tolist()
+        # true positives, more or less localized, some of them duplicated
+        for box, cat in zip(boxes, cats):
+            for _ in range(rng.randint(0, 3)):
+                jitter = box + rng.normal(scale=0.05, size=4) * box[[2, 3, 2, 3]]
+                dets.append([img_id, *jitter, 0.0, cat])
+        # false positives
+        for _ in range(rng.randint(0, 30)):
+            dets.append([img_id, *rng.uniform(0, 500, size=2), *rng.uniform(5, 150, size=2), 0.0, cat_ids[rng.randint(num_classes)]])
+    dets = np.array(dets, dtype=np.float64)
+    dets[:, 3:5] = np.maximum(dets[:, 3:5], 1.)
+    # scores rounded to 2 decimals, many ties
+    dets[:, 5] = np.round(rng.uniform(0.001, 1., size=len(dets)), 2)
+
+    return dets, np.array(gt_img_ids), np.array(gt_cat_ids), np.array(gt_boxes).reshape(-1, 4), np.array(gt_crowd, dtype=bool), cat_ids
+
+
+def bench_cocomap(args):
+    """
+    utils.coco_map against pycocotools' COCOeval on a synthetic fixture.
+    """
+    import contextlib
+    import io
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+    from utils.coco_map import coco_map
+
+    dets, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, cat_ids = coco_fixture(num_classes=args.num_classes)
+    img_ids = np.unique(np.concatenate([gt_img_ids, dets[:, 0]])).astype(np.int64)
+    coco = COCO()
+    coco.dataset = {'images': [{'id': int(i)} for i in img_ids],
+                    'categories': [{'id': int(c)} for c in cat_ids],
+                    'annotations': [{'id': i + 1, 'image_id': int(img), 'category_id': int(cat), 'bbox': box.tolist(),
+                                     'area': float(box[2] * box[3]), 'iscrowd': int(crowd)}
+                                    for i, (img, cat, box, crowd) in enumerate(zip(gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd))]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco.createIndex()
+
+    def pycocotools():
+        with contextlib.redirect_stdout(io.StringIO()):
+            cocoEval = COCOeval(coco, coco.loadRes(dets), 'bbox')
+            cocoEval.params.imgIds = img_ids.tolist()
+            cocoEval.evaluate()
+            cocoEval.accumulate()
+            cocoEval.summarize()
+        return cocoEval.stats[0], cocoEval.stats[1]
+
+    def native():
+        return coco_map(dets, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, img_ids, cat_ids)
+
+    ref, ours = pycocotools(), native()
+    repeat = max(1, args.repeat // 10)
+    t_ref = timeit(pycocotools, repeat)
+    t_ours = timeit(native, repeat)
+    print('[COCO mAP][%d images, %d detections] pycocotools: AP %.5f AP50 %.5f, %.2f s || coco_map: AP %.5f AP50 %.5f, %.2f s (%.1fx)'
+          % (len(img_ids), len(dets), ref[0], ref[1], t_ref, ours[0], ours[1], t_ours, t_ref / t_ours))
+
+
+def voc_fixture(root, num_images=1000, labelmap=VOC_CLASSES, seed=0):
+    """
+    Writes the annotations of a synthetic VOC2007 test set under root, and
+    returns detections for it: jittered and duplicated ground truth boxes,
+    false positives, difficult objects and tied scores.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'VOC2007', 'Annotations'))
+    os.makedirs(os.path.join(root, 'VOC2007', 'ImageSets', 'Main'))
+    names = ['%06d' % i for i in range(num_images)]
+    with open(os.path.join(root, 'VOC2007', 'ImageSets', 'Main', 'test.txt'), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    all_boxes = [[[] for _ in range(num_images)] for _ in range(len(labelmap))]
+    for i, name in enumerate(names):
+        num_gt = rng.randint(1, 10)
+        xy = rng.randint(1, 400, size=[num_gt, 2])
+        boxes = np.concatenate([xy, xy + rng.randint(10, 100, size=[num_gt, 2])], axis=1)
+        labels = rng.randint(len(labelmap), size=num_gt)
+        objects = ''.join('<object><name>%s</name><pose>Unspecified</pose><truncated>0</truncated><difficult>%d</difficult>'
+                          '<bndbox><xmin>%d</xmin><ymin>%d</ymin><xmax>%d</xmax><ymax>%d</ymax></bndbox></object>'
+                          % (labelmap[l], rng.uniform() < 0.1, *box) for box, l in zip(boxes, labels))
+        with open(os.path.join(root, 'VOC2007', 'Annotations', name + '.xml'), 'w') as f:
+            f.write('<annotation><size><width>500</width><height>500</height><depth>3</depth></size>%s</annotation>' % objects)
+        dets = [[] for _ in labelmap]
+        for box, l in zip(boxes - 1, labels):
+            for _ in range(rng.randint(0, 3)):
+                dets[l].append(box + rng.normal(scale=5., size=4))
+        for _ in range(rng.randint(0, 20)):
+            xy = rng.uniform(0, 400, size=2)
+            dets[rng.randint(len(labelmap))].append(np.concatenate([xy, xy + rng.uniform(10, 100, size=2)]))
+        for j in range(len(labelmap)):
+            # scores rounded by the text files, many ties
+            scores = rng.uniform(0.001, 1., size=[len(dets[j]), 1])
+            all_boxes[j][i] = np.hstack([np.array(dets[j]).reshape(-1, 4), scores]).astype(np.float32)
+
+    return all_boxes
+
+
+def bench_vocmap(args):
+    """
+    VOCAPIEvaluator's text files and voc_eval() against the in-memory
+    utils.voc_map on a synthetic VOC2007 test set, for the 07 11-point and
+    the area metrics.
+    """
+    import shutil
+    import tempfile
+    from types import SimpleNamespace
+    from data import VOCAnnotationIndex
+    from utils.vocapi_evaluator import VOCAPIEvaluator
+    from utils.voc_map import voc_map
+
+    root = tempfile.mkdtemp()
+    try:
+        all_boxes = voc_fixture(root)
+        evaluator = VOCAPIEvaluator.__new__(VOCAPIEvaluator)
+        evaluator.labelmap, evaluator.set_type, evaluator.display = VOC_CLASSES, 'test', False
+        evaluator.devkit_path = os.path.join(root, 'VOC2007')
+        evaluator.annopath = os.path.join(root, 'VOC2007', 'Annotations', '%s.xml')
+        evaluator.imgsetpath = os.path.join(root, 'VOC2007', 'ImageSets', 'Main', 'test.txt')
+        ids = [(os.path.join(root, 'VOC2007'), line.strip()) for line in open(evaluator.imgsetpath)]
+        annopaths = [os.path.join(folder, 'Annotations', name + '.xml') for folder, name in ids]
+        evaluator.dataset = SimpleNamespace(ids=ids, anno_index=VOCAnnotationIndex(annopaths, {c: i for i, c in enumerate(VOC_CLASSES)}))
+        cachedir = os.path.join(evaluator.devkit_path, 'annotations_cache')
+        gt = evaluator.ground_truth()
+
+        for use_07 in [True, False]:
+            def files():
+                evaluator.write_voc_results_file(all_boxes)
+                return [evaluator.voc_eval(evaluator.get_voc_results_file_template(cls), cls, cachedir, 0.5, use_07)[2]
+                        for cls in VOC_CLASSES]
+
+            def in_memory():
+                return [ap for _, _, ap in voc_map(all_boxes, *gt, ovthresh=0.5, use_07_metric=use_07)]
+
+            ref, ours = files(), in_memory()
+            repeat = max(1, args.repeat // 10)
+            t_files = timeit(files, repeat)
+            t_memory = timeit(in_memory, repeat)
+            num_dets = sum(len(d) for cls_boxes in all_boxes for d in cls_boxes)
+            print('[VOC mAP][07 metric: %s][%d detections] text files: mAP %.6f, %.2f s || voc_map: mAP %.6f, %.2f s (%.1fx)'
+                  % (use_07, num_dets, np.mean(ref), t_files, np.mean(ours), t_memory, t_files / t_memory))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    if args.mode == 'nms':
+        bench_nms(args, device)
+    elif args.mode == 'latency':
+        bench_latency(args, device)
+    elif args.mode == 'gt':
+        bench_gt(args)
+    elif args.mode == 'fuse':
+        bench_fuse(args, device)
+    elif args.mode == 'export':
+        bench_export(args)
+    elif args.mode == 'amp':
+        bench_amp(args, device)
+    elif args.mode == 'ema':
+        bench_ema(args, device)
+    elif args.mode == 'accumulate':
+        bench_accumulate(args, device)
+    elif args.mode == 'multiscale':
+        bench_multiscale(args, device)
+    elif args.mode == 'rect':
+        bench_rect(args, device)
+    elif args.mode == 'preprocess':
+        bench_preprocess(args, device)
+    elif args.mode == 'cocoresults':
+        bench_cocoresults(args)
+    elif args.mode == 'cocomap':
+        bench_cocomap(args)
+    elif args.mode == 'vocmap':
+        bench_vocmap(args)
+    else:
+        print('Unknown mode !!!')
+        exit(0)
@@ -0,0 +1,666 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+
+import tools
+from data import MULTI_ANCHOR_SIZE_COCO, VOC_CLASSES
+from utils.nms import batched_nms
+from benchmark import (per_class_nms, random_candidates, loop_multi_gt_creator, random_labels, build_model,
+                       randomize_bn, synthetic_batches, train_losses, coco_fixture, voc_fixture)
+
+
+CHECKS = ['nms', 'gt', 'fuse', 'export', 'amp', 'ddp', 'ema', 'resume', 'accumulate', 'multiscale', 'rect',
+          'preprocess', 'cocomap', 'vocmap', 'streaming']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='YOLO Checks')
+    parser.add_argument('-m', '--mode', default='all',
+                        help='all, ' + ', '.join(CHECKS))
+    parser.add_argument('--num_boxes', default=5000, type=int,
+                        help='number of candidate boxes fed to NMS')
+    parser.add_argument('--num_classes', default=80, type=int,
+                        help='number of classes')
+    parser.add_argument('--nms_thresh', default=0.5, type=float,
+                        help='NMS threshold')
+    parser.add_argument('--batch_size', default=64, type=int,
+                        help='batch size in gt mode')
+    parser.add_argument('--iters', default=100, type=int,
+                        help='number of training iterations in amp mode')
+    parser.add_argument('-size', '--input_size', default=160, type=int,
+                        help='input size of the synthetic training images')
+    parser.add_argument('--accumulate', default=4, type=int,
+                        help='number of accumulated batches in accumulate mode')
+    parser.add_argument('--world_size', default=2, type=int,
+                        help='number of processes in ddp mode')
+    parser.add_argument('--cuda', action='store_true', default=False,
+                        help='use cuda.')
+
+    return parser.parse_args()
+
+
+def check_nms(args, device):
+    """ batched_nms must keep the boxes of the per-class loop, on small (dense) and large (greedy) groups. """
+    for num_boxes, num_classes in [(args.num_boxes, args.num_classes), (args.num_boxes, 2)]:
+        for clustered in [True, False]:
+            for diou in [False, True]:
+                bboxes, scores, cls_inds = random_candidates(num_boxes, num_classes, clustered)
+                keep_ref = per_class_nms(bboxes, scores, cls_inds, num_classes, args.nms_thresh, diou)
+                keep = batched_nms(torch.from_numpy(bboxes).to(device), torch.from_numpy(scores).to(device),
+                                   torch.from_numpy(cls_inds).to(device), args.nms_thresh, diou).cpu().numpy()
+                num_diff = len(set(keep_ref.tolist()) ^ set(keep.tolist()))
+                print('[NMS][%s][diou: %s][%d boxes][%d classes][%d kept][%d differ]'
+                      % ('clustered' if clustered else 'scattered', diou, num_boxes, num_classes, len(keep), num_diff))
+                assert num_diff == 0, 'batched_nms keeps other boxes than the per-class loop'
+
+
+def check_gt(args):
+    """ tools.multi_gt_creator must be bit-exact with the per-box loop. """
+    strides = [8, 16, 32]
+    for size in range(320, 608 + 1, 96):
+        label_lists = random_labels(args.batch_size, args.num_classes, seed=size)
+        input_size = [size, size]
+        gt_ref = loop_multi_gt_creator(input_size, strides, label_lists, MULTI_ANCHOR_SIZE_COCO).astype(np.float32)
+        gt_new = tools.multi_gt_creator(input_size, strides, label_lists, MULTI_ANCHOR_SIZE_COCO)
+        exact = gt_ref.shape == gt_new.shape and gt_ref.tobytes() == gt_new.tobytes()
+        print('[GT][%d][batch %d][%d boxes][bit-exact: %s]'
+              % (size, args.batch_size, sum(len(l) for l in label_lists), exact))
+        assert exact, 'the vectorized gt differs from the loop at size %d' % size
+
+
+def check_fuse(args, device):
+    """ The fused models must have no BN left, and decode the maps of conv+bn within 1e-4. """
+    for version in ['yolo_v3_slim', 'yolo_v3_slim_csp', 'yolo_v3_plus', 'yolo_v3_plus_small']:
+        for size in [416, 608]:
+            model = build_model(version, device, [size, size], args.num_classes).to(device).eval()
+            randomize_bn(model)
+            x = torch.randn(1, 3, size, size, device=device)
+
+            # compare the decoded maps fed to the post-processing
+            maps = []
+            batch_postprocess = model.batch_postprocess
+            def capture(all_bbox, all_class):
+                maps.append((all_bbox, all_class))
+                return batch_postprocess(all_bbox, all_class)
+            model.batch_postprocess = capture
+            with torch.no_grad():
+                model(x)
+                model.fuse()
+                model(x)
+            bbox_diff = (maps[0][0] - maps[-1][0]).abs().max().item()
+            class_diff = (maps[0][1] - maps[-1][1]).abs().max().item()
+            num_bn = sum(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules())
+            print('[Fuse][%s][%d][%d BN left][max diff: bbox %.2e, class %.2e]'
+                  % (version, size, num_bn, bbox_diff, class_diff))
+            assert num_bn == 0 and max(bbox_diff, class_diff) < 1e-4, 'the fused %s differs from conv+bn' % version
+
+
+def check_export(args):
+    """ The TorchScript and ONNX Runtime exports must match the eager model within 1e-4. """
+    import tempfile
+    import export
+
+    device = torch.device('cpu')
+    out_dir = tempfile.mkdtemp()
+    for version in ['yolo_v3_slim', 'yolo_v3_plus']:
+        size = 416
+        model = export.build_deploy_model(version, device, [size, size], args.num_classes, MULTI_ANCHOR_SIZE_COCO)
+        model.eval().fuse()
+        export.export_torchscript(model, [size, size], os.path.join(out_dir, version + '.torchscript.pt'))
+        runs = {'torchscript': export.torchscript_session(os.path.join(out_dir, version + '.torchscript.pt'))}
+        try:
+            import onnx
+            import onnxruntime
+        except ImportError:
+            print('onnx or onnxruntime is not installed, skip ONNX Runtime.')
+        else:
+            export.export_onnx(model, [size, size], os.path.join(out_dir, version + '.onnx'))
+            runs['onnxruntime'] = export.ort_session(os.path.join(out_dir, version + '.onnx'))
+
+        for batch_size in [1, 4]:
+            for name, run in runs.items():
+                bbox_diff, score_diff = export.check_parity(model, run, [size, size], batch_size)
+                print('[Export][%s][%d][batch %d][%s][max diff: bbox %.2e, score %.2e]'
+                      % (version, size, batch_size, name, bbox_diff, score_diff))
+                assert max(bbox_diff, score_diff) < 1e-4, 'the %s export of %s differs from the eager model' % (name, version)
+
+
+def check_amp(args, device):
+    """
+    Loss curves of fp32 and mixed precision training (bf16 on CPU, fp16 on GPU)
+    from the same initial weights, on a synthetic dataset. The losses must be
+    finite, and the smoothed curves within 15% of each other on average and at
+    the end (bf16 has 8 bits of mantissa, about 10% at the end here).
+    """
+    import copy
+    from models.yolo_v3_slim import YOLOv3Slim
+
+    size = args.input_size
+    batches = synthetic_batches(16, 4, size, args.num_classes)
+    torch.manual_seed(0)
+    # trained from scratch, without the pretrained backbone
+    model = YOLOv3Slim(device, input_size=[size, size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny').to(device).train()
+    model.trainable = True
+    amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+    curves = [train_losses(copy.deepcopy(model), batches, args.iters, device, lr=1e-4, amp_dtype=dtype)
+              for dtype in [None, amp_dtype]]
+    fp32, amp = curves
+    w = max(args.iters // 10, 1)
+    smooth = lambda x: np.convolve(x, np.ones(w) / w, mode='valid')
+    rel_diff = np.abs(smooth(amp) - smooth(fp32)) / smooth(fp32)
+    print('[AMP][%s][%d iters][finite: %s] relative difference of the smoothed loss curves: mean %.3f || max %.3f || final %.3f'
+          % (str(amp_dtype).split('.')[-1], args.iters, all(np.isfinite(curve).all() for curve in curves),
+             rel_diff.mean(), rel_diff.max(), rel_diff[-1]))
+    assert all(np.isfinite(curve).all() for curve in curves), 'the training diverged'
+    assert rel_diff.mean() < 0.15 and rel_diff[-1] < 0.15, 'the mixed precision loss curve departs from the fp32 one'
+
+
+def ddp_worker(rank, args):
+    from torch.nn.parallel import DistributedDataParallel
+    from models.yolo_v3_slim import YOLOv3Slim
+    from utils import distributed
+
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(args.world_size)})
+    distributed.init_distributed(cuda=False)
+    device = torch.device('cpu')
+    size = args.input_size
+
+    # a different initialization in each process: DDP must broadcast the weights of rank 0
+    torch.manual_seed(rank)
+    model = YOLOv3Slim(device, input_size=[size, size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny').train()
+    model.trainable = True
+    model = DistributedDataParallel(model)
+
+    images, targets = [torch.cat(t) for t in zip(*synthetic_batches(8, 2, size, args.num_classes))]
+    dataset = torch.utils.data.TensorDataset(images, targets)
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset, seed=0)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=2, sampler=sampler)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4 * args.world_size, momentum=0.9, weight_decay=5e-4)
+
+    seen = []
+    t0 = time.time()
+    num_iters = 0
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        for images, targets in dataloader:
+            total_loss = model(images, target=targets)[-1]
+            total_loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            seen.append(epoch)
+            num_iters += 1
+    t = (time.time() - t0) / num_iters
+
+    # the weights must be the same in all the processes, and the samplers disjoint
+    params = torch.cat([p.detach().view(-1) for p in model.parameters()])
+    all_params = [torch.zeros_like(params) for _ in range(args.world_size)]
+    torch.distributed.all_gather(all_params, params)
+    indices = torch.tensor(list(iter(sampler)))
+    all_indices = [torch.zeros_like(indices) for _ in range(args.world_size)]
+    torch.distributed.all_gather(all_indices, indices)
+    if distributed.is_main_process():
+        max_diff = max((p - all_params[0]).abs().max().item() for p in all_params)
+        disjoint = len(torch.cat(all_indices).unique()) == len(dataset)
+        print('[DDP][world size %d][%d iters / process][%.2f ms / iter][max weight diff across processes: %.2e][disjoint samplers: %s] last loss: %.2f'
+              % (args.world_size, num_iters, t * 1000, max_diff, disjoint, total_loss.item()))
+        assert max_diff < 1e-6 and disjoint, 'the processes diverged or their samplers overlap'
+    torch.distributed.destroy_process_group()
+
+
+def check_ddp(args):
+    """ Multi-process smoke test of distributed data-parallel training with gloo, on a synthetic dataset. """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    torch.multiprocessing.spawn(ddp_worker, args=(args,), nprocs=args.world_size)
+
+
+def check_ema(args, device):
+    """ The EMA of the _foreach updates of ModelEMA must be the one of the per-tensor formula. """
+    from models.yolo_v3_slim import YOLOv3Slim
+    from utils import ModelEMA
+
+    torch.manual_seed(0)
+    model = YOLOv3Slim(device, input_size=[args.input_size, args.input_size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny').to(device).train()
+    ema = ModelEMA(model, decay=0.99, ramp=20)
+
+    # ema = d * ema + (1 - d) * model, tensor by tensor, over updates of other weights
+    expected = [v.clone() for v in ema.ema_tensors]
+    for _ in range(10):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(torch.randn_like(p), alpha=0.01)
+            for m in model.modules():
+                if isinstance(m, torch.nn.BatchNorm2d):
+                    m.running_mean.add_(torch.randn_like(m.running_mean), alpha=0.01)
+        d = ema.decay(ema.updates + 1)
+        model_tensors = [v for v in model.state_dict().values() if v.dtype.is_floating_point]
+        expected = [d * e + (1. - d) * v for e, v in zip(expected, model_tensors)]
+        ema.update(model)
+    max_diff = max((e - v).abs().max().item() for e, v in zip(expected, ema.ema_tensors))
+    print('[EMA][10 updates] max diff to the per-tensor formula: %.2e' % max_diff)
+    assert max_diff < 1e-5, 'the _foreach EMA update departs from the per-tensor formula'
+
+
+def voc_train_fixture(root, num_images=24, size=160, labelmap=VOC_CLASSES, seed=0):
+    """
+    Writes a synthetic VOCdevkit under root for train.py: random images with
+    boxes of random colors in VOC2007 and VOC2012 trainval, and VOC2007 test.
+    """
+    import cv2
+
+    rng = np.random.RandomState(seed)
+    for year, image_set, start in [('2007', 'trainval', 0), ('2012', 'trainval', num_images // 2), ('2007', 'test', num_images)]:
+        rootpath = os.path.join(root, 'VOC' + year)
+        for folder in ['Annotations', 'JPEGImages', os.path.join('ImageSets', 'Main')]:
+            os.makedirs(os.path.join(rootpath, folder), exist_ok=True)
+        names = ['%06d' % i for i in range(start, start + num_images // 2)]
+        with open(os.path.join(rootpath, 'ImageSets', 'Main', image_set + '.txt'), 'w') as f:
+            f.write('\n'.join(names) + '\n')
+        for name in names:
+            image = rng.randint(0, 256, size=[size, size, 3]).astype(np.uint8)
+            objects = ''
+            for _ in range(rng.randint(1, 4)):
+                xy = rng.randint(1, size // 2, size=2)
+                box = np.concatenate([xy, xy + rng.randint(16, size // 2, size=2)])
+                image[box[1]:box[3], box[0]:box[2]] = rng.randint(0, 256, size=3)
+                objects += ('<object><name>%s</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>'
+                            '<bndbox><xmin>%d</xmin><ymin>%d</ymin><xmax>%d</xmax><ymax>%d</ymax></bndbox></object>'
+                            % (labelmap[rng.randint(len(labelmap))], *box))
+            cv2.imwrite(os.path.join(rootpath, 'JPEGImages', name + '.jpg'), image)
+            with open(os.path.join(rootpath, 'Annotations', name + '.xml'), 'w') as f:
+                f.write('<annotation><size><width>%d</width><height>%d</height><depth>3</depth></size>%s</annotation>'
+                        % (size, size, objects))
+
+
+class StopTraining(Exception):
+    pass
+
+
+def train_run(root, save_folder, argv, max_epoch, stop_at=None):
+    """
+    Runs train.train() on the VOCdevkit under root, for max_epoch epochs, with
+    the command line arguments argv. It stops after the checkpoint of the
+    iteration stop_at (epoch, iter) as if the run was killed, and resumes from
+    the last checkpoint of save_folder when there is one. Returns the model of
+    the last checkpoint.
+    """
+    import sys
+    import contextlib
+    import io
+    import train
+    from utils.checkpoint import load_checkpoint
+
+    def save_checkpoint(state, path):
+        train_save_checkpoint(state, path)
+        if (state['epoch'], state['iter']) == stop_at:
+            raise StopTraining()
+
+    train_save_checkpoint = train.save_checkpoint
+    train_cfg, voc_root = train.train_cfg, train.VOC_ROOT
+    train.save_checkpoint = save_checkpoint
+    train.train_cfg, train.VOC_ROOT = dict(train_cfg, max_epoch=max_epoch), root
+    sys_argv = sys.argv
+    sys.argv = ['train.py', '-d', 'voc', '--save_folder', save_folder, '--auto_resume', '--save_iter', '1', *argv]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            train.train()
+    except StopTraining:
+        pass
+    finally:
+        train.save_checkpoint = train_save_checkpoint
+        train.train_cfg, train.VOC_ROOT = train_cfg, voc_root
+        sys.argv = sys_argv
+
+    return load_checkpoint(os.path.join(save_folder, 'voc', argv[argv.index('-v') + 1], 'last.pth'))['model']
+
+
+def check_resume(args):
+    """
+    A run of train.py killed in the middle of an epoch and resumed from its
+    checkpoint must end with the same weights as a run without stop, with the
+    augmentations and the mosaic drawn in several dataloader workers.
+    """
+    import shutil
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    voc_train_fixture(os.path.join(root, 'VOCdevkit'))
+    argv = ['-v', 'yolo_v3_slim', '--batch_size', '4', '--num_workers', '3', '--mosaic', '--eval_epoch', '100', '--no_warm_up', '--lr', '1e-4']
+    t0 = time.time()
+    reference = train_run(os.path.join(root, 'VOCdevkit/'), os.path.join(root, 'reference'), argv, max_epoch=2)
+    first = train_run(os.path.join(root, 'VOCdevkit/'), os.path.join(root, 'resumed'), argv, max_epoch=2, stop_at=(1, 2))
+    resumed = train_run(os.path.join(root, 'VOCdevkit/'), os.path.join(root, 'resumed'), argv, max_epoch=2)
+    t = time.time() - t0
+    shutil.rmtree(root)
+
+    exact = all(torch.equal(resumed[k], reference[k]) for k in reference)
+    changed = any(not torch.equal(first[k], reference[k]) for k in reference if first[k].is_floating_point())
+    print('[Resume][train.py, 3 workers, stopped after epoch 1, iteration 2][same weights as without stop: %s][%.1f s]'
+          % (exact, t))
+    assert changed, 'the first run was not stopped before the end'
+    assert exact, 'the resumed run does not reproduce the weights of the run without stop'
+
+
+def check_accumulate(args, device):
+    """
+    The gradient accumulated over accumulate batches of batch_size / accumulate
+    images must be the gradient of one batch of batch_size images. BN uses its
+    running statistics here, with batch statistics they would differ per batch.
+    """
+    from models.yolo_v3_slim import YOLOv3Slim
+
+    size = args.input_size
+    batch_size = 8
+    images, targets = synthetic_batches(1, batch_size, size, args.num_classes)[0]
+    images, targets = images.to(device), targets.to(device)
+    torch.manual_seed(0)
+    model = YOLOv3Slim(device, input_size=[size, size], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny').to(device).eval()
+    model.trainable = True
+
+    model.zero_grad()
+    model(images, target=targets)[-1].backward()
+    grads = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+    for x, t in zip(images.chunk(args.accumulate), targets.chunk(args.accumulate)):
+        (model(x, target=t)[-1] / args.accumulate).backward()
+    rel_diff = max(((p.grad - g).norm() / g.norm().clamp(min=1e-12)).item() for p, g in zip(model.parameters(), grads))
+    print('[Accumulate][batch %d = %d x %d][max relative grad diff: %.2e]'
+          % (batch_size, args.accumulate, batch_size // args.accumulate, rel_diff))
+    assert rel_diff < 1e-4, 'the accumulated gradient differs from the gradient of one batch'
+
+
+def check_multiscale(args, device):
+    """
+    The batches of train.py resized by the dataloader workers must have the
+    sizes drawn by MultiScaleBatchSampler, and the grids cached by set_grid
+    must be the ones of create_grid.
+    """
+    import shutil
+    import tempfile
+    from data import VOCDetection, MultiScaleBatchSampler, MultiScaleDataset
+    from models.yolo_v3_slim import YOLOv3Slim
+    from utils import SSDAugmentation
+
+    root = tempfile.mkdtemp()
+    voc_train_fixture(root, num_images=48)
+    dataset = VOCDetection(os.path.join(root, ''), 640, [('2007', 'trainval')], transform=SSDAugmentation([640, 640]))
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=1, rank=0)
+    batch_sampler = MultiScaleBatchSampler(sampler, batch_size=4, input_size=[640, 640],
+                                           sizes=[i * 32 for i in range(10, 20)], interval=1)
+    dataloader = torch.utils.data.DataLoader(MultiScaleDataset(dataset), batch_sampler=batch_sampler,
+                                             collate_fn=tools.GTCollate([8, 16, 32], MULTI_ANCHOR_SIZE_COCO),
+                                             num_workers=2)
+    batch_sizes = [tuple(images.shape) for images, _, _ in dataloader]
+    expected = [(min(4, len(dataset) - 4 * i), 3, *batch_sampler.size_of(i)) for i in range(len(batch_sampler))]
+    shutil.rmtree(root)
+    print('[Multi-scale][%d batches of the workers] sizes: %s'
+          % (len(batch_sizes), ' '.join('%d' % s[-1] for s in batch_sizes)))
+    assert batch_sizes == expected, 'the workers did not resize the batches to the sizes of the batch sampler'
+
+    model = YOLOv3Slim(device, input_size=[416, 416], num_classes=args.num_classes,
+                       anchor_size=MULTI_ANCHOR_SIZE_COCO, backbone='d-tiny')
+    sizes = [i * 32 for i in range(10, 20)]
+    model.precompute_grids([[s, s] for s in sizes])
+    for size in sizes:
+        model.set_grid([size, size])
+        assert all(torch.equal(a, b) for a, b in zip(model.create_grid([size, size]),
+                                                     [model.grid_cell, model.stride_tensor, model.all_anchors_wh]))
+    print('[Multi-scale][%d sizes] cached set_grid: same grids as create_grid' % len(sizes))
+
+
+def check_rect(args):
+    """
+    A white box on a black image, found by thresholding the input of the
+    square and of the rect=True BaseTransform and mapped back by
+    map_to_image, must be the box of the image within one pixel of the input.
+    """
+    from data import BaseTransform, map_to_image
+
+    size = 416
+    for shape in [(375, 500), (500, 375), (333, 500), (480, 640), (427, 640), (640, 480), (1080, 1920)]:
+        h, w = shape
+        img = np.zeros(shape + (3,), dtype=np.uint8)
+        box = np.array([w // 5, h // 3, w * 2 // 3, h * 4 // 5])
+        img[box[1]:box[3], box[0]:box[2]] = 255
+        mapped = []
+        for rect in [False, True]:
+            transform = BaseTransform([size, size], rect=rect)
+            x, _, scale, offset = transform.preprocess(img)
+            ys, xs = np.nonzero(x[0].numpy() > (transform.lut[0, 0] + transform.lut[0, 255]) / 2)
+            pad_h, pad_w = x.shape[1:]
+            found = np.array([[xs.min() / pad_w, ys.min() / pad_h, (xs.max() + 1) / pad_w, (ys.max() + 1) / pad_h]])
+            mapped.append(map_to_image(found, offset, scale, h, w)[0])
+        # one pixel of the input, in pixels of the image
+        pixel = max(h, w) / size
+        err = max(np.abs(m - box).max() for m in mapped)
+        print('[Rect][%dx%d] box mapped back: square %s || rect %s || max error %.2f input pixels'
+              % (w, h, np.round(mapped[0], 1), np.round(mapped[1], 1), err / pixel))
+        assert err <= pixel, 'the box mapped back by map_to_image is not the box of the image'
+
+
+def check_preprocess(args):
+    """
+    BaseTransform.preprocess against the float path of BaseTransform, square
+    and rect=True: the same geometry, the resize of the uint8 image only
+    rounds the pixels, by at most half a level.
+    """
+    import cv2
+    from data import BaseTransform
+
+    size = 416
+    rng = np.random.RandomState(0)
+    for rect in [False, True]:
+        transform = BaseTransform([size, size], rect=rect)
+        # half a level, in normalized values
+        tol = 0.5 / 255. / transform.std.min() + 1e-4
+        for shape in [(375, 500), (500, 375), (333, 500), (480, 640), (427, 640), (640, 480), (1080, 1920), (301, 300)]:
+            img = cv2.GaussianBlur(rng.randint(0, 256, shape + (3,), dtype=np.uint8), (5, 5), 2)
+            x, _, scale, offset = transform.preprocess(img)
+            ref, _, _, ref_scale, ref_offset = transform(img)
+            diff = np.abs(x.numpy() - ref[:, :, (2, 1, 0)].transpose(2, 0, 1))
+            print('[Preprocess][rect=%s][%dx%d] mean abs diff %.4f || max %.4f (half a level: %.4f)'
+                  % (rect, shape[1], shape[0], diff.mean(), diff.max(), tol))
+            assert np.allclose(scale, ref_scale) and np.allclose(offset, ref_offset), 'preprocess places the image elsewhere'
+            assert diff.max() <= tol, 'preprocess differs from BaseTransform by more than the rounding'
+
+
+def check_cocomap(args):
+    """
+    utils.coco_map against pycocotools' COCOeval on a synthetic fixture: the
+    AP@[.5:.95] and AP50 must match within 1e-4.
+    """
+    import contextlib
+    import io
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+    from utils.coco_map import coco_map
+
+    dets, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, cat_ids = coco_fixture(num_classes=args.num_classes)
+    img_ids = np.unique(np.concatenate([gt_img_ids, dets[:, 0]])).astype(np.int64)
+    coco = COCO()
+    coco.dataset = {'images': [{'id': int(i)} for i in img_ids],
+                    'categories': [{'id': int(c)} for c in cat_ids],
+                    'annotations': [{'id': i + 1, 'image_id': int(img), 'category_id': int(cat), 'bbox': box.tolist(),
+                                     'area': float(box[2] * box[3]), 'iscrowd': int(crowd)}
+                                    for i, (img, cat, box, crowd) in enumerate(zip(gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd))]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco.createIndex()
+        cocoEval = COCOeval(coco, coco.loadRes(dets), 'bbox')
+        cocoEval.params.imgIds = img_ids.tolist()
+        cocoEval.evaluate()
+        cocoEval.accumulate()
+        cocoEval.summarize()
+    ref = cocoEval.stats[0], cocoEval.stats[1]
+    ours = coco_map(dets, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, img_ids, cat_ids)
+    diff = max(abs(ref[0] - ours[0]), abs(ref[1] - ours[1]))
+    print('[COCO mAP][%d images, %d detections] pycocotools: AP %.5f AP50 %.5f || coco_map: AP %.5f AP50 %.5f || max diff %.2e'
+          % (len(img_ids), len(dets), ref[0], ref[1], ours[0], ours[1], diff))
+    assert diff < 1e-4, 'coco_map differs from pycocotools'
+
+
+def check_vocmap(args):
+    """
+    VOCAPIEvaluator's text files and voc_eval() against the in-memory
+    utils.voc_map on a synthetic VOC2007 test set: the APs must be identical,
+    for the 07 11-point and the area metrics.
+    """
+    import shutil
+    import tempfile
+    from types import SimpleNamespace
+    from data import VOCAnnotationIndex
+    from utils.vocapi_evaluator import VOCAPIEvaluator
+    from utils.voc_map import voc_map
+
+    root = tempfile.mkdtemp()
+    try:
+        all_boxes = voc_fixture(root)
+        evaluator = VOCAPIEvaluator.__new__(VOCAPIEvaluator)
+        evaluator.labelmap, evaluator.set_type, evaluator.display = VOC_CLASSES, 'test', False
+        evaluator.devkit_path = os.path.join(root, 'VOC2007')
+        evaluator.annopath = os.path.join(root, 'VOC2007', 'Annotations', '%s.xml')
+        evaluator.imgsetpath = os.path.join(root, 'VOC2007', 'ImageSets', 'Main', 'test.txt')
+        ids = [(os.path.join(root, 'VOC2007'), line.strip()) for line in open(evaluator.imgsetpath)]
+        annopaths = [os.path.join(folder, 'Annotations', name + '.xml') for folder, name in ids]
+        evaluator.dataset = SimpleNamespace(ids=ids, anno_index=VOCAnnotationIndex(annopaths, {c: i for i, c in enumerate(VOC_CLASSES)}))
+        cachedir = os.path.join(evaluator.devkit_path, 'annotations_cache')
+        gt = evaluator.ground_truth()
+
+        evaluator.write_voc_results_file(all_boxes)
+        for use_07 in [True, False]:
+            ref = [evaluator.voc_eval(evaluator.get_voc_results_file_template(cls), cls, cachedir, 0.5, use_07)[2]
+                   for cls in VOC_CLASSES]
+            ours = [ap for _, _, ap in voc_map(all_boxes, *gt, ovthresh=0.5, use_07_metric=use_07)]
+            print('[VOC mAP][07 metric: %s] text files: mAP %.6f || voc_map: mAP %.6f || %s'
+                  % (use_07, np.mean(ref), np.mean(ours), 'identical' if ref == ours else 'MISMATCH'))
+            assert ref == ours, 'voc_map differs from the text files'
+    finally:
+        shutil.rmtree(root)
+
+
+def check_streaming(args):
+    """
+    utils.streaming_map against coco_map and voc_map, fed one image at a time.
+    With one detection per score bin the APs must match within 1e-9, with
+    the tied scores of the fixtures the difference is that of the binning.
+    """
+    import shutil
+    import tempfile
+    from data import VOCAnnotationIndex
+    from utils.coco_map import coco_map
+    from utils.voc_map import voc_map
+    from utils.streaming_map import StreamingMAP
+
+    rng = np.random.RandomState(0)
+    num_bins = 10000
+    tied, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, cat_ids = coco_fixture(num_classes=args.num_classes)
+    img_ids = np.unique(np.concatenate([gt_img_ids, tied[:, 0]])).astype(np.int64)
+    gt_xyxy = np.concatenate([gt_boxes[:, :2], gt_boxes[:, :2] + gt_boxes[:, 2:]], axis=1)
+    # the same detections, with a distinct score bin for each detection of a category
+    untied = tied.copy()
+    for cat_id in cat_ids:
+        d = np.nonzero(untied[:, 6] == cat_id)[0]
+        untied[d, 5] = (rng.permutation(num_bins)[:len(d)] + 0.5) / num_bins
+    for ties, dets in [(False, untied), (True, tied)]:
+        ref = coco_map(dets, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, img_ids, cat_ids)
+        accumulator = StreamingMAP(len(cat_ids), gt_img_ids, np.searchsorted(cat_ids, gt_cat_ids), gt_xyxy, gt_crowd,
+                                   metric='coco', num_bins=num_bins)
+        t0 = time.time()
+        for img_id in img_ids:
+            d = dets[dets[:, 0] == img_id]
+            accumulator.update(img_id, np.concatenate([d[:, 1:3], d[:, 1:3] + d[:, 3:5]], axis=1), d[:, 5],
+                               np.searchsorted(cat_ids, d[:, 6]))
+        t = time.time() - t0
+        ours = accumulator.compute()
+        diff = max(abs(ref[0] - ours['map']), abs(ref[1] - ours['ap50']))
+        print('[Streaming COCO][tied scores: %s] coco_map: AP %.5f AP50 %.5f || streaming: AP %.5f AP50 %.5f, %.1f images/s, %.1f MB || max diff %.2e %s'
+              % (ties, ref[0], ref[1], ours['map'], ours['ap50'], len(img_ids) / t,
+                 (accumulator.tp.nbytes + accumulator.fp.nbytes) / 2 ** 20, diff,
+                 '' if ties else ('OK' if diff < 1e-9 else 'MISMATCH')))
+        assert ties or diff < 1e-9, 'the streaming COCO AP differs from coco_map'
+
+    root = tempfile.mkdtemp()
+    try:
+        tied = voc_fixture(root)
+        names = [line.strip() for line in open(os.path.join(root, 'VOC2007', 'ImageSets', 'Main', 'test.txt'))]
+        index = VOCAnnotationIndex([os.path.join(root, 'VOC2007', 'Annotations', name + '.xml') for name in names],
+                                   {c: i for i, c in enumerate(VOC_CLASSES)})
+        gt_imgs = np.repeat(np.arange(len(index)), np.diff(index.offsets))
+        gt_boxes = np.asarray(index.boxes, dtype=np.float64)
+        # distinct '{:.3f}' scores and '{:.1f}' boxes, so that the text quantization changes nothing
+        untied = [[d.copy() for d in cls_boxes] for cls_boxes in tied]
+        for cls_boxes in untied:
+            scores = rng.permutation(1000) / 1000. + 0.0004
+            sizes = np.cumsum([0] + [len(d) for d in cls_boxes])
+            for i, d in enumerate(cls_boxes):
+                d[:, 4] = scores[sizes[i]:sizes[i + 1]]
+                d[:, :4] = np.round(d[:, :4], 1)
+        for ties, all_boxes in [(False, untied), (True, tied)]:
+            for metric, use_07 in [('voc07', True), ('voc', False)]:
+                ref = [ap for _, _, ap in voc_map(all_boxes, gt_imgs, index.labels, gt_boxes + 1, index.difficult,
+                                                  use_07_metric=use_07)]
+                accumulator = StreamingMAP(len(VOC_CLASSES), gt_imgs, index.labels, gt_boxes, index.difficult, metric=metric)
+                for i in range(len(names)):
+                    d = [cls_boxes[i] for cls_boxes in all_boxes]
+                    labels = np.repeat(np.arange(len(d)), [len(c) for c in d])
+                    d = np.concatenate(d)
+                    accumulator.update(i, d[:, :4], d[:, 4], labels)
+                ours = accumulator.compute()
+                diff = np.abs(np.array(ref) - ours['aps']).max()
+                print('[Streaming VOC][%s][tied scores: %s] voc_map: mAP %.5f || streaming: mAP %.5f || max class diff %.2e %s'
+                      % (metric, ties, np.mean(ref), ours['map'], diff,
+                         '' if ties else ('OK' if diff < 1e-9 else 'MISMATCH')))
+                assert ties or diff < 1e-9, 'the streaming %s AP differs from voc_map' % metric
+    finally:
+        shutil.rmtree(root)
+
+
+def run_check(mode, args, device):
+    if mode == 'nms':
+        check_nms(args, device)
+    elif mode == 'gt':
+        check_gt(args)
+    elif mode == 'fuse':
+        check_fuse(args, device)
+    elif mode == 'export':
+        check_export(args)
+    elif mode == 'amp':
+        check_amp(args, device)
+    elif mode == 'ddp':
+        check_ddp(args)
+    elif mode == 'ema':
+        check_ema(args, device)
+    elif mode == 'resume':
+        check_resume(args)
+    elif mode == 'accumulate':
+        check_accumulate(args, device)
+    elif mode == 'multiscale':
+        check_multiscale(args, device)
+    elif mode == 'rect':
+        check_rect(args)
+    elif mode == 'preprocess':
+        check_preprocess(args)
+    elif mode == 'cocomap':
+        check_cocomap(args)
+    elif mode == 'vocmap':
+        check_vocmap(args)
+    elif mode == 'streaming':
+        check_streaming(args)
+    else:
+        print('Unknown mode !!!')
+        exit(0)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    # each check raises an AssertionError on a mismatch
+    for mode in CHECKS if args.mode == 'all' else [args.mode]:
+        run_check(mode, args, device)
@@ -1,8 +1,11 @@
-from .voc0712 import VOCDetection, VOCAnnotationTransform, VOC_CLASSES, VOC_ROOT
+from .voc0712 import VOCDetection, VOCAnnotationTransform, VOCAnnotationIndex, VOC_CLASSES, VOC_ROOT
 from .cocodataset import coco_class_index, coco_class_labels, COCODataset, coco_root
 from .config import *
+from .image_cache import ImageCache
+from .shards import pack_shards, ShardReader, ShardSampler
 import torch
 import cv2
+import random
 import numpy as np
 
 def detection_collate(batch):
@@ -26,13 +29,130 @@ def detection_collate(batch):
     return torch.stack(imgs, 0), targets
 
 
+class MultiScaleBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler for the multi-scale trick.
+
+    Each batch is a list of (index, input_size, seed), so that the dataloader
+    workers know the input size of the batch they are loading. A new size is
+    drawn from sizes every interval batches, counted across epochs. Without
+    sizes, all the batches use input_size.
+
+    The size of a batch only depends on seed, the epoch set by set_epoch() and
+    the position of the batch in the epoch, not on how far the dataloader has
+    prefetched, and the seed of the augmentation of an image only on seed, the
+    epoch and its index, not on the worker loading it, so that a training run
+    can be resumed in the middle of an epoch: set_epoch(epoch, start_iter)
+    skips the first start_iter batches.
+    """
+    def __init__(self, sampler, batch_size, input_size, sizes=None, interval=10, drop_last=False, seed=0):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.input_size = list(input_size)
+        self.sizes = sizes
+        self.interval = interval
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start_iter = 0
+
+    def set_epoch(self, epoch, start_iter=0):
+        self.epoch = epoch
+        self.start_iter = start_iter
+
+    def __iter__(self):
+        batch = []
+        iter_i = 0
+        for index in self.sampler:
+            batch.append(index)
+            if len(batch) == self.batch_size:
+                if iter_i >= self.start_iter:
+                    yield self.attach_size(batch, iter_i)
+                batch = []
+                iter_i += 1
+        if len(batch) > 0 and not self.drop_last and iter_i >= self.start_iter:
+            yield self.attach_size(batch, iter_i)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def size_of(self, iter_i):
+        block = (self.epoch * len(self) + iter_i) // self.interval
+        if self.sizes is None or block == 0:
+            return tuple(self.input_size)
+        # randomly choose a new size
+        size = random.Random(self.seed * 1000003 + block).choice(self.sizes)
+
+        return (size, size)
+
+    def seed_of(self, index):
+        return ((self.seed * 1000003 + self.epoch) * 1000003 + index) % 2**32
+
+    def attach_size(self, batch, iter_i):
+        size = self.size_of(iter_i)
+
+        return [(index, size, self.seed_of(index)) for index in batch]
+
+
+class MultiScaleDataset(torch.utils.data.Dataset):
+    """Wraps a detection dataset to be indexed by the (index, input_size, seed) of MultiScaleBatchSampler.
+
+    The image is loaded by dataset.pull_item(index, input_size), so that the
+    transform of the dataset (and the mosaic) produce the input size of the
+    batch directly, in the dataloader workers. The random and numpy RNGs of
+    the augmentation are seeded with seed first.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.name = dataset.name
+
+    def __getitem__(self, index):
+        index, input_size, seed = index
+        random.seed(seed)
+        np.random.seed(seed)
+        im, gt = self.dataset.pull_item(index, input_size)[:2]
+
+        return im, gt, input_size
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class InferenceDataset(torch.utils.data.Dataset):
+    """Wraps a detection dataset to load and preprocess its images for inference, in the dataloader workers.
+
+    Each sample is the [3, H, W] tensor of transform.preprocess and the
+    (index, height, width, offset, scale) of the image, to map the detections
+    back to its original size. Batched by inference_collate.
+    """
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __getitem__(self, index):
+        # the original size, even if the image is downscaled in the shards
+        img, (height, width) = self.dataset.load_image(index)
+        x, _, scale, offset = self.transform.preprocess(img)
+
+        return x, (index, height, width, offset, scale)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def inference_collate(batch):
+    """Stacks the images of InferenceDataset, and lists their (index, height, width, offset, scale)."""
+    return torch.stack([sample[0] for sample in batch], 0), [sample[1] for sample in batch]
+
+
 def base_transform(image, size, mean, std, boxes=None):
     height, width, _ = image.shape
     # normalize
     image = image.astype(np.float32)
     # zero padding
     if height > width:
-        image_ = np.zeros([height, height, 3])
+        image_ = np.zeros([height, height, 3], dtype=np.float32)
         delta_w = height - width
         left = delta_w // 2
         image_[:, left:left+width, :] = image
@@ -40,7 +160,7 @@ def base_transform(image, size, mean, std, boxes=None):
         scale =  np.array([[width / height, 1., width / height, 1.]])
 
     elif height < width:
-        image_ = np.zeros([width, width, 3])
+        image_ = np.zeros([width, width, 3], dtype=np.float32)
         delta_h = width - height
         top = delta_h // 2
         image_[top:top+height, :, :] = image
@@ -64,13 +184,160 @@ def base_transform(image, size, mean, std, boxes=None):
     return image_, boxes, scale, offset
 
 
+def letterbox_geometry(height, width, size, stride=32):
+    """
+    Returns the padded [pad_h, pad_w] input of letterbox_transform, and the
+    [new_h, new_w] size and [top, left] position of the resized image in it.
+    """
+    r = max(size) / max(height, width)
+    new_h, new_w = int(round(height * r)), int(round(width * r))
+    pad_h, pad_w = int(np.ceil(new_h / stride) * stride), int(np.ceil(new_w / stride) * stride)
+    top, left = (pad_h - new_h) // 2, (pad_w - new_w) // 2
+
+    return pad_h, pad_w, new_h, new_w, top, left
+
+
+def square_resize(image, size, top, left):
+    """
+    cv2.resize of the image zero padded at (top, left) of a square by
+    base_transform, without the padded copy: cv2.resize maps the pixel x of
+    the output to (x + 0.5) / s - 0.5 in the square and repeats the pixels of
+    its border, so a warp with a border of one zero pixel on the padded sides
+    of the image and BORDER_REPLICATE reads the same samples.
+    """
+    height, width = image.shape[:2]
+    side = max(height, width)
+    if height == width:
+        return cv2.resize(image, (size[1], size[0]))
+    bt, bb = int(top > 0), int(side - height - top > 0)
+    bl, br = int(left > 0), int(side - width - left > 0)
+    image = cv2.copyMakeBorder(image, bt, bb, bl, br, cv2.BORDER_CONSTANT, value=0)
+    sy, sx = size[0] / side, size[1] / side
+    M = np.array([[sx, 0., sx * (left - bl + 0.5) - 0.5],
+                  [0., sy, sy * (top - bt + 0.5) - 0.5]])
+
+    return cv2.warpAffine(image, M, (size[1], size[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def normalize_lut(mean, std):
+    """
+    The [3, 256] table of the normalized value of each uint8 BGR pixel value,
+    with its rows in RGB order.
+    """
+    values = np.arange(256, dtype=np.float32) / 255.
+    return np.stack([(values - mean[c]) / std[c] for c in (2, 1, 0)]).astype(np.float32)
+
+
+def fused_transform(image, size, lut, boxes=None, rect=False, out=None, stride=32):
+    """
+    Single-pass version of base_transform (or letterbox_transform with
+    rect=True) that returns the [3, H, W] float32 RGB tensor fed to the model:
+    the uint8 image is resized first, with the geometry of base_transform
+    (square_resize) or of letterbox_transform, and the channel swap, the
+    normalization and the HWC -> CHW transpose are a lookup in the table of
+    normalize_lut, written into the padded tensor. No float copy is made.
+
+    out: a [3, H, W] float32 tensor to write into, e.g. the output of the
+    previous call or a row of a pinned batch tensor. A new tensor is
+    allocated if it is None or of another shape.
+    """
+    height, width, _ = image.shape
+    if rect:
+        pad_h, pad_w, new_h, new_w, top, left = letterbox_geometry(height, width, size, stride)
+        offset = np.array([[left / pad_w, top / pad_h, left / pad_w, top / pad_h]])
+        scale =  np.array([[new_w / pad_w, new_h / pad_h, new_w / pad_w, new_h / pad_h]])
+        if (new_h, new_w) != (height, width):
+            image = cv2.resize(image, (new_w, new_h))
+    else:
+        # zero padded to a square, resized to size with the padding
+        side = max(height, width)
+        top, left = (side - height) // 2, (side - width) // 2
+        offset = np.array([[left / side, top / side, left / side, top / side]])
+        scale =  np.array([[width / side, height / side, width / side, height / side]])
+        image = square_resize(image, size, top, left)
+        pad_h, pad_w = size[0], size[1]
+        new_h, new_w, top, left = pad_h, pad_w, 0, 0
+    if boxes is not None:
+        boxes = boxes * scale + offset
+
+    if out is None or tuple(out.shape) != (3, pad_h, pad_w):
+        out = torch.empty([3, pad_h, pad_w], dtype=torch.float32)
+    out_ = out.numpy()
+    if image.dtype != np.uint8:
+        # e.g. float images: no lookup, clip and round to the uint8 values
+        image = np.clip(image + 0.5, 0, 255).astype(np.uint8)
+    # zero padding, i.e. the normalized value of 0, only around the image
+    for c in range(3):
+        if top > 0 or left > 0 or new_h < pad_h or new_w < pad_w:
+            out_[c, :top] = lut[c, 0]
+            out_[c, top+new_h:] = lut[c, 0]
+            out_[c, top:top+new_h, :left] = lut[c, 0]
+            out_[c, top:top+new_h, left+new_w:] = lut[c, 0]
+        # to rgb, normalize and to CHW
+        np.take(lut[c], image[:, :, 2 - c], out=out_[c, top:top+new_h, left:left+new_w], mode='clip')
+
+    return out, boxes, scale, offset
+
+
+def letterbox_transform(image, size, mean, std, boxes=None, stride=32):
+    """
+    Resizes the image so that its longest side is max(size), keeping its aspect
+    ratio, and zero pads it to the smallest multiple of stride on both sides,
+    e.g. a 1920x1080 frame becomes 416x256 instead of 416x416.
+    """
+    height, width, _ = image.shape
+    pad_h, pad_w, new_h, new_w, top, left = letterbox_geometry(height, width, size, stride)
+    offset = np.array([[left / pad_w, top / pad_h, left / pad_w, top / pad_h]])
+    scale =  np.array([[new_w / pad_w, new_h / pad_h, new_w / pad_w, new_h / pad_h]])
+    if boxes is not None:
+        boxes = boxes * scale + offset
+
+    # resize, then zero padding
+    image_ = np.zeros([pad_h, pad_w, 3], dtype=np.float32)
+    image_[top:top+new_h, left:left+new_w] = cv2.resize(image, (new_w, new_h))
+    # normalize
+    image_ /= 255.
+    image_ -= mean
+    image_ /= std
+
+    return image_, boxes, scale, offset
+
+
+def map_to_image(bboxes, offset, scale, height, width):
+    """
+    Maps the boxes predicted on a transformed image, normalized to [0, 1], back
+    to the pixels of the original height x width image, for the square padding
+    of base_transform as well as for letterbox_transform.
+    """
+    return (bboxes - offset) / scale * np.array([[width, height, width, height]])
+
+
 class BaseTransform:
-    def __init__(self, size, mean=(0.406, 0.456, 0.485), std=(0.225, 0.224, 0.229)):
+    """
+    With rect=True, the images are letterboxed to the smallest stride-32
+    rectangle instead of being padded to a size x size square. Only for
+    inference, the batches of different images then have different shapes.
+    """
+    def __init__(self, size, mean=(0.406, 0.456, 0.485), std=(0.225, 0.224, 0.229), rect=False):
         self.size = size
         self.mean = np.array(mean, dtype=np.float32)
         self.std = np.array(std, dtype=np.float32)
+        self.rect = rect
+        self.lut = normalize_lut(self.mean, self.std)
+
+    def preprocess(self, image, boxes=None, size=None, out=None):
+        """
+        Returns the [3, H, W] RGB tensor of the image fed to the model, see
+        fused_transform, with the boxes, the scale and the offset of __call__.
+        """
+        return fused_transform(image, self.size if size is None else size, self.lut, boxes, self.rect, out)
+
+    def __call__(self, image, boxes=None, labels=None, size=None):
+        # size: the input size of this image, self.size by default
+        if self.rect:
+            image, boxes, scale, offset = letterbox_transform(image, self.size if size is None else size, self.mean, self.std, boxes)
 
-    def __call__(self, image, boxes=None, labels=None):
-        image, boxes, scale, offset = base_transform(image, self.size, self.mean, self.std, boxes)
+            return image, boxes, labels, scale, offset
+        image, boxes, scale, offset = base_transform(image, self.size if size is None else size, self.mean, self.std, boxes)
 
         return image, boxes, labels, scale, offset
@@ -1,10 +1,13 @@
 import os
+import shutil
+import hashlib
 import numpy as np
 import random
 
 import torch
 from torch.utils.data import Dataset
 import cv2
+from .shards import ShardReader
 try:
     from pycocotools.coco import COCO
 except:
@@ -33,17 +36,127 @@ coco_class_index = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 14, 15, 16, 17, 18, 1
                     70, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 84, 85, 86, 87, 88, 89, 90]
 
 coco_root = '/home/k545/object-detection/dataset/COCO/'
+
+
+class COCOAnnotationIndex(object):
+    """
+    Columnar index of the annotations of a COCO json file.
+    The annotations of the i-th image are boxes[offsets[i]:offsets[i+1]], and
+    so are their areas, category indexes (positions in cat_ids) and iscrowd
+    flags. The boxes are the raw COCO [x, y, w, h].
+
+    The columns are built once from the COCO API, saved as .npy files in
+    cache_dir and memory-mapped, so that the dataloader workers share them
+    without copies, and the json file is not even loaded again until it changes.
+    """
+    columns = ['img_ids', 'cat_ids', 'offsets', 'boxes', 'areas', 'cat_inds', 'iscrowd']
+    # changes the cache key when the columns change
+    version = 2
+
+    def __init__(self, json_path, cache_dir, coco=None):
+        stat = os.stat(json_path)
+        key = hashlib.md5(repr((os.path.abspath(json_path), stat.st_mtime_ns, stat.st_size, self.version)).encode()).hexdigest()
+        index_dir = os.path.join(cache_dir, os.path.splitext(os.path.basename(json_path))[0] + '_' + key)
+
+        self.index_dir = index_dir
+        if not os.path.isdir(index_dir):
+            if coco is None:
+                coco = COCO(json_path)
+            columns = self.build(coco)
+            tmp_dir = index_dir + '.%d.tmp' % os.getpid()
+            try:
+                os.makedirs(tmp_dir, exist_ok=True)
+                for name in self.columns:
+                    np.save(os.path.join(tmp_dir, name + '.npy'), columns[name])
+                os.rename(tmp_dir, index_dir)
+            except OSError:
+                # another process has saved it, or cache_dir is not writable
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not os.path.isdir(index_dir):
+                    print('Can not save the annotation index to %s' % cache_dir)
+                    self.index_dir = None
+                    for name in self.columns:
+                        setattr(self, name, columns[name])
+                    return
+
+        self.load()
+
+    @classmethod
+    def from_dir(cls, index_dir):
+        """Memory-maps the columns saved as .npy files in index_dir, e.g. by pack_shards."""
+        index = cls.__new__(cls)
+        index.index_dir = index_dir
+        index.load()
+        return index
+
+    def load(self):
+        for name in self.columns:
+            path = os.path.join(self.index_dir, name + '.npy')
+            if name == 'iscrowd' and not os.path.exists(path):
+                # shards packed before the column existed
+                print('No iscrowd column in %s, repack the shards to evaluate the crowd boxes' % self.index_dir)
+                self.iscrowd = np.zeros(len(self.boxes), dtype=np.uint8)
+                continue
+            setattr(self, name, np.load(path, mmap_mode='r'))
+
+    def __getstate__(self):
+        # only pickle the path of the memory-mapped columns, not their content
+        if self.index_dir is None:
+            return self.__dict__
+        return {'index_dir': self.index_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'boxes' not in state:
+            self.load()
+
+    @staticmethod
+    def build(coco):
+        img_ids = coco.getImgIds()
+        cat_ids = sorted(coco.getCatIds())
+        # category lookup table: category id -> index in cat_ids
+        cat_table = {cat_id: i for i, cat_id in enumerate(cat_ids)}
+
+        boxes, areas, cat_inds, iscrowd, counts = [], [], [], [], []
+        for id_ in img_ids:
+            annotations = [anno for anno in coco.imgToAnns[id_] if 'bbox' in anno]
+            boxes += [anno['bbox'] for anno in annotations]
+            areas += [anno['area'] for anno in annotations]
+            cat_inds += [cat_table[anno['category_id']] for anno in annotations]
+            iscrowd += [anno.get('iscrowd', 0) for anno in annotations]
+            counts.append(len(annotations))
+
+        return {'img_ids': np.array(img_ids, dtype=np.int64),
+                'cat_ids': np.array(cat_ids, dtype=np.int64),
+                'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                'boxes': np.array(boxes, dtype=np.float32).reshape(-1, 4),
+                'areas': np.array(areas, dtype=np.float32),
+                'cat_inds': np.array(cat_inds, dtype=np.int16),
+                'iscrowd': np.array(iscrowd, dtype=np.uint8)}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        return np.array(self.boxes[start:end], dtype=np.float64), self.areas[start:end], self.cat_inds[start:end]
+
+
 class COCODataset(Dataset):
     """
     COCO dataset class.
     """
+    shard_type = 'coco'
+
     def __init__(self, data_dir='COCO', json_file='instances_train2017.json',
                  name='train2017', img_size=416,
                  transform=None, 
                  base_transform=None,
-                 min_size=1, debug=False, mosaic=False):
+                 min_size=1, debug=False, mosaic=False, image_cache=None, shard_dir=None):
         """
-        COCO dataset initialization. Annotation data are read into memory by COCO API.
+        COCO dataset initialization. Annotation data are indexed once by COCOAnnotationIndex,
+        the COCO API itself is only loaded when the coco attribute is used.
         Args:
             data_dir (str): dataset root directory
             json_file (str): COCO json file name
@@ -51,15 +164,28 @@ class COCODataset(Dataset):
             img_size (int): target image size after pre-processing
             min_size (int): bounding boxes smaller than this are ignored
             debug (bool): if True, only one data id is selected from the dataset
+            image_cache (ImageCache): if given, decoded images are read through this cache
+            shard_dir (str): if given, images and annotations are read from the shards
+                             packed by data.shards.pack_shards
         """
         self.data_dir = data_dir
         self.json_file = json_file
-        self.coco = COCO(self.data_dir+'annotations/'+self.json_file)
-        self.ids = self.coco.getImgIds()
+        self._coco = None
+        self.shards = None
+        if shard_dir is not None:
+            self.shards = ShardReader(shard_dir)
+            self.anno_index = COCOAnnotationIndex.from_dir(self.shards.anno_dir)
+        else:
+            self.anno_index = COCOAnnotationIndex(self.data_dir+'annotations/'+self.json_file,
+                                                  os.path.join(self.data_dir, 'annotations_cache'))
+        self.ids = self.anno_index.img_ids.tolist()
+        # position of each image in the annotation index
+        self.rows = np.arange(len(self.ids))
         if debug:
             self.ids = self.ids[1:2]
+            self.rows = self.rows[1:2]
             print("debug mode...", self.ids)
-        self.class_ids = sorted(self.coco.getCatIds())
+        self.class_ids = self.anno_index.cat_ids.tolist()
         self.name = name
         self.max_labels = 50
         self.img_size = img_size
@@ -67,12 +193,31 @@ class COCODataset(Dataset):
         self.transform = transform
         self.base_transform = base_transform
         self.mosaic = mosaic
+        self.image_cache = image_cache
+
+    @property
+    def coco(self):
+        # the COCO API is only loaded when needed, e.g. by the evaluators,
+        # and it is not pickled into the dataloader workers
+        if self._coco is None:
+            self._coco = COCO(self.data_dir+'annotations/'+self.json_file)
+        return self._coco
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_coco'] = None
+        return state
 
     def __len__(self):
         return len(self.ids)
 
+    def shard_keys(self):
+        return list(self.ids)
+
     def pull_image(self, index):
         id_ = self.ids[index]
+        if self.shards is not None:
+            return self.shards.imread(self.rows[index])[0], id_
         img_file = os.path.join(self.data_dir, self.name,
                                 '{:012}'.format(id_) + '.jpg')
         img = cv2.imread(img_file)
@@ -95,122 +240,94 @@ class COCODataset(Dataset):
         return img, id_
 
     def pull_anno(self, index):
-        id_ = self.ids[index]
+        boxes, areas, cat_inds = self.anno_index[self.rows[index]]
 
-        anno_ids = self.coco.getAnnIds(imgIds=[int(id_)], iscrowd=None)
-        annotations = self.coco.loadAnns(anno_ids)
-        
-        target = []
-        for anno in annotations:
-            if 'bbox' in anno:
-                xmin = np.max((0, anno['bbox'][0]))
-                ymin = np.max((0, anno['bbox'][1]))
-                xmax = xmin + anno['bbox'][2]
-                ymax = ymin + anno['bbox'][3]
-                
-                if anno['area'] > 0 and xmax >= xmin and ymax >= ymin:
-                    label_ind = anno['category_id']
-                    cls_id = self.class_ids.index(label_ind)
-
-                    target.append([xmin, ymin, xmax, ymax, cls_id])  # [xmin, ymin, xmax, ymax, label_ind]
-            else:
-                print('No bbox !!')
-        return target
+        xmin = np.maximum(0, boxes[:, 0])
+        ymin = np.maximum(0, boxes[:, 1])
+        xmax = xmin + boxes[:, 2]
+        ymax = ymin + boxes[:, 3]
+        keep = (areas > 0) & (xmax >= xmin) & (ymax >= ymin)
+        target = np.stack([xmin, ymin, xmax, ymax, cat_inds], axis=1)[keep]
 
-    def __getitem__(self, index):
-        im, gt, h, w, offset, scale = self.pull_item(index)
+        return target.tolist()  # [xmin, ymin, xmax, ymax, label_ind]
 
-        return im, gt
+    def pull_target(self, index, width, height):
+        """
+        Returns the annotations of image at index -> [[x1, y1, x2, y2, label_ind], ...],
+        normalized by the width and height of the image.
+        """
+        boxes, areas, cat_inds = self.anno_index[self.rows[index]]
 
-    def pull_item(self, index):
-        id_ = self.ids[index]
+        x1 = np.maximum(0, boxes[:, 0])
+        y1 = np.maximum(0, boxes[:, 1])
+        x2 = np.minimum(width - 1, x1 + np.maximum(0, boxes[:, 2] - 1))
+        y2 = np.minimum(height - 1, y1 + np.maximum(0, boxes[:, 3] - 1))
+        keep = (areas > 0) & (x2 >= x1) & (y2 >= y1)
+        target = np.stack([x1 / width, y1 / height, x2 / width, y2 / height, cat_inds], axis=1)
 
-        anno_ids = self.coco.getAnnIds(imgIds=[int(id_)], iscrowd=None)
-        annotations = self.coco.loadAnns(anno_ids)
+        return target[keep]
 
-        # load image and preprocess
+    def imread(self, img_file):
+        """
+        Returns the image of img_file and its original (height, width),
+        read through the image cache if there is one.
+        """
+        if self.image_cache is not None:
+            return self.image_cache.imread(img_file)
+        img = cv2.imread(img_file)
+        return img, None if img is None else img.shape[:2]
+
+    def load_image(self, index):
+        """
+        Returns the image at index and its original (height, width),
+        read from the shards if there are.
+        """
+        if self.shards is not None:
+            return self.shards.imread(self.rows[index])
+        id_ = self.ids[index]
         img_file = os.path.join(self.data_dir, self.name,
                                 '{:012}'.format(id_) + '.jpg')
-        img = cv2.imread(img_file)
-        
+        img, shape = self.imread(img_file)
+
         if self.json_file == 'instances_val5k.json' and img is None:
             img_file = os.path.join(self.data_dir, 'train2017',
                                     '{:012}'.format(id_) + '.jpg')
-            img = cv2.imread(img_file)
+            img, shape = self.imread(img_file)
 
         assert img is not None
 
-        height, width, channels = img.shape
-        
-        # COCOAnnotation Transform
-        # start here :
-        target = []
-        for anno in annotations:
-            x1 = np.max((0, anno['bbox'][0]))
-            y1 = np.max((0, anno['bbox'][1]))
-            x2 = np.min((width - 1, x1 + np.max((0, anno['bbox'][2] - 1))))
-            y2 = np.min((height - 1, y1 + np.max((0, anno['bbox'][3] - 1))))
-            if anno['area'] > 0 and x2 >= x1 and y2 >= y1:
-                label_ind = anno['category_id']
-                cls_id = self.class_ids.index(label_ind)
-                x1 /= width
-                y1 /= height
-                x2 /= width
-                y2 /= height
-
-                target.append([x1, y1, x2, y2, cls_id])  # [xmin, ymin, xmax, ymax, label_ind]
-        # end here .
+        return img, shape
+
+    def __getitem__(self, index):
+        im, gt, h, w, offset, scale = self.pull_item(index)
+
+        return im, gt
+
+    def pull_item(self, index, input_size=None):
+        # input_size: [h, w] of the batch, given by MultiScaleDataset, the size of the transforms by default
+        img_size = self.img_size if input_size is None else input_size[0]
+        id_ = self.ids[index]
+
+        # load image and preprocess
+        img, (height, width) = self.load_image(index)
+        target = self.pull_target(index, width, height)
 
         # mosaic augmentation
         if self.mosaic and np.random.randint(2):
-            ids_list_ = self.ids[:index] + self.ids[index+1:]
-            # random sample 3 indexs
-            id2, id3, id4 = random.sample(ids_list_, 3)
-            ids = [id2, id3, id4]
+            # random sample 3 indexs, other than index
+            indexs = [i + (i >= index) for i in random.sample(range(len(self.ids) - 1), 3)]
             img_lists = [img]
             tg_lists = [target]
             # load other 3 images and targets
-            for id_ in ids:
-                anno_ids = self.coco.getAnnIds(imgIds=[int(id_)], iscrowd=None)
-                annotations = self.coco.loadAnns(anno_ids)
-
-                # load image and preprocess
-                img_file = os.path.join(self.data_dir, self.name,
-                                        '{:012}'.format(id_) + '.jpg')
-                img_i = cv2.imread(img_file)
-                
-                if self.json_file == 'instances_val5k.json' and img_i is None:
-                    img_file = os.path.join(self.data_dir, 'train2017',
-                                            '{:012}'.format(id_) + '.jpg')
-                    img_i = cv2.imread(img_file)
-
-                assert img_i is not None
-
-                height_i, width_i, channels_i = img_i.shape             
-                # COCOAnnotation Transform
-                # start here :
-                target_i = []
-                for anno in annotations:
-                    x1 = np.max((0, anno['bbox'][0]))
-                    y1 = np.max((0, anno['bbox'][1]))
-                    x2 = np.min((width_i - 1, x1 + np.max((0, anno['bbox'][2] - 1))))
-                    y2 = np.min((height_i - 1, y1 + np.max((0, anno['bbox'][3] - 1))))
-                    if anno['area'] > 0 and x2 >= x1 and y2 >= y1:
-                        label_ind = anno['category_id']
-                        cls_id = self.class_ids.index(label_ind)
-                        x1 /= width_i
-                        y1 /= height_i
-                        x2 /= width_i
-                        y2 /= height_i
-
-                        target_i.append([x1, y1, x2, y2, cls_id])  # [xmin, ymin, xmax, ymax, label_ind]
-                # end here .
+            for index_ in indexs:
+                img_i, (height_i, width_i) = self.load_image(index_)
+                target_i = self.pull_target(index_, width_i, height_i)
                 img_lists.append(img_i)
                 tg_lists.append(target_i)
 
-            mosaic_img = np.zeros([self.img_size*2, self.img_size*2, img.shape[2]], dtype=np.uint8)
+            mosaic_img = np.zeros([img_size*2, img_size*2, img.shape[2]], dtype=np.uint8)
             # mosaic center
-            yc, xc = [int(random.uniform(-x, 2*self.img_size + x)) for x in [-self.img_size // 2, -self.img_size // 2]]
+            yc, xc = [int(random.uniform(-x, 2*img_size + x)) for x in [-img_size // 2, -img_size // 2]]
 
             mosaic_tg = []
             for i in range(4):
@@ -218,7 +335,7 @@ class COCODataset(Dataset):
                 h0, w0, _ = img_i.shape
 
                 # resize image to img_size
-                r = self.img_size / max(h0, w0)
+                r = img_size / max(h0, w0)
                 if r != 1:  # always resize down, only resize up if training with augmentation
                     img_i = cv2.resize(img_i, (int(w0 * r), int(h0 * r)))
                 h, w, _ = img_i.shape
@@ -228,13 +345,13 @@ class COCODataset(Dataset):
                     x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
                     x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
                 elif i == 1:  # top right
-                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, self.img_size * 2), yc
+                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, img_size * 2), yc
                     x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
                 elif i == 2:  # bottom left
-                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(self.img_size * 2, yc + h)
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(img_size * 2, yc + h)
                     x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
                 elif i == 3:  # bottom right
-                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, self.img_size * 2), min(self.img_size * 2, yc + h)
+                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, img_size * 2), min(img_size * 2, yc + h)
                     x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
                 mosaic_img[y1a:y2a, x1a:x2a] = img_i[y1b:y2b, x1b:x2b]
@@ -258,20 +375,18 @@ class COCODataset(Dataset):
             else:
                 mosaic_tg = np.concatenate(mosaic_tg, axis=0)
                 # Cutout/Clip targets
-                np.clip(mosaic_tg[:, :4], 0, 2 * self.img_size, out=mosaic_tg[:, :4])
+                np.clip(mosaic_tg[:, :4], 0, 2 * img_size, out=mosaic_tg[:, :4])
                 # normalize
-                mosaic_tg[:, :4] /= (self.img_size * 2)
+                mosaic_tg[:, :4] /= (img_size * 2)
 
-            # augment
-            mosaic_img, boxes, labels, scale, offset = self.base_transform(mosaic_img, mosaic_tg[:, :4], mosaic_tg[:, 4])
-            # to rgb
-            mosaic_img = mosaic_img[:, :, (2, 1, 0)]
-            mosaic_tg = np.hstack((boxes, np.expand_dims(labels, axis=1)))
+            # resize, to rgb tensor
+            mosaic_img, boxes, scale, offset = self.base_transform.preprocess(mosaic_img, mosaic_tg[:, :4], size=input_size)
+            mosaic_tg = np.hstack((boxes, mosaic_tg[:, 4:]))
 
             scale =  np.array([[1., 1., 1., 1.]])
             offset = np.zeros([1, 4])
 
-            return torch.from_numpy(mosaic_img).permute(2, 0, 1).float(), mosaic_tg, self.img_size, self.img_size, offset, scale
+            return mosaic_img, mosaic_tg, img_size, img_size, offset, scale
 
         # basic augmentation(SSDAugmentation or BaseTransform)
         if self.transform is not None:
@@ -281,8 +396,15 @@ class COCODataset(Dataset):
             else:
                 target = np.array(target)
 
+            if hasattr(self.transform, 'preprocess'):
+                # BaseTransform: resize, to rgb tensor in one pass
+                img, boxes, scale, offset = self.transform.preprocess(img, target[:, :4], size=input_size)
+                target = np.hstack((boxes, target[:, 4:]))
+
+                return img, target, height, width, offset, scale
+
             # augment
-            img, boxes, labels, scale, offset = self.transform(img, target[:, :4], target[:, 4])
+            img, boxes, labels, scale, offset = self.transform(img, target[:, :4], target[:, 4], size=input_size)
 
             # to rgb
             img = img[:, :, (2, 1, 0)]
@@ -334,11 +456,17 @@ if __name__ == "__main__":
             self.size = size
             self.mean = np.array(mean, dtype=np.float32)
 
-        def __call__(self, image, boxes=None, labels=None):
-            image, boxes, scale, offset = base_transform(image, self.size, self.mean, boxes)
+        def __call__(self, image, boxes=None, labels=None, size=None):
+            image, boxes, scale, offset = base_transform(image, self.size if size is None else size, self.mean, boxes)
 
             return image, boxes, labels, scale, offset
 
+        def preprocess(self, image, boxes=None, size=None, out=None):
+            # the pixel values minus the mean, in RGB order
+            from data import fused_transform
+            lut = np.stack([np.arange(256, dtype=np.float32) - self.mean[c] for c in (2, 1, 0)])
+            return fused_transform(image, self.size if size is None else size, lut, boxes, out=out)
+
     img_size = 640
     dataset = COCODataset(
                 data_dir=coco_root,
@@ -0,0 +1,165 @@
+import os
+import atexit
+import shutil
+import hashlib
+import tempfile
+import multiprocessing as mp
+import numpy as np
+import cv2
+
+
+class ImageCache(object):
+    """
+    Cache of decoded uint8 images with LRU eviction and a byte budget.
+
+    The decoded images are stored as files in cache_dir, by default in
+    /dev/shm, so that the cache lives in shared memory and is shared by all
+    the dataloader workers. The total size, the hit/miss counters and the
+    eviction lock are shared multiprocessing values, so the cache must be
+    built in the main process before the dataloader starts its workers.
+    A hit refreshes the mtime of the file, and the files with the oldest
+    mtime are evicted first. An image is cached under its path, the mtime
+    and the size of its file, so that a modified image is read again.
+
+    Without cache_dir, the images are stored in a new directory of /dev/shm,
+    removed by close() or at the exit of the process which built the cache
+    (a killed run leaves it behind, as /dev/shm/yolo_image_cache_*). A given
+    cache_dir is kept, and reused by the next runs.
+
+    Args:
+        max_bytes (int): byte budget of the cache
+        max_size (int): if given, images are downscaled so that their longest
+                        side is at most max_size before being cached
+        cache_dir (str): where to store the decoded images
+    """
+    def __init__(self, max_bytes=4 * 1024**3, max_size=None, cache_dir=None):
+        self.temporary = cache_dir is None
+        if self.temporary:
+            root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            cache_dir = tempfile.mkdtemp(prefix='yolo_image_cache_', dir=root)
+            # not in the dataloader workers, which are forked after
+            self.owner = os.getpid()
+            atexit.register(self.close)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+
+        self.lock = mp.Lock()
+        self.hits = mp.Value('q', 0, lock=False)
+        self.misses = mp.Value('q', 0, lock=False)
+        self.evictions = mp.Value('q', 0, lock=False)
+        # the cache dir may be left by a previous run
+        self.total_bytes = mp.Value('q', sum(size for _, _, size in self.entries()), lock=False)
+
+    def imread(self, img_file):
+        """
+        Returns the decoded image of img_file and the (height, width) of the
+        original image, which is needed to normalize its annotations.
+        """
+        try:
+            stat = os.stat(img_file)
+        except OSError:
+            return None, None
+        key = hashlib.md5(('%s|%d|%d|%s' % (img_file, stat.st_mtime_ns, stat.st_size, self.max_size)).encode()).hexdigest()
+        cache_file = os.path.join(self.cache_dir, key + '.npy')
+        try:
+            with open(cache_file, 'rb') as f:
+                height, width = np.frombuffer(f.read(8), dtype=np.int32)
+                img = np.load(f)
+        except (OSError, ValueError, EOFError):
+            img = None
+        if img is not None:
+            try:
+                os.utime(cache_file)
+            except OSError:
+                # evicted by another worker since, the image was read anyway
+                pass
+            with self.lock:
+                self.hits.value += 1
+            return img, (int(height), int(width))
+
+        img = cv2.imread(img_file)
+        if img is None:
+            return None, None
+        height, width, _ = img.shape
+        if self.max_size is not None:
+            r = self.max_size / max(height, width)
+            if r < 1:
+                img = cv2.resize(img, (int(width * r), int(height * r)))
+        with self.lock:
+            self.misses.value += 1
+        self.put(cache_file, img, height, width)
+
+        return img, (height, width)
+
+    def put(self, cache_file, img, height, width):
+        nbytes = img.nbytes + 128
+        if nbytes > self.max_bytes:
+            return
+        # write outside the lock, then rename, so that other workers never read a partial file
+        tmp_file = cache_file + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(np.array([height, width], dtype=np.int32).tobytes())
+                np.save(f, img)
+        except OSError:
+            # e.g. the disk is full, the image is simply not cached
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return
+        nbytes = os.path.getsize(tmp_file)
+
+        with self.lock:
+            # another worker missed the same image and already cached it
+            if os.path.exists(cache_file):
+                os.remove(tmp_file)
+                return
+            if self.total_bytes.value + nbytes > self.max_bytes:
+                self.evict(self.total_bytes.value + nbytes - self.max_bytes)
+            os.replace(tmp_file, cache_file)
+            self.total_bytes.value += nbytes
+
+    def evict(self, nbytes):
+        # free a bit more than needed, so that we do not scan the cache dir at every miss
+        nbytes += self.max_bytes // 20
+        for cache_file, _, size in sorted(self.entries(), key=lambda entry: entry[1]):
+            if nbytes <= 0:
+                break
+            try:
+                os.remove(cache_file)
+            except OSError:
+                continue
+            nbytes -= size
+            self.total_bytes.value -= size
+            self.evictions.value += 1
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def stats(self):
+        hits, misses = self.hits.value, self.misses.value
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / max(hits + misses, 1),
+                'evictions': self.evictions.value,
+                'bytes': self.total_bytes.value}
+
+    def clear(self):
+        with self.lock:
+            for cache_file, _, _ in self.entries():
+                os.remove(cache_file)
+            self.total_bytes.value = 0
+
+    def close(self):
+        """Removes the directory of the cache if it was made for this run, a given cache_dir is kept."""
+        if self.temporary and os.getpid() == self.owner:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,172 @@
+import os
+import os.path as osp
+import json
+import mmap
+import numpy as np
+import cv2
+import torch
+
+
+def pack_shards(dataset, out_dir, max_size=None, encoding='jpeg', quality=95, shard_bytes=1024**3):
+    """
+    Packs the images and the annotation index of a VOCDetection or a COCODataset
+    into a few large shard files, read back by ShardReader.
+
+    out_dir/
+        meta.json           dataset type, image keys, encoding and shard files
+        index.npy           [shard, offset, nbytes, height, width, channels] of each stored image
+        sizes.npy           (height, width) of each original image
+        shard_00000.bin     the images, one after the other
+        annotations/*.npy   the arrays of the annotation index
+
+    Args:
+        dataset: VOCDetection or COCODataset, its images are stored in the order of dataset.ids
+        max_size (int): if given, images are downscaled so that their longest side is at most max_size
+        encoding (str): 'jpeg' to store JPEG bytes, 'raw' to store the decoded uint8 pixels
+        quality (int): JPEG quality
+        shard_bytes (int): a new shard file is started when a shard gets larger than shard_bytes
+    """
+    assert encoding in ['jpeg', 'raw']
+    # the rows of the annotation index must be the images of the dataset
+    assert dataset.anno_index is not None and len(dataset.anno_index) == len(dataset.ids)
+    os.makedirs(osp.join(out_dir, 'annotations'), exist_ok=True)
+    num_images = len(dataset.ids)
+    index = np.zeros([num_images, 6], dtype=np.int64)
+    sizes = np.zeros([num_images, 2], dtype=np.int32)
+    shard_files = []
+    f = None
+
+    for i in range(num_images):
+        if i % 5000 == 0:
+            print('Packing [%d / %d]' % (i, num_images))
+        img, (height, width) = dataset.load_image(i)
+        sizes[i] = height, width
+        if max_size is not None:
+            r = max_size / max(height, width)
+            if r < 1:
+                img = cv2.resize(img, (int(width * r), int(height * r)))
+        if encoding == 'jpeg':
+            data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        else:
+            data = np.ascontiguousarray(img).tobytes()
+
+        if f is None or f.tell() + len(data) > shard_bytes:
+            if f is not None:
+                f.close()
+            shard_files.append('shard_%05d.bin' % len(shard_files))
+            f = open(osp.join(out_dir, shard_files[-1]), 'wb')
+        index[i] = [len(shard_files) - 1, f.tell(), len(data)] + list(img.shape)
+        f.write(data)
+    if f is not None:
+        f.close()
+
+    np.save(osp.join(out_dir, 'index.npy'), index)
+    np.save(osp.join(out_dir, 'sizes.npy'), sizes)
+    for name in dataset.anno_index.columns:
+        np.save(osp.join(out_dir, 'annotations', name + '.npy'), np.asarray(getattr(dataset.anno_index, name)))
+    meta = {'type': dataset.shard_type,
+            'keys': dataset.shard_keys(),
+            'encoding': encoding,
+            'shards': shard_files}
+    with open(osp.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print('Packed %d images into %d shards.' % (num_images, len(shard_files)))
+
+
+class ShardReader(object):
+    """
+    Reads the images packed by pack_shards.
+
+    The shard files are memory-mapped lazily, once per process, so that a
+    ShardReader can be handed to the dataloader workers and each of them maps
+    the shards by itself. Only the path is pickled.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(osp.join(shard_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.keys = self.meta['keys']
+        self.index = np.load(osp.join(shard_dir, 'index.npy'), mmap_mode='r')
+        self.sizes = np.load(osp.join(shard_dir, 'sizes.npy'), mmap_mode='r')
+        self.anno_dir = osp.join(shard_dir, 'annotations')
+        self.maps = None
+        self.pid = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        return {'shard_dir': self.shard_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['shard_dir'])
+
+    def open(self):
+        self.maps = []
+        for shard_file in self.meta['shards']:
+            with open(osp.join(self.shard_dir, shard_file), 'rb') as f:
+                self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self.pid = os.getpid()
+
+    def imread(self, i):
+        """
+        Returns the i-th image and the (height, width) of the original image,
+        which is needed to normalize its annotations.
+        """
+        if self.pid != os.getpid():
+            self.open()
+        shard, offset, nbytes, height, width, channels = self.index[i]
+        data = np.frombuffer(self.maps[shard], dtype=np.uint8, count=nbytes, offset=offset)
+        if self.meta['encoding'] == 'jpeg':
+            img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        else:
+            img = data.reshape(height, width, channels).copy()
+
+        return img, (int(self.sizes[i, 0]), int(self.sizes[i, 1]))
+
+    def shard_of(self):
+        return np.asarray(self.index[:, 0])
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Shuffles a shard-backed dataset while keeping the reads local: the shards
+    are visited in a random order, and the images of a shard in a random order,
+    so that only one or two shards are hot in the page cache at a time.
+
+    For distributed training, every process draws the same order from seed and
+    the epoch set by set_epoch(), and takes every num_replicas-th image of it,
+    so that the processes read the same shards at the same time. The order is
+    padded to give the same number of images to every process.
+    """
+    def __init__(self, shards, shuffle=True, num_replicas=1, rank=0, seed=None):
+        self.shard_of = shards.shard_of()
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = int(torch.empty((), dtype=torch.int64).random_().item()) if seed is None else seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        shard_ids = np.unique(self.shard_of)
+        if self.shuffle:
+            shard_ids = shard_ids[torch.randperm(len(shard_ids), generator=g).numpy()]
+        order = []
+        for shard in shard_ids:
+            inds = np.nonzero(self.shard_of == shard)[0]
+            if self.shuffle:
+                inds = inds[torch.randperm(len(inds), generator=g).numpy()]
+            order.append(inds)
+        order = np.concatenate(order)
+        order = np.resize(order, len(self) * self.num_replicas)
+
+        for i in order[self.rank::self.num_replicas]:
+            yield int(i)
+
+    def __len__(self):
+        return (len(self.shard_of) + self.num_replicas - 1) // self.num_replicas
@@ -3,13 +3,16 @@ Original author: Francisco Massa
 https://github.com/fmassa/vision/blob/voc_dataset/torchvision/datasets/voc.py
 Updated by: Ellis Brown, Max deGroot
 """
+import os
 import os.path as osp
 import sys
+import hashlib
 import torch
 import torch.utils.data as data
 import cv2
 import numpy as np
 import random
+from .shards import ShardReader
 if sys.version_info[0] == 2:
     import xml.etree.cElementTree as ET
 else:
@@ -72,6 +75,102 @@ class VOCAnnotationTransform(object):
 
         return res  # [[xmin, ymin, xmax, ymax, label_ind], ... ]
 
+    def from_index(self, boxes, labels, difficult, width, height):
+        """Same as __call__, for the annotation arrays of VOCAnnotationIndex.
+        Returns:
+            ndarray -> [[xmin, ymin, xmax, ymax, label_ind], ... ]
+        """
+        if not self.keep_difficult:
+            boxes, labels = boxes[~difficult], labels[~difficult]
+        res = np.empty([len(boxes), 5])
+        res[:, 0:4:2] = boxes[:, 0:4:2].astype(np.float64) / width
+        res[:, 1:4:2] = boxes[:, 1:4:2].astype(np.float64) / height
+        res[:, 4] = labels
+
+        return res
+
+
+class VOCAnnotationIndex(object):
+    """All the annotations of a VOC dataset, parsed once into NumPy arrays.
+
+    The objects of the i-th image are boxes[offsets[i]:offsets[i+1]], and so
+    are their labels and difficult flags. The boxes are the 0-based pixel
+    coordinates [xmin, ymin, xmax, ymax], sizes are the (height, width) read
+    from the XML files.
+
+    The arrays are saved in cache_dir, under a key made of the annotation
+    paths, their latest mtime and the classes, so that the XML files are
+    parsed again only when they change.
+
+    Arguments:
+        annopaths (list): paths to the annotation XML files, one per image
+        class_to_ind (dict): dictionary lookup of classnames -> indexes
+        cache_dir (str, optional): where to save the arrays, not saved if None
+    """
+
+    columns = ['boxes', 'labels', 'difficult', 'sizes', 'offsets']
+
+    def __init__(self, annopaths, class_to_ind, cache_dir=None):
+        mtime = max([os.stat(path).st_mtime_ns for path in annopaths], default=0)
+        key = hashlib.md5(repr((annopaths, mtime, sorted(class_to_ind.items()))).encode()).hexdigest()
+        cache_file = None if cache_dir is None else osp.join(cache_dir, 'voc_index_%s.npz' % key)
+
+        if cache_file is not None and osp.exists(cache_file):
+            arrays = np.load(cache_file)
+        else:
+            arrays = self.parse(annopaths, class_to_ind)
+            if cache_file is not None:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    tmp_file = cache_file + '.%d.tmp.npz' % os.getpid()
+                    np.savez(tmp_file, **arrays)
+                    os.replace(tmp_file, cache_file)
+                except OSError:
+                    print('Can not save the annotation index to %s' % cache_dir)
+        for name in self.columns:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def from_dir(cls, index_dir):
+        """Memory-maps the arrays saved as .npy files in index_dir, e.g. by pack_shards."""
+        index = cls.__new__(cls)
+        for name in cls.columns:
+            setattr(index, name, np.load(osp.join(index_dir, name + '.npy'), mmap_mode='r'))
+        return index
+
+    @staticmethod
+    def parse(annopaths, class_to_ind):
+        boxes, labels, difficult, sizes, counts = [], [], [], [], []
+        for path in annopaths:
+            target = ET.parse(path).getroot()
+            size = target.find('size')
+            if size is not None:
+                sizes.append([int(size.find('height').text), int(size.find('width').text)])
+            else:
+                sizes.append([0, 0])
+            num_objects = 0
+            for obj in target.iter('object'):
+                difficult.append(int(obj.find('difficult').text) == 1)
+                labels.append(class_to_ind[obj.find('name').text.lower().strip()])
+                bbox = obj.find('bndbox')
+                boxes.append([int(bbox.find(pt).text) - 1 for pt in ['xmin', 'ymin', 'xmax', 'ymax']])
+                num_objects += 1
+            counts.append(num_objects)
+
+        return {'boxes': np.array(boxes, dtype=np.float32).reshape(-1, 4),
+                'labels': np.array(labels, dtype=np.int16),
+                'difficult': np.array(difficult, dtype=bool),
+                'sizes': np.array(sizes, dtype=np.int32).reshape(-1, 2),
+                'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        return self.boxes[start:end], self.labels[start:end], self.difficult[start:end]
+
 
 class VOCDetection(data.Dataset):
     """VOC Detection Dataset Object
@@ -86,14 +185,20 @@ class VOCDetection(data.Dataset):
             (eg: take in caption string, return tensor of word indices)
         dataset_name (string, optional): which dataset to load
             (default: 'VOC2007')
+        anno_cache (bool, optional): save the parsed annotations in
+            root/annotations_cache (default: True)
+        shard_dir (string, optional): read the images and annotations packed
+            by data.shards.pack_shards instead, image_sets is then ignored
     """
+    shard_type = 'voc'
 
     def __init__(self, root, img_size,
                  image_sets=[('2007', 'trainval'), ('2012', 'trainval')],
                  transform=None, 
                  base_transform=None,
                  target_transform=VOCAnnotationTransform(),
-                 dataset_name='VOC0712', mosaic=False):
+                 dataset_name='VOC0712', mosaic=False, image_cache=None,
+                 anno_cache=True, shard_dir=None):
         self.root = root
         self.img_size = img_size
         self.image_set = image_sets
@@ -105,10 +210,24 @@ class VOCDetection(data.Dataset):
         self._imgpath = osp.join('%s', 'JPEGImages', '%s.jpg')
         self.ids = list()
         self.mosaic = mosaic
-        for (year, name) in image_sets:
-            rootpath = osp.join(self.root, 'VOC' + year)
-            for line in open(osp.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
-                self.ids.append((rootpath, line.strip()))
+        self.image_cache = image_cache
+        self.shards = None
+        if shard_dir is not None:
+            # images and annotations packed by pack_shards
+            self.shards = ShardReader(shard_dir)
+            self.ids = [(osp.join(self.root, folder), name) for folder, name in self.shards.keys]
+            self.anno_index = VOCAnnotationIndex.from_dir(self.shards.anno_dir)
+        else:
+            for (year, name) in image_sets:
+                rootpath = osp.join(self.root, 'VOC' + year)
+                for line in open(osp.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
+                    self.ids.append((rootpath, line.strip()))
+            # parse all the annotations once
+            self.anno_index = None
+            if isinstance(self.target_transform, VOCAnnotationTransform):
+                self.anno_index = VOCAnnotationIndex([self._annopath % img_id for img_id in self.ids],
+                                                     self.target_transform.class_to_ind,
+                                                     osp.join(self.root, 'annotations_cache') if anno_cache else None)
 
     def __getitem__(self, index):
         im, gt, h, w, offset, scale = self.pull_item(index)
@@ -118,37 +237,30 @@ class VOCDetection(data.Dataset):
     def __len__(self):
         return len(self.ids)
 
-    def pull_item(self, index):
+    def pull_item(self, index, input_size=None):
+        # input_size: [h, w] of the batch, given by MultiScaleDataset, the size of the transforms by default
+        img_size = self.img_size if input_size is None else input_size[0]
         img_id = self.ids[index]
 
-        target = ET.parse(self._annopath % img_id).getroot()
-        img = cv2.imread(self._imgpath % img_id)
-        height, width, channels = img.shape
-
-        if self.target_transform is not None:
-            target = self.target_transform(target, width, height)
+        img, (height, width) = self.load_image(index)
+        target = self.pull_target(index, width, height)
 
         # mosaic augmentation
         if self.mosaic and np.random.randint(2):
-            ids_list_ = self.ids[:index] + self.ids[index+1:]
-            # random sample 3 indexs
-            id2, id3, id4 = random.sample(ids_list_, 3)
-            ids = [id2, id3, id4]
+            # random sample 3 indexs, other than index
+            indexs = [i + (i >= index) for i in random.sample(range(len(self.ids) - 1), 3)]
             img_lists = [img]
             tg_lists = [target]
-            for id_ in ids:
-                img_ = cv2.imread(self._imgpath % id_)
-                height_, width_, channels_ = img_.shape
-
-                target_ = ET.parse(self._annopath % id_).getroot()              
-                target_ = self.target_transform(target_, width_, height_)
+            for index_ in indexs:
+                img_, (height_, width_) = self.load_image(index_)
+                target_ = self.pull_target(index_, width_, height_)
 
                 img_lists.append(img_)
                 tg_lists.append(target_)
             
-            mosaic_img = np.zeros([self.img_size*2, self.img_size*2, img.shape[2]], dtype=np.uint8)
+            mosaic_img = np.zeros([img_size*2, img_size*2, img.shape[2]], dtype=np.uint8)
             # mosaic center
-            yc, xc = [int(random.uniform(-x, 2*self.img_size + x)) for x in [-self.img_size // 2, -self.img_size // 2]]
+            yc, xc = [int(random.uniform(-x, 2*img_size + x)) for x in [-img_size // 2, -img_size // 2]]
 
             mosaic_tg = []
             for i in range(4):
@@ -156,7 +268,7 @@ class VOCDetection(data.Dataset):
                 h0, w0, _ = img_i.shape
 
                 # resize image to img_size
-                r = self.img_size / max(h0, w0)
+                r = img_size / max(h0, w0)
                 if r != 1:  # always resize down, only resize up if training with augmentation
                     img_i = cv2.resize(img_i, (int(w0 * r), int(h0 * r)))
                 h, w, _ = img_i.shape
@@ -166,13 +278,13 @@ class VOCDetection(data.Dataset):
                     x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
                     x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
                 elif i == 1:  # top right
-                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, self.img_size * 2), yc
+                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, img_size * 2), yc
                     x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
                 elif i == 2:  # bottom left
-                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(self.img_size * 2, yc + h)
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(img_size * 2, yc + h)
                     x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
                 elif i == 3:  # bottom right
-                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, self.img_size * 2), min(self.img_size * 2, yc + h)
+                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, img_size * 2), min(img_size * 2, yc + h)
                     x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
                 mosaic_img[y1a:y2a, x1a:x2a] = img_i[y1b:y2b, x1b:x2b]
@@ -196,17 +308,15 @@ class VOCDetection(data.Dataset):
             else:
                 mosaic_tg = np.concatenate(mosaic_tg, axis=0)
                 # Cutout/Clip targets
-                np.clip(mosaic_tg[:, :4], 0, 2 * self.img_size, out=mosaic_tg[:, :4])
+                np.clip(mosaic_tg[:, :4], 0, 2 * img_size, out=mosaic_tg[:, :4])
                 # normalize
-                mosaic_tg[:, :4] /= (self.img_size * 2)
+                mosaic_tg[:, :4] /= (img_size * 2)
 
-            # augment
-            mosaic_img, boxes, labels, scale, offset = self.base_transform(mosaic_img, mosaic_tg[:, :4], mosaic_tg[:, 4])
-            # to rgb
-            mosaic_img = mosaic_img[:, :, (2, 1, 0)]
-            mosaic_tg = np.hstack((boxes, np.expand_dims(labels, axis=1)))
+            # resize, to rgb tensor
+            mosaic_img, boxes, scale, offset = self.base_transform.preprocess(mosaic_img, mosaic_tg[:, :4], size=input_size)
+            mosaic_tg = np.hstack((boxes, mosaic_tg[:, 4:]))
 
-            return torch.from_numpy(mosaic_img).permute(2, 0, 1).float(), mosaic_tg, self.img_size, self.img_size, offset, scale
+            return mosaic_img, mosaic_tg, img_size, img_size, offset, scale
 
         # basic augmentation(SSDAugmentation or BaseTransform)
         if self.transform is not None:
@@ -216,8 +326,15 @@ class VOCDetection(data.Dataset):
             else:
                 target = np.array(target)
             
+            if hasattr(self.transform, 'preprocess'):
+                # BaseTransform: resize, to rgb tensor in one pass
+                img, boxes, scale, offset = self.transform.preprocess(img, target[:, :4], size=input_size)
+                target = np.hstack((boxes, target[:, 4:]))
+
+                return img, target, height, width, offset, scale
+
             # augment
-            img, boxes, labels, scale, offset = self.transform(img, target[:, :4], target[:, 4])
+            img, boxes, labels, scale, offset = self.transform(img, target[:, :4], target[:, 4], size=input_size)
             
             # to rgb
             img = img[:, :, (2, 1, 0)]
@@ -225,6 +342,32 @@ class VOCDetection(data.Dataset):
         
         return torch.from_numpy(img).permute(2, 0, 1).float(), target, height, width, offset, scale
 
+    def pull_target(self, index, width, height):
+        '''Returns the transformed annotation of image at index, from the
+        annotation index if there is one.
+        '''
+        if self.anno_index is not None:
+            return self.target_transform.from_index(*self.anno_index[index], width, height)
+        target = ET.parse(self._annopath % self.ids[index]).getroot()
+        if self.target_transform is not None:
+            target = self.target_transform(target, width, height)
+        return target
+
+    def load_image(self, index):
+        '''Returns the image at index and its original (height, width),
+        read from the shards or through the image cache if there is one.
+        '''
+        if self.shards is not None:
+            return self.shards.imread(index)
+        img_id = self.ids[index]
+        if self.image_cache is not None:
+            return self.image_cache.imread(self._imgpath % img_id)
+        img = cv2.imread(self._imgpath % img_id)
+        return img, img.shape[:2]
+
+    def shard_keys(self):
+        return [[osp.basename(rootpath), name] for rootpath, name in self.ids]
+
     def pull_image(self, index):
         '''Returns the original image object at index in PIL form
         Note: not using self.__getitem__(), as any transformations passed in
@@ -235,6 +378,8 @@ class VOCDetection(data.Dataset):
             PIL img
         '''
         img_id = self.ids[index]
+        if self.shards is not None:
+            return self.shards.imread(index)[0], img_id
         return cv2.imread(self._imgpath % img_id, cv2.IMREAD_COLOR), img_id
 
     def pull_anno(self, index):
@@ -248,8 +393,9 @@ class VOCDetection(data.Dataset):
                 eg: ('001718', [('dog', (96, 13, 438, 332))])
         '''
         img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
-        gt = self.target_transform(anno, 1, 1)
+        gt = self.pull_target(index, 1, 1)
+        if isinstance(gt, np.ndarray):
+            gt = gt.tolist()
         return img_id[1], gt
 
     def pull_tensor(self, index):
@@ -307,11 +453,17 @@ if __name__ == "__main__":
             self.size = size
             self.mean = np.array(mean, dtype=np.float32)
 
-        def __call__(self, image, boxes=None, labels=None):
-            image, boxes, scale, offset = base_transform(image, self.size, self.mean, boxes)
+        def __call__(self, image, boxes=None, labels=None, size=None):
+            image, boxes, scale, offset = base_transform(image, self.size if size is None else size, self.mean, boxes)
 
             return image, boxes, labels, scale, offset
 
+        def preprocess(self, image, boxes=None, size=None, out=None):
+            # the pixel values minus the mean, in RGB order
+            from data import fused_transform
+            lut = np.stack([np.arange(256, dtype=np.float32) - self.mean[c] for c in (2, 1, 0)])
+            return fused_transform(image, self.size if size is None else size, lut, boxes, out=out)
+
     img_size = 640
     # dataset
     dataset = VOCDetection(VOC_ROOT, img_size, [('2007', 'trainval')],
@@ -40,6 +40,8 @@ def parse_args():
                         help='NMS threshold')
     parser.add_argument('--diou_nms', action='store_true', default=False, 
                         help='use diou_nms.')
+    parser.add_argument('--rect', action='store_true', default=False,
+                        help='letterbox the images to the smallest stride-32 rectangle instead of a square.')
     parser.add_argument('-vs','--vis_thresh', default=0.4,
                         type=float, help='visual threshold')
     
@@ -71,6 +73,7 @@ def detect(args, net, device, transform, mode='image', path_to_img=None, path_to
     if mode == 'camera':
         print('use camera !!!')
         cap = cv2.VideoCapture(args.cam_ind, cv2.CAP_DSHOW)
+        frame_ = None
 
         while True:
             ret, frame = cap.read()
@@ -81,22 +84,16 @@ def detect(args, net, device, transform, mode='image', path_to_img=None, path_to
             if ret:
                 # preprocess
                 h, w, _ = frame.shape
-                frame_, _, _, _, offset = transform(frame)
-
-                # to rgb
-                x = torch.from_numpy(frame_[:, :, (2, 1, 0)]).permute(2, 0, 1)
-                x = x.unsqueeze(0).to(device)
+                # to rgb tensor, reusing the tensor of the previous frame
+                frame_, _, scale, offset = transform.preprocess(frame, out=frame_)
+                x = frame_.unsqueeze(0).to(device)
 
                 t0 = time.time()
-                bboxes, scores, cls_inds = net(x)
+                bboxes, scores, cls_inds = [out[0] for out in net(x)]
                 t1 = time.time()
                 print("detection time used ", t1-t0, "s")
-                # scale each detection back up to the image
-                max_line = max(h, w)
-                # map the boxes to input image with zero padding
-                bboxes *= max_line
-                # map to the image without zero padding
-                bboxes -= (offset * max_line)
+                # map each detection back to the image, undoing the padding and the resize
+                bboxes = map_to_image(bboxes, offset, scale, h, w)
 
                 frame_processed = vis(frame, bboxes, scores, cls_inds, thresh, class_color=class_color)
                 cv2.imshow('detection result', frame_processed)
@@ -117,22 +114,16 @@ def detect(args, net, device, transform, mode='image', path_to_img=None, path_to
 
             # preprocess
             h, w, _ = img.shape
-            img_, _, _, _, offset = transform(img)
-
-            # to rgb
-            x = torch.from_numpy(img_[:, :, (2, 1, 0)]).permute(2, 0, 1)
-            x = x.unsqueeze(0).to(device)
+            # to rgb tensor
+            img_, _, scale, offset = transform.preprocess(img)
+            x = img_.unsqueeze(0).to(device)
 
             t0 = time.time()
-            bboxes, scores, cls_inds = net(x)
+            bboxes, scores, cls_inds = [out[0] for out in net(x)]
             t1 = time.time()
             print("detection time used ", t1-t0, "s")
-            # scale each detection back up to the image
-            max_line = max(h, w)
-            # map the boxes to input image with zero padding
-            bboxes *= max_line
-            # map to the image without zero padding
-            bboxes -= (offset * max_line)
+            # map each detection back to the image, undoing the padding and the resize
+            bboxes = map_to_image(bboxes, offset, scale, h, w)
 
             img_processed = vis(img, bboxes, scores, cls_inds, thresh=thresh, class_color=class_color)
             cv2.imwrite(os.path.join(save_path, str(index).zfill(6) +'.jpg'), img_processed)
@@ -145,6 +136,7 @@ def detect(args, net, device, transform, mode='image', path_to_img=None, path_to
         video = cv2.VideoCapture(path_to_vid)
         fourcc = cv2.VideoWriter_fourcc(*'XVID')
         out = cv2.VideoWriter(os.path.join(save_path, 'output.avi'), fourcc, 30.0, (640, 360))        
+        frame_ = None
         
         while(True):
             ret, frame = video.read()
@@ -154,22 +146,16 @@ def detect(args, net, device, transform, mode='image', path_to_img=None, path_to
 
                 # preprocess
                 h, w, _ = frame.shape
-                frame_, _, _, _, offset = transform(frame)
-
-                # to rgb
-                x = torch.from_numpy(frame_[:, :, (2, 1, 0)]).permute(2, 0, 1)
-                x = x.unsqueeze(0).to(device)
+                # to rgb tensor, reusing the tensor of the previous frame
+                frame_, _, scale, offset = transform.preprocess(frame, out=frame_)
+                x = frame_.unsqueeze(0).to(device)
 
                 t0 = time.time()
-                bboxes, scores, cls_inds = net(x)
+                bboxes, scores, cls_inds = [out[0] for out in net(x)]
                 t1 = time.time()
                 print("detection time used ", t1-t0, "s")
-                # scale each detection back up to the image
-                max_line = max(h, w)
-                # map the boxes to input image with zero padding
-                bboxes *= max_line
-                # map to the image without zero padding
-                bboxes -= (offset * max_line)
+                # map each detection back to the image, undoing the padding and the resize
+                bboxes = map_to_image(bboxes, offset, scale, h, w)
                 
                 frame_processed = vis(frame, bboxes, scores, cls_inds, thresh, class_color=class_color)
                 
@@ -198,15 +184,11 @@ def detect(args, net, device, transform, mode='image', path_to_img=None, path_to
             x = img_tensor.unsqueeze(0).to(device)
 
             t0 = time.time()
-            bboxes, scores, cls_inds = net(x)
+            bboxes, scores, cls_inds = [out[0] for out in net(x)]
             t1 = time.time()
             print("detection time used ", t1-t0, "s")
-            # scale each detection back up to the image
-            max_line = max(h, w)
-            # map the boxes to input image with zero padding
-            bboxes *= max_line
-            # map to the image without zero padding
-            bboxes -= (offset * max_line)
+            # map each detection back to the image, undoing the padding and the resize
+            bboxes = map_to_image(bboxes, offset, scale, h, w)
 
             img_processed = vis(img, bboxes, scores, cls_inds, thresh, class_color=class_color)
             cv2.imshow('detection result', img_processed)
@@ -297,17 +279,19 @@ def run():
     # load a trained model
     net.load_state_dict(torch.load(args.trained_model, map_location=device))
     net.to(device).eval()
+    # fold the BatchNorm layers into the convs
+    net.fuse()
     print('Finished loading model!')
 
     # run
     if args.mode == 'camera':
-        detect(args=args, net=net, device=device, transform=BaseTransform(input_size), 
+        detect(args=args, net=net, device=device, transform=BaseTransform(input_size, rect=args.rect), 
                mode=args.mode, thresh=args.vis_thresh, class_color=class_color)
     elif args.mode == 'image':
-        detect(args=args, net=net, device=device, transform=BaseTransform(input_size), 
+        detect(args=args, net=net, device=device, transform=BaseTransform(input_size, rect=args.rect), 
                mode=args.mode, thresh=args.vis_thresh, path_to_img=args.path_to_img, path_to_save=args.path_to_save, class_color=class_color)
     elif args.mode == 'video':
-        detect(args=args, net=net, device=device, transform=BaseTransform(input_size),
+        detect(args=args, net=net, device=device, transform=BaseTransform(input_size, rect=args.rect),
                mode=args.mode, thresh=args.vis_thresh, path_to_vid=args.path_to_vid, path_to_save=args.path_to_save, class_color=class_color)
     elif args.mode == 'dataset':
         # build test dataset
@@ -317,13 +301,13 @@ def run():
                         json_file='instances_val2017.json',
                         name='val2017',
                         img_size=input_size[0],
-                        transform=BaseTransform(input_size),
+                        transform=BaseTransform(input_size, rect=args.rect),
                         debug=False)
 
         detect(args=args,
                net=net, 
                device=device,
-               transform=BaseTransform(input_size),
+               transform=BaseTransform(input_size, rect=args.rect),
                mode=args.mode, 
                thresh=args.vis_thresh, 
                path_to_img=args.path_to_img, 
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from data import *
 import argparse
+import time
 from utils.vocapi_evaluator import VOCAPIEvaluator
 from utils.cocoapi_evaluator import COCOAPIEvaluator
 
@@ -23,8 +24,22 @@ parser.add_argument('-nt', '--nms_thresh', default=0.50, type=float,
                     help='nms thresh')
 parser.add_argument('--cuda', action='store_true', default=False,
                     help='Use cuda')
+parser.add_argument('--shard_dir', default=None, type=str,
+                    help='read the images from the shards packed by make_shards.py.')
 parser.add_argument('--diou_nms', action='store_true', default=False, 
                     help='use diou nms.')
+parser.add_argument('-bs', '--batch_size', default=32, type=int,
+                    help='batch size of the COCO evaluation.')
+parser.add_argument('--num_workers', default=4, type=int,
+                    help='number of workers loading the COCO images.')
+parser.add_argument('--rect', action='store_true', default=False,
+                    help='letterbox the images to the smallest stride-32 rectangle instead of a square.')
+parser.add_argument('--native_eval', action='store_true', default=False,
+                    help='compute the COCO AP with utils.coco_map instead of pycocotools.')
+parser.add_argument('--voc_files', action='store_true', default=False,
+                    help='evaluate VOC through the devkit text files instead of in memory.')
+parser.add_argument('--streaming', action='store_true', default=False,
+                    help='match the detections as they arrive and print a running mAP, without keeping them.')
 
 args = parser.parse_args()
 
@@ -34,9 +49,12 @@ def voc_test(model, device, input_size):
     evaluator = VOCAPIEvaluator(data_root=VOC_ROOT,
                                 img_size=input_size,
                                 device=device,
-                                transform=BaseTransform(input_size),
+                                transform=BaseTransform(input_size, rect=args.rect),
                                 labelmap=VOC_CLASSES,
-                                display=True
+                                display=True,
+                                shard_dir=args.shard_dir,
+                                in_memory=not args.voc_files,
+                                streaming=args.streaming
                                 )
 
     # VOC evaluation
@@ -52,7 +70,12 @@ def coco_test(model, device, input_size, test=False):
                         img_size=input_size,
                         device=device,
                         testset=True,
-                        transform=BaseTransform(input_size)
+                        transform=BaseTransform(input_size, rect=args.rect),
+                        shard_dir=args.shard_dir,
+                        batch_size=args.batch_size,
+                        num_workers=args.num_workers,
+                        native=args.native_eval,
+                        streaming=args.streaming
                         )
 
     else:
@@ -62,7 +85,12 @@ def coco_test(model, device, input_size, test=False):
                         img_size=input_size,
                         device=device,
                         testset=False,
-                        transform=BaseTransform(input_size)
+                        transform=BaseTransform(input_size, rect=args.rect),
+                        shard_dir=args.shard_dir,
+                        batch_size=args.batch_size,
+                        num_workers=args.num_workers,
+                        native=args.native_eval,
+                        streaming=args.streaming
                         )
 
     # COCO evaluation
@@ -157,9 +185,12 @@ if __name__ == '__main__':
     # load net
     yolo_net.load_state_dict(torch.load(args.trained_model, map_location='cuda'))
     yolo_net.to(device).eval()
+    # fold the BatchNorm layers into the convs
+    yolo_net.fuse()
     print('Finished loading model!')
     
     # evaluation
+    t0 = time.time()
     with torch.no_grad():
         if args.dataset == 'voc':
             voc_test(yolo_net, device, input_size)
@@ -167,3 +198,4 @@ if __name__ == '__main__':
             coco_test(yolo_net, device, input_size, test=False)
         elif args.dataset == 'coco-test':
             coco_test(yolo_net, device, input_size, test=True)
+    print('Evaluation time (%s inputs): %.1f s' % ('rectangular' if args.rect else 'square', time.time() - t0))
@@ -0,0 +1,192 @@
+"""
+Exports a YOLO model to TorchScript and ONNX for deployment.
+
+The exported graph holds the backbone, the head and the box decoding, with
+the grid and anchor tensors of the given input size baked in, and a dynamic
+batch dimension:
+
+    images: [B, 3, H, W]             the BaseTransform-ed images
+    bboxes: [B, H*W*anchor_n, 4]     [xmin, ymin, xmax, ymax], normalized to [0, 1]
+    scores: [B, H*W*anchor_n, C]     class probabilities times objectness
+
+NMS is not part of the graph. Run postprocess() below on the outputs of each
+image: it applies the confidence threshold, the optional top-k pre-selection
+and the class-wise NMS exactly like the test path of the eager model.
+"""
+import os
+import argparse
+import numpy as np
+import torch
+from data import *
+from utils.nms import BatchedNMS
+
+
+BACKBONES = {'yolo_v3_plus': 'd-53', 'yolo_v3_plus_x': 'csp-x', 'yolo_v3_plus_large': 'csp-l',
+             'yolo_v3_plus_medium': 'csp-m', 'yolo_v3_plus_small': 'csp-s',
+             'yolo_v3_slim': 'd-tiny', 'yolo_v3_slim_csp': 'csp-slim'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='YOLO Export')
+    parser.add_argument('-v', '--version', default='yolo_v3_plus',
+                        help='yolo_v3_plus, yolo_v3_plus_x, yolo_v3_plus_large, yolo_v3_plus_medium, yolo_v3_plus_small, \
+                            yolo_v3_slim, yolo_v3_slim_csp.')
+    parser.add_argument('-d', '--dataset', default='voc',
+                        help='voc, coco.')
+    parser.add_argument('-size', '--input_size', default=416, type=int,
+                        help='input_size')
+    parser.add_argument('--trained_model', default=None, type=str,
+                        help='Trained state_dict file path to open')
+    parser.add_argument('-f', '--format', default='all', type=str,
+                        help='torchscript, onnx, all.')
+    parser.add_argument('-o', '--out_dir', default='weights/export/', type=str,
+                        help='where to write the exported models.')
+    parser.add_argument('--opset', default=11, type=int,
+                        help='ONNX opset version.')
+
+    return parser.parse_args()
+
+
+def build_deploy_model(version, device, input_size, num_classes, anchor_size):
+    """ The eval-mode, BN-fused model, whose forward returns the decoded (bboxes, scores). """
+    if version not in BACKBONES:
+        print('Unknown version !!!')
+        exit(0)
+    if version.startswith('yolo_v3_plus'):
+        from models.yolo_v3_plus import YOLOv3Plus as YOLO
+    else:
+        from models.yolo_v3_slim import YOLOv3Slim as YOLO
+
+    return YOLO(device, input_size=input_size, num_classes=num_classes, anchor_size=anchor_size,
+                backbone=BACKBONES[version], deploy=True)
+
+
+def export_torchscript(model, input_size, path):
+    x = torch.zeros(1, 3, input_size[0], input_size[1], device=model.device)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, x)
+    traced.save(path)
+    print('Saved TorchScript model to', path)
+
+    return traced
+
+
+def export_onnx(model, input_size, path, opset=11):
+    x = torch.zeros(1, 3, input_size[0], input_size[1], device=model.device)
+    with torch.no_grad():
+        torch.onnx.export(model, (x,), path,
+                          dynamo=False,
+                          opset_version=opset,
+                          input_names=['images'],
+                          output_names=['bboxes', 'scores'],
+                          dynamic_axes={'images': {0: 'batch'},
+                                        'bboxes': {0: 'batch'},
+                                        'scores': {0: 'batch'}})
+    print('Saved ONNX model to', path)
+
+
+def postprocess(bboxes, scores, conf_thresh=0.001, nms_thresh=0.5, topk=None, diou_nms=False):
+    """
+    The NMS post-step of the exported models, for one image.
+
+    Input:
+        bboxes: [H*W*anchor_n, 4], an output of the exported model, numpy or tensor
+        scores: [H*W*anchor_n, C], an output of the exported model, numpy or tensor
+    Output:
+        bboxes, scores, cls_inds: numpy arrays, the same as the eager model
+    """
+    bboxes = torch.as_tensor(bboxes)
+    scores, cls_inds = torch.max(torch.as_tensor(scores), dim=1)
+
+    # threshold
+    keep = torch.nonzero(scores >= conf_thresh).squeeze(1)
+    # top-k candidates with the highest scores
+    if topk is not None and keep.numel() > topk:
+        keep = keep[torch.topk(scores[keep], topk)[1]]
+    bboxes, scores, cls_inds = bboxes[keep], scores[keep], cls_inds[keep]
+
+    # NMS
+    keep = BatchedNMS(diou=diou_nms)(bboxes, scores, cls_inds, nms_thresh)
+
+    return bboxes[keep].cpu().numpy(), scores[keep].cpu().numpy(), cls_inds[keep].cpu().numpy()
+
+
+def check_parity(model, run, input_size, batch_size=2):
+    """ Max abs diff between the outputs of the eager model and of an exported one, with a batch of batch_size. """
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, 3, input_size[0], input_size[1], device=model.device)
+    with torch.no_grad():
+        bboxes, scores = model(x)
+    bboxes_, scores_ = run(x)
+    bbox_diff = np.abs(bboxes.cpu().numpy() - np.asarray(bboxes_)).max()
+    score_diff = np.abs(scores.cpu().numpy() - np.asarray(scores_)).max()
+
+    return bbox_diff, score_diff
+
+
+def torchscript_session(path):
+    traced = torch.jit.load(path, map_location='cpu')
+
+    def run(x):
+        with torch.no_grad():
+            return [out.cpu().numpy() for out in traced(x)]
+
+    return run
+
+
+def ort_session(path):
+    import onnxruntime as ort
+    session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(x):
+        return session.run(None, {'images': x.cpu().numpy()})
+
+    return run
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device('cpu')
+    input_size = [args.input_size, args.input_size]
+
+    if args.dataset == 'voc':
+        num_classes = 20
+        anchor_size = MULTI_ANCHOR_SIZE
+    elif args.dataset == 'coco':
+        num_classes = 80
+        anchor_size = MULTI_ANCHOR_SIZE_COCO
+    else:
+        print('unknow dataset !! Only support voc and coco !!')
+        exit(0)
+
+    model = build_deploy_model(args.version, device, input_size, num_classes, anchor_size)
+    if args.trained_model is not None:
+        model.load_state_dict(torch.load(args.trained_model, map_location=device))
+    else:
+        print('No trained model given, exporting the initial weights.')
+    model.to(device).eval()
+    # fold the BatchNorm layers into the convs
+    model.fuse()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    name = os.path.join(args.out_dir, '%s_%s_%d' % (args.version, args.dataset, args.input_size))
+
+    if args.format in ['torchscript', 'all']:
+        export_torchscript(model, input_size, name + '.torchscript.pt')
+        run = torchscript_session(name + '.torchscript.pt')
+        print('TorchScript parity [max diff: bbox %.2e, score %.2e]' % check_parity(model, run, input_size))
+
+    if args.format in ['onnx', 'all']:
+        try:
+            import onnx
+        except ImportError:
+            print('onnx is not installed, skip the ONNX export.')
+            exit(0)
+        export_onnx(model, input_size, name + '.onnx', opset=args.opset)
+        onnx.checker.check_model(onnx.load(name + '.onnx'))
+        try:
+            run = ort_session(name + '.onnx')
+        except ImportError:
+            print('onnxruntime is not installed, skip the ONNX parity check.')
+        else:
+            print('ONNX Runtime parity [max diff: bbox %.2e, score %.2e]' % check_parity(model, run, input_size))
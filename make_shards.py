@@ -0,0 +1,49 @@
+from data import VOC_ROOT, VOCDetection, coco_root, COCODataset, pack_shards
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack a dataset into memory-mapped shards')
+
+    parser.add_argument('-d', '--dataset', default='voc',
+                        help='voc, coco.')
+    parser.add_argument('--root', default=None, type=str,
+                        help='dataset root, VOC_ROOT or coco_root by default.')
+    parser.add_argument('--image_sets', default='2007-trainval,2012-trainval', type=str,
+                        help='VOC image sets, as year-name separated by commas.')
+    parser.add_argument('--json_file', default='instances_train2017.json', type=str,
+                        help='COCO json file.')
+    parser.add_argument('--name', default='train2017', type=str,
+                        help='COCO image folder.')
+    parser.add_argument('-o', '--out_dir', required=True, type=str,
+                        help='where to write the shards.')
+    parser.add_argument('--max_size', default=None, type=int,
+                        help='downscale the images so that their longest side is at most max_size.')
+    parser.add_argument('--encoding', default='jpeg', type=str,
+                        help='jpeg or raw.')
+    parser.add_argument('--quality', default=95, type=int,
+                        help='JPEG quality.')
+    parser.add_argument('--shard_size', default=1., type=float,
+                        help='size of each shard file (GB).')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.dataset == 'voc':
+        image_sets = [tuple(image_set.split('-')) for image_set in args.image_sets.split(',')]
+        dataset = VOCDetection(root=args.root or VOC_ROOT, img_size=None, image_sets=image_sets)
+
+    elif args.dataset == 'coco':
+        dataset = COCODataset(data_dir=args.root or coco_root, json_file=args.json_file, name=args.name)
+
+    else:
+        print('unknow dataset !! Only support voc and coco !!')
+        exit(0)
+
+    pack_shards(dataset, args.out_dir,
+                max_size=args.max_size,
+                encoding=args.encoding,
+                quality=args.quality,
+                shard_bytes=int(args.shard_size * 1024**3))
@@ -1,14 +1,15 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from utils import Conv, SPP, BottleneckCSP, UpSample
+from utils import Conv, SPP, BottleneckCSP, UpSample, BatchedNMS, fuse_modules
 from backbone import *
 import numpy as np
 import tools
+from collections import OrderedDict
 
 
 class YOLOv3Plus(nn.Module):
-    def __init__(self, device, input_size=None, num_classes=20, trainable=False, conf_thresh=0.001, nms_thresh=0.5, anchor_size=None, hr=False, backbone='d-53', ciou=False, diou_nms=False):
+    def __init__(self, device, input_size=None, num_classes=20, trainable=False, conf_thresh=0.001, nms_thresh=0.5, anchor_size=None, hr=False, backbone='d-53', ciou=False, diou_nms=False, topk=None, deploy=False, grid_cache_size=16):
         super(YOLOv3Plus, self).__init__()
         self.device = device
         self.input_size = input_size
@@ -16,16 +17,19 @@ class YOLOv3Plus(nn.Module):
         self.trainable = trainable
         self.conf_thresh = conf_thresh
         self.nms_thresh = nms_thresh
-        self.nms_processor = self.diou_nms if diou_nms else self.nms
+        self.nms_processor = BatchedNMS(diou=diou_nms)
+        self.topk = topk
+        self.deploy = deploy
         self.bk = backbone
         self.ciou = ciou
         self.stride = [8, 16, 32]
         self.anchor_size = torch.tensor(anchor_size).view(3, len(anchor_size) // 3, 2)
         self.anchor_number = self.anchor_size.size(1)
 
-        self.grid_cell, self.stride_tensor, self.all_anchors_wh = self.create_grid(input_size)
-        self.scale = np.array([[[input_size[1], input_size[0], input_size[1], input_size[0]]]])
-        self.scale_torch = torch.tensor(self.scale.copy(), device=device).float()
+        # the grids of the last grid_cache_size input sizes, by (h, w), least recently used first
+        self.grid_cache = OrderedDict()
+        self.grid_cache_size = grid_cache_size
+        self.set_grid(input_size)
 
         # backbone darknet-53 (optional: darknet-19)
         if self.bk == 'd-53':
@@ -113,9 +117,41 @@ class YOLOv3Plus(nn.Module):
 
 
     def set_grid(self, input_size):
-        self.grid_cell, self.stride_tensor, self.all_anchors_wh = self.create_grid(input_size)
-        self.scale = np.array([[[input_size[1], input_size[0], input_size[1], input_size[0]]]])
-        self.scale_torch = torch.tensor(self.scale.copy(), device=self.device).float()
+        key = (input_size[0], input_size[1])
+        if key in self.grid_cache:
+            self.grid_cache.move_to_end(key)
+        else:
+            grid_cell, stride_tensor, all_anchors_wh = self.create_grid(input_size)
+            scale = np.array([[[input_size[1], input_size[0], input_size[1], input_size[0]]]])
+            scale_torch = torch.tensor(scale.copy(), device=self.device).float()
+            self.grid_cache[key] = (grid_cell, stride_tensor, all_anchors_wh, scale, scale_torch)
+            # evict the least recently used size
+            if len(self.grid_cache) > self.grid_cache_size:
+                self.grid_cache.popitem(last=False)
+        self.grid_size = key
+        self.grid_cell, self.stride_tensor, self.all_anchors_wh, self.scale, self.scale_torch = self.grid_cache[key]
+
+
+    def precompute_grids(self, sizes):
+        """
+            Fills the grid cache with the grids of sizes, e.g. all the multi-scale
+            sizes, so that set_grid never builds them on the hot path. The current
+            grid is kept. Sizes beyond grid_cache_size are evicted again.
+        """
+        grid_size = self.grid_size
+        for size in sizes:
+            self.set_grid(size)
+        self.set_grid(grid_size)
+
+
+    def fuse(self):
+        """
+            Folds all the BatchNorm2d layers into the convs before them, in place.
+            Only for inference, the fused model can not be trained anymore.
+        """
+        fuse_modules(self)
+
+        return self
 
 
     def decode_xywh(self, txtytwth_pred):
@@ -147,134 +183,21 @@ class YOLOv3Plus(nn.Module):
         xywh_pred = self.decode_xywh(txtytwth_pred)
 
         # [center_x, center_y, w, h] -> [xmin, ymin, xmax, ymax]
-        x1y1x2y2_pred = torch.zeros_like(xywh_pred)
-        x1y1x2y2_pred[:, :, 0] = (xywh_pred[:, :, 0] - xywh_pred[:, :, 2] / 2)
-        x1y1x2y2_pred[:, :, 1] = (xywh_pred[:, :, 1] - xywh_pred[:, :, 3] / 2)
-        x1y1x2y2_pred[:, :, 2] = (xywh_pred[:, :, 0] + xywh_pred[:, :, 2] / 2)
-        x1y1x2y2_pred[:, :, 3] = (xywh_pred[:, :, 1] + xywh_pred[:, :, 3] / 2)
+        # no in-place writes, so that the decoding can be traced and exported to ONNX
+        x1y1x2y2_pred = torch.cat([xywh_pred[:, :, :2] - xywh_pred[:, :, 2:] / 2,
+                                   xywh_pred[:, :, :2] + xywh_pred[:, :, 2:] / 2], dim=-1)
         
         return x1y1x2y2_pred
 
 
-    def nms(self, dets, scores):
-        """"Pure Python NMS baseline."""
-        x1 = dets[:, 0]  #xmin
-        y1 = dets[:, 1]  #ymin
-        x2 = dets[:, 2]  #xmax
-        y2 = dets[:, 3]  #ymax
-
-        areas = (x2 - x1) * (y2 - y1)                 # the size of bbox
-        order = scores.argsort()[::-1]                        # sort bounding boxes by decreasing order
-
-        keep = []                                             # store the final bounding boxes
-        while order.size > 0:
-            i = order[0]                                      #the index of the bbox with highest confidence
-            keep.append(i)                                    #save it to keep
-            # compute iou
-            xx1 = np.maximum(x1[i], x1[order[1:]])
-            yy1 = np.maximum(y1[i], y1[order[1:]])
-            xx2 = np.minimum(x2[i], x2[order[1:]])
-            yy2 = np.minimum(y2[i], y2[order[1:]])
-
-            w = np.maximum(1e-28, xx2 - xx1)
-            h = np.maximum(1e-28, yy2 - yy1)
-            inter = w * h
-
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-            #reserve all the boundingbox whose ovr less than thresh
-            inds = np.where(ovr <= self.nms_thresh)[0]
-            order = order[inds + 1]
-
-        return keep
-
-
-    def diou_nms(self, dets, scores):
-        """"Pure Python DIoU-NMS baseline."""
-        x1 = dets[:, 0]  #xmin
-        y1 = dets[:, 1]  #ymin
-        x2 = dets[:, 2]  #xmax
-        y2 = dets[:, 3]  #ymax
-
-        areas = (x2 - x1) * (y2 - y1)                 # the size of bbox
-        order = scores.argsort()[::-1]                        # sort bounding boxes by decreasing order
-
-        keep = []                                             # store the final bounding boxes
-        while order.size > 0:
-            i = order[0]                                      #the index of the bbox with highest confidence
-            keep.append(i)                                    #save it to keep
-            # compute iou
-            xx1 = np.maximum(x1[i], x1[order[1:]])
-            yy1 = np.maximum(y1[i], y1[order[1:]])
-            xx2 = np.minimum(x2[i], x2[order[1:]])
-            yy2 = np.minimum(y2[i], y2[order[1:]])
-
-            w = np.maximum(1e-28, xx2 - xx1)
-            h = np.maximum(1e-28, yy2 - yy1)
-            inter = w * h
-
-            iou = inter / (areas[i] + areas[order[1:]] - inter)
-            # compute diou
-            # # compute the length of diagonal line
-            x1_, x2_ = x1[i].repeat(len(order[1:])), x2[i:i+1].repeat(len(order[1:]))
-            y1_, y2_ = y1[i].repeat(len(order[1:])), y2[i:i+1].repeat(len(order[1:]))
-            x1234 = np.stack([x1_, x2_, x1[order[1:]], x2[order[1:]]], axis=1)
-            y1234 = np.stack([y1_, y2_, y1[order[1:]], y2[order[1:]]], axis=1)
-
-            C = np.sqrt((np.max(x1234, axis=1) - np.min(x1234, axis=1))**2 + \
-                        (np.max(y1234, axis=1) - np.min(y1234, axis=1))**2)
-            # # compute the distance between two center point
-            # # # points-1
-            points_1_x = (x1_ + x2_) / 2.
-            points_1_y = (y1_ + y2_) / 2.
-            # # points-2
-            points_2_x = (x1[order[1:]] + x2[order[1:]]) / 2.
-            points_2_y = (y1[order[1:]] + y2[order[1:]]) / 2.
-            D = np.sqrt((points_2_x - points_1_x)**2 + (points_2_y - points_1_y)**2)
-
-            lens = D**2 / (C**2 + 1e-20)
-            diou = iou - lens
-
-            ovr = diou                
-            #reserve all the boundingbox whose ovr less than thresh
-            inds = np.where(ovr <= self.nms_thresh)[0]
-            order = order[inds + 1]
-
-        return keep
-
-
     def postprocess(self, all_local, all_conf, exchange=True, im_shape=None):
         """
         bbox_pred: (HxW*anchor_n, 4), bsize = 1
         prob_pred: (HxW*anchor_n, num_classes), bsize = 1
+        Both are tensors on self.device. Thresholding, top-k pre-selection and NMS
+        run on that device, only the final detections are copied to host memory.
         """
-        bbox_pred = all_local
-        prob_pred = all_conf
-
-        cls_inds = np.argmax(prob_pred, axis=1)
-        prob_pred = prob_pred[(np.arange(prob_pred.shape[0]), cls_inds)]
-        scores = prob_pred.copy()
-        
-        # threshold
-        keep = np.where(scores >= self.conf_thresh)
-        bbox_pred = bbox_pred[keep]
-        scores = scores[keep]
-        cls_inds = cls_inds[keep]
-
-        # NMS
-        keep = np.zeros(len(bbox_pred), dtype=np.int)
-        for i in range(self.num_classes):
-            inds = np.where(cls_inds == i)[0]
-            if len(inds) == 0:
-                continue
-            c_bboxes = bbox_pred[inds]
-            c_scores = scores[inds]
-            c_keep = self.nms_processor(c_bboxes, c_scores) # self.nms(c_bboxes, c_scores)
-            keep[inds[c_keep]] = 1
-
-        keep = np.where(keep > 0)
-        bbox_pred = bbox_pred[keep]
-        scores = scores[keep]
-        cls_inds = cls_inds[keep]
+        bbox_pred, scores, cls_inds = [out[0] for out in self.batch_postprocess(all_local[None], all_conf[None])]
 
         if im_shape != None:
             # clip
@@ -283,6 +206,40 @@ class YOLOv3Plus(nn.Module):
         return bbox_pred, scores, cls_inds
 
 
+    def batch_postprocess(self, all_local, all_conf):
+        """
+        all_local: (B, HxW*anchor_n, 4)
+        all_conf: (B, HxW*anchor_n, num_classes)
+        It returns three lists, holding bboxes, scores and cls_inds of each
+        image, whatever B is. The candidates of all the images go through a
+        single NMS, the image index being folded into the class labels.
+        """
+        B = all_local.size(0)
+        scores, cls_inds = torch.max(all_conf, dim=2)
+        bbox_pred = all_local
+
+        # top-k candidates with the highest scores of each image
+        if self.topk is not None and self.topk < scores.size(1):
+            scores, inds = torch.topk(scores, self.topk, dim=1)
+            cls_inds = torch.gather(cls_inds, 1, inds)
+            bbox_pred = torch.gather(bbox_pred, 1, inds[..., None].expand(-1, -1, 4))
+        img_inds = torch.arange(B, device=scores.device)[:, None].expand_as(scores)
+
+        # threshold
+        keep = scores >= self.conf_thresh
+        bbox_pred, scores, cls_inds, img_inds = bbox_pred[keep], scores[keep], cls_inds[keep], img_inds[keep]
+
+        # NMS of all the images at once, then grouped by image
+        keep = self.nms_processor(bbox_pred, scores, cls_inds + img_inds * self.num_classes, self.nms_thresh)
+        keep = keep[torch.sort(img_inds[keep], stable=True)[1]]
+        splits = np.cumsum(torch.bincount(img_inds[keep], minlength=B).tolist())[:-1]
+        bboxes = np.split(bbox_pred[keep].to('cpu').numpy(), splits)
+        scores = np.split(scores[keep].to('cpu').numpy(), splits)
+        cls_inds = np.split(cls_inds[keep].to('cpu').numpy(), splits)
+
+        return bboxes, scores, cls_inds
+
+
     def forward(self, x, target=None):
         # backbone
         c3, c4, c5 = self.backbone(x)
@@ -346,6 +303,8 @@ class YOLOv3Plus(nn.Module):
         
         # train
         if self.trainable:
+            # under autocast the head outputs are fp16/bf16: decode the boxes and compute the losses in fp32
+            conf_pred, cls_pred, txtytwth_pred = conf_pred.float(), cls_pred.float(), txtytwth_pred.float()
             txtytwth_pred = txtytwth_pred.view(B, HW, self.anchor_number, 4)
             
             if self.ciou:
@@ -400,19 +359,20 @@ class YOLOv3Plus(nn.Module):
 
         # test
         else:
+            # decode against the grid of the input shape, a square or a letterboxed rectangle
+            self.set_grid(x.shape[2:])
             txtytwth_pred = txtytwth_pred.view(B, HW, self.anchor_number, 4)
             with torch.no_grad():
-                # batch size = 1                
-                all_obj = torch.sigmoid(conf_pred)[0]           # 0 is because that these is only 1 batch.
-                all_bbox = torch.clamp((self.decode_boxes(txtytwth_pred) / self.scale_torch)[0], 0., 1.)
-                all_class = (torch.softmax(cls_pred[0, :, :], dim=1) * all_obj)
-                # separate box pred and class conf
-                all_obj = all_obj.to('cpu').numpy()
-                all_class = all_class.to('cpu').numpy()
-                all_bbox = all_bbox.to('cpu').numpy()
-
-                bboxes, scores, cls_inds = self.postprocess(all_bbox, all_class)
-
-                # print(len(all_boxes))
-                return bboxes, scores, cls_inds
+                # [B, H*W*anchor_n, 1]
+                all_obj = torch.sigmoid(conf_pred)
+                # [B, H*W*anchor_n, 4]
+                all_bbox = torch.clamp(self.decode_boxes(txtytwth_pred) / self.scale_torch, 0., 1.)
+                # [B, H*W*anchor_n, num_classes]
+                all_class = (torch.softmax(cls_pred, dim=2) * all_obj)
+
+                if self.deploy:
+                    # exported graph: the decoded boxes and the class scores, NMS is a post-step
+                    return all_bbox, all_class
+
+                return self.batch_postprocess(all_bbox, all_class)
 
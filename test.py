@@ -30,6 +30,8 @@ parser.add_argument('--cuda', action='store_true', default=False,
                     help='use cuda.')
 parser.add_argument('--diou_nms', action='store_true', default=False, 
                     help='use diou nms.')
+parser.add_argument('--rect', action='store_true', default=False,
+                    help='letterbox the images to the smallest stride-32 rectangle instead of a square.')
 
 args = parser.parse_args()
 
@@ -72,16 +74,12 @@ def test(net, device, testset, transform, thresh, class_colors=None, class_names
         x = img_tensor.unsqueeze(0).to(device)
 
         t0 = time.time()
-        # forward
-        bboxes, scores, cls_inds = net(x)
+        # forward, the detections of the only image
+        bboxes, scores, cls_inds = [out[0] for out in net(x)]
         print("detection time used ", time.time() - t0, "s")
 
-        # scale each detection back up to the image
-        max_line = max(h, w)
-        # map the boxes to input image with zero padding
-        bboxes *= max_line
-        # map to the image without zero padding
-        bboxes -= (offset * max_line)
+        # map each detection back to the image, undoing the padding and the resize
+        bboxes = map_to_image(bboxes, offset, scale, h, w)
 
         img_processed = vis(img, bboxes, scores, cls_inds, thresh, class_colors, class_names, class_indexs, dataset)
         cv2.imshow('detection', img_processed)
@@ -111,7 +109,7 @@ if __name__ == '__main__':
         dataset = VOCDetection(root=VOC_ROOT, 
                                img_size=None, 
                                image_sets=[('2007', 'test')], 
-                               transform=BaseTransform(input_size))
+                               transform=BaseTransform(input_size, rect=args.rect))
 
     elif args.dataset == 'coco-val':
         print('test on coco-val ...')
@@ -123,7 +121,7 @@ if __name__ == '__main__':
                     data_dir=coco_root,
                     json_file='instances_val2017.json',
                     name='val2017',
-                    transform=BaseTransform(input_size),
+                    transform=BaseTransform(input_size, rect=args.rect),
                     img_size=input_size[0])
 
     class_colors = [(np.random.randint(255),np.random.randint(255),np.random.randint(255)) for _ in range(num_classes)]
@@ -186,13 +184,15 @@ if __name__ == '__main__':
 
     yolo_net.load_state_dict(torch.load(args.trained_model, map_location=device))
     yolo_net.to(device).eval()
+    # fold the BatchNorm layers into the convs
+    yolo_net.fuse()
     print('Finished loading model!')
 
     # evaluation
     test(net=yolo_net, 
         device=device, 
         testset=dataset,
-        transform=BaseTransform(input_size),
+        transform=BaseTransform(input_size, rect=args.rect),
         thresh=args.visual_threshold,
         class_colors=class_colors,
         class_names=class_names,
@@ -1,8 +1,10 @@
 import numpy as np
 from data import *
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import functools
 
 # We use ignore thresh to decide which anchor box can be kept.
 ignore_thresh = IGNORE_THRESH
@@ -13,6 +15,8 @@ class BCELoss(nn.Module):
         super(BCELoss, self).__init__()
         self.reduction = reduction
     def forward(self, inputs, targets, mask):
+        # in fp16, 1e-14 would underflow to 0 and log(0) = -inf
+        inputs, targets = inputs.float(), targets.float()
         pos_id = (mask==1.0).float()
         neg_id = (mask==0.0).float()
         pos_loss = -pos_id * (targets * torch.log(inputs + 1e-14) + (1 - targets) * torch.log(1.0 - inputs + 1e-14))
@@ -31,6 +35,7 @@ class MSELoss(nn.Module):
         self.reduction = reduction
     def forward(self, inputs, targets, mask):
         # We ignore those whose tarhets == -1.0. 
+        inputs, targets = inputs.float(), targets.float()
         pos_id = (mask==1.0).float()
         neg_id = (mask==0.0).float()
         pos_loss = pos_id * (inputs - targets)**2
@@ -130,125 +135,139 @@ def set_anchors(anchor_size):
     return anchor_boxes
 
 
+@functools.lru_cache(maxsize=32)
+def gt_creator_tables(input_size, strides, anchor_size):
+    """
+    Tables shared by all the batches of the same input size.
+    Output:
+        anchor_wh : ndarray -> [[anchor_w, anchor_h], ...], all the anchor boxes of all the scales.
+        grid_shapes : ndarray -> [[h//s, w//s], ...] of each scale.
+        offsets : ndarray -> start of each scale along the H*W*anchor_n axis of the gt tensor.
+        total : int -> length of the H*W*anchor_n axis.
+    """
+    h, w = input_size
+    anchor_number = len(anchor_size) // len(strides)
+    anchor_wh = set_anchors(anchor_size)[:, 2:]
+    grid_shapes = np.array([[h // s, w // s] for s in strides])
+    sizes = grid_shapes[:, 0] * grid_shapes[:, 1] * anchor_number
+    offsets = np.cumsum(sizes) - sizes
+
+    return anchor_wh, grid_shapes, offsets, int(sizes.sum())
+
+
+def last_occurrence(x):
+    """
+    Input:
+        x : ndarray -> [N]
+    Output:
+        inds : ndarray -> indices of the last occurrence of each unique value of x.
+    """
+    _, inds = np.unique(x[::-1], return_index=True)
+
+    return len(x) - 1 - inds
+
+
 def multi_gt_creator(input_size, strides, label_lists=[], anchor_size=None):
-    """creator multi scales gt"""
-    # prepare the all empty gt datas
+    """creator multi scales gt
+
+    All the gt boxes of the batch are assigned at once. When several boxes
+    hit the same anchor, the later box wins, as if they were written one by one.
+    """
     batch_size = len(label_lists)
     h, w = input_size
     num_scale = len(strides)
-    gt_tensor = []
-
-    # generate gt datas
-    all_anchor_size = anchor_size # get_total_anchor_size(multi_level=True, name=name, version=version)
-    anchor_number = len(all_anchor_size) // num_scale
-    for s in strides:
-        gt_tensor.append(np.zeros([batch_size, h//s, w//s, anchor_number, 1+1+4+1+4]))
-    for batch_index in range(batch_size):
-        for gt_label in label_lists[batch_index]:
-            # get a bbox coords
-            gt_class = int(gt_label[-1])
-            xmin, ymin, xmax, ymax = gt_label[:-1]
-            # compute the center, width and height
-            c_x = (xmax + xmin) / 2 * w
-            c_y = (ymax + ymin) / 2 * h
-            box_w = (xmax - xmin) * w
-            box_h = (ymax - ymin) * h
-
-            if box_w < 1. or box_h < 1.:
-                # print('A dirty data !!!')
-                continue    
-
-            # compute the IoU
-            anchor_boxes = set_anchors(all_anchor_size)
-            gt_box = np.array([[0, 0, box_w, box_h]])
-            iou = compute_iou(anchor_boxes, gt_box)
-
-            # We only consider those anchor boxes whose IoU is more than ignore thresh,
-            iou_mask = (iou > ignore_thresh)
-
-            if iou_mask.sum() == 0:
-                # We assign the anchor box with highest IoU score.
-                index = np.argmax(iou)
-                # s_indx, ab_ind = index // num_scale, index % num_scale
-                s_indx = index // anchor_number
-                ab_ind = index - s_indx * anchor_number
-                # get the corresponding stride
-                s = strides[s_indx]
-                # get the corresponding anchor box
-                p_w, p_h = anchor_boxes[index, 2], anchor_boxes[index, 3]
-                # compute the gride cell location
-                c_x_s = c_x / s
-                c_y_s = c_y / s
-                grid_x = int(c_x_s)
-                grid_y = int(c_y_s)
-                # compute gt labels
-                tx = c_x_s - grid_x
-                ty = c_y_s - grid_y
-                tw = np.log(box_w / p_w)
-                th = np.log(box_h / p_h)
-                weight = 2.0 - (box_w / w) * (box_h / h)
-
-                if grid_y < gt_tensor[s_indx].shape[1] and grid_x < gt_tensor[s_indx].shape[2]:
-                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 0] = 1.0
-                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 1] = gt_class
-                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 2:6] = np.array([tx, ty, tw, th])
-                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 6] = weight
-                    gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 7:] = np.array([xmin, ymin, xmax, ymax])
-            
-            else:
-                # There are more than one anchor boxes whose IoU are higher than ignore thresh.
-                # But we only assign only one anchor box whose IoU is the best(objectness target is 1) and ignore other 
-                # anchor boxes whose(we set their objectness as -1 which means we will ignore them during computing obj loss )
-                # iou_ = iou * iou_mask
-                
-                # We get the index of the best IoU
-                best_index = np.argmax(iou)
-                for index, iou_m in enumerate(iou_mask):
-                    if iou_m:
-                        if index == best_index:
-                            # s_indx, ab_ind = index // num_scale, index % num_scale
-                            s_indx = index // anchor_number
-                            ab_ind = index - s_indx * anchor_number
-                            # get the corresponding stride
-                            s = strides[s_indx]
-                            # get the corresponding anchor box
-                            p_w, p_h = anchor_boxes[index, 2], anchor_boxes[index, 3]
-                            # compute the gride cell location
-                            c_x_s = c_x / s
-                            c_y_s = c_y / s
-                            grid_x = int(c_x_s)
-                            grid_y = int(c_y_s)
-                            # compute gt labels
-                            tx = c_x_s - grid_x
-                            ty = c_y_s - grid_y
-                            tw = np.log(box_w / p_w)
-                            th = np.log(box_h / p_h)
-                            weight = 2.0 - (box_w / w) * (box_h / h)
-
-                            if grid_y < gt_tensor[s_indx].shape[1] and grid_x < gt_tensor[s_indx].shape[2]:
-                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 0] = 1.0
-                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 1] = gt_class
-                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 2:6] = np.array([tx, ty, tw, th])
-                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 6] = weight
-                                gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 7:] = np.array([xmin, ymin, xmax, ymax])
-            
-                        else:
-                            # we ignore other anchor boxes even if their iou scores are higher than ignore thresh
-                            # s_indx, ab_ind = index // num_scale, index % num_scale
-                            s_indx = index // anchor_number
-                            ab_ind = index - s_indx * anchor_number
-                            s = strides[s_indx]
-                            c_x_s = c_x / s
-                            c_y_s = c_y / s
-                            grid_x = int(c_x_s)
-                            grid_y = int(c_y_s)
-                            gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 0] = -1.0
-                            gt_tensor[s_indx][batch_index, grid_y, grid_x, ab_ind, 6] = -1.0
-
-    gt_tensor = [gt.reshape(batch_size, -1, 1+1+4+1+4) for gt in gt_tensor]
-    gt_tensor = np.concatenate(gt_tensor, 1)
-    
-    return gt_tensor
+    anchor_number = len(anchor_size) // num_scale
+    anchor_wh, grid_shapes, offsets, total = gt_creator_tables(
+        tuple(input_size), tuple(strides), tuple(tuple(size) for size in anchor_size))
+    gt_tensor = np.zeros([batch_size * total, 1+1+4+1+4], dtype=np.float32)
+
+    # all the gt boxes of the batch -> [N, 5], and their batch index -> [N]
+    labels = [np.asarray(label, dtype=np.float64).reshape(-1, 5) for label in label_lists]
+    batch_inds = np.repeat(np.arange(batch_size), [len(label) for label in labels])
+    labels = np.concatenate(labels, axis=0) if batch_size > 0 else np.zeros([0, 5])
+    xmin, ymin, xmax, ymax = labels[:, 0], labels[:, 1], labels[:, 2], labels[:, 3]
+    gt_class = labels[:, 4].astype(np.int64)
+
+    # compute the center, width and height
+    c_x = (xmax + xmin) / 2 * w
+    c_y = (ymax + ymin) / 2 * h
+    box_w = (xmax - xmin) * w
+    box_h = (ymax - ymin) * h
+    # drop the dirty data
+    valid = (box_w >= 1.) & (box_h >= 1.)
+
+    # compute the IoU between the gt boxes and the anchor boxes, both centered at (0, 0) -> [N, anchor_n * num_scale]
+    gw, gh = box_w[:, None], box_h[:, None]
+    aw, ah = anchor_wh[None, :, 0], anchor_wh[None, :, 1]
+    I_w = np.minimum(gw / 2, aw / 2) - np.maximum(-(gw / 2), -(aw / 2))
+    I_h = np.minimum(gh / 2, ah / 2) - np.maximum(-(gh / 2), -(ah / 2))
+    S_I = I_h * I_w
+    iou = S_I / (gw * gh + aw * ah - S_I + 1e-20)
+
+    # We assign the anchor box with highest IoU score, and ignore other
+    # anchor boxes whose IoU scores are higher than ignore thresh.
+    best_index = np.argmax(iou, axis=1)
+    is_best = np.zeros(iou.shape, dtype=bool)
+    is_best[np.arange(len(iou)), best_index] = True
+    is_ignore = (iou > ignore_thresh) & ~is_best
+
+    # every assignment as an event (gt box, anchor index), ordered as the boxes come
+    gt_inds, index = np.nonzero((is_best | is_ignore) & valid[:, None])
+    positive = is_best[gt_inds, index]
+    s_indx = index // anchor_number
+    ab_ind = index - s_indx * anchor_number
+    s = np.asarray(strides, dtype=np.float64)[s_indx]
+    # compute the gride cell location
+    c_x_s = c_x[gt_inds] / s
+    c_y_s = c_y[gt_inds] / s
+    grid_x = c_x_s.astype(np.int64)
+    grid_y = c_y_s.astype(np.int64)
+    in_grid = (grid_y < grid_shapes[s_indx, 0]) & (grid_x < grid_shapes[s_indx, 1])
+    cells = batch_inds[gt_inds] * total + offsets[s_indx] + \
+            (grid_y * grid_shapes[s_indx, 1] + grid_x) * anchor_number + ab_ind
+
+    # positive samples: the last positive event of each anchor sets every target
+    pos = np.nonzero(positive & in_grid)[0]
+    pos = pos[last_occurrence(cells[pos])]
+    g = gt_inds[pos]
+    p_w, p_h = anchor_wh[index[pos], 0], anchor_wh[index[pos], 1]
+    gt_tensor[cells[pos]] = np.stack([
+        np.ones(len(pos)),
+        gt_class[g],
+        c_x_s[pos] - grid_x[pos],
+        c_y_s[pos] - grid_y[pos],
+        np.log(box_w[g] / p_w),
+        np.log(box_h[g] / p_h),
+        2.0 - (box_w[g] / w) * (box_h[g] / h),
+        xmin[g], ymin[g], xmax[g], ymax[g]
+    ], axis=1)
+
+    # ignored samples: objectness and weight are -1 when the last event of the anchor is an ignored one
+    events = np.nonzero(in_grid)[0]
+    events = events[last_occurrence(cells[events])]
+    ign = events[~positive[events]]
+    gt_tensor[cells[ign], 0] = -1.0
+    gt_tensor[cells[ign], 6] = -1.0
+
+    return gt_tensor.reshape(batch_size, total, 1+1+4+1+4)
+
+
+class GTCollate(object):
+    """Collate fn building the dense training targets inside the dataloader workers.
+
+    It takes the samples of MultiScaleDataset, and returns the stacked images,
+    the float32 targets of multi_gt_creator and the input size of the batch.
+    """
+    def __init__(self, strides, anchor_size):
+        self.strides = strides
+        self.anchor_size = anchor_size
+
+    def __call__(self, batch):
+        images = torch.stack([sample[0] for sample in batch], 0)
+        input_size = list(batch[0][2])
+        targets = multi_gt_creator(input_size, self.strides, [sample[1] for sample in batch], self.anchor_size)
+
+        return images, torch.from_numpy(targets), input_size
 
 
 def iou_score(bboxes_a, bboxes_b):
@@ -256,6 +275,8 @@ def iou_score(bboxes_a, bboxes_b):
         bbox_1 : [B*N, 4] = [x1, y1, x2, y2]
         bbox_2 : [B*N, 4] = [x1, y1, x2, y2]
     """
+    # in fp16, the 1e-20 epsilon would underflow to 0
+    bboxes_a, bboxes_b = bboxes_a.float(), bboxes_b.float()
     tl = torch.max(bboxes_a[:, :2], bboxes_b[:, :2])
     br = torch.min(bboxes_a[:, 2:], bboxes_b[:, 2:])
     area_a = torch.prod(bboxes_a[:, 2:] - bboxes_a[:, :2], 1)
@@ -282,6 +303,8 @@ def loss(pred_conf, pred_cls, pred_txtytwth, label, num_classes, obj_loss_f='mse
     txty_loss_function = nn.BCEWithLogitsLoss(reduction='none')
     twth_loss_function = nn.MSELoss(reduction='none')
 
+    # the losses are computed in fp32, also under autocast
+    pred_conf, pred_cls, pred_txtytwth = pred_conf.float(), pred_cls.float(), pred_txtytwth.float()
     pred_conf = torch.sigmoid(pred_conf[:, :, 0])
     pred_cls = pred_cls.permute(0, 2, 1)
     txty_pred = pred_txtytwth[:, :, :2]
@@ -326,6 +349,8 @@ def loss_ciou(pred_conf, pred_cls, pred_ciou, label, num_classes, obj_loss_f='ms
 
     cls_loss_function = nn.CrossEntropyLoss(reduction='none')
 
+    # the losses are computed in fp32, also under autocast
+    pred_conf, pred_cls, pred_ciou = pred_conf.float(), pred_cls.float(), pred_ciou.float()
     pred_conf = torch.sigmoid(pred_conf[:, :, 0])
     pred_cls = pred_cls.permute(0, 2, 1)
         
@@ -374,6 +399,8 @@ def DIoU(bboxes_a, bboxes_b, batch_size):
         Output: DIoU -> [diou_1, diou_2, ...],    size=[B, N]
     """
     B = batch_size
+    # in fp16, the 1e-20 epsilon would underflow to 0
+    bboxes_a, bboxes_b = bboxes_a.float(), bboxes_b.float()
 
     x1234 = torch.cat([ bboxes_a[:, [0, 2]], bboxes_b[:, [0, 2]] ], dim=1)
     y1234 = torch.cat([ bboxes_a[:, [1, 3]], bboxes_b[:, [1, 3]] ], dim=1)
@@ -410,6 +437,8 @@ def CIoU(bboxes_a, bboxes_b, batch_size):
         Output: CIoU -> [ciou_1, ciou_2, ...],    size=[B, N]
     """
     B = batch_size
+    # in fp16, the 1e-15 epsilons would underflow to 0, and w / h to inf in atan
+    bboxes_a, bboxes_b = bboxes_a.float(), bboxes_b.float()
     iou = IoU(bboxes_a, bboxes_b, B).view(-1)
     diou = DIoU(bboxes_a, bboxes_b, B).view(-1)
 
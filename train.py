@@ -5,6 +5,7 @@ import random
 import argparse
 import time
 import math
+import contextlib
 import numpy as np
 
 import torch
@@ -14,7 +15,9 @@ import torch.backends.cudnn as cudnn
 from data import *
 import tools
 
-from utils import SSDAugmentation
+from utils import SSDAugmentation, ModelEMA
+from utils import distributed
+from utils.checkpoint import save_checkpoint, load_checkpoint, get_rng_state, set_rng_state
 from utils.cocoapi_evaluator import COCOAPIEvaluator
 from utils.vocapi_evaluator import VOCAPIEvaluator
 
@@ -31,6 +34,9 @@ def parse_args():
                         help='use multi-scale trick')                  
     parser.add_argument('--batch_size', default=32, type=int, 
                         help='Batch size for training')
+    parser.add_argument('--accumulate', default=1, type=int,
+                        help='accumulate the gradients of several batches before each optimizer step, \
+                              the lr is the one of batch_size * accumulate.')
     parser.add_argument('--lr', default=1e-3, type=float, 
                         help='initial learning rate')
     parser.add_argument('-cos', '--cos', action='store_true', default=False,
@@ -42,7 +48,13 @@ def parse_args():
     parser.add_argument('--start_epoch', type=int, default=0,
                         help='start epoch to train')
     parser.add_argument('-r', '--resume', default=None, type=str, 
-                        help='keep training')
+                        help='keep training from a checkpoint, or from the weights of a model.')
+    parser.add_argument('--auto_resume', action='store_true', default=False,
+                        help='keep training from the last checkpoint in the save folder, if any.')
+    parser.add_argument('--save_iter', default=1000, type=int,
+                        help='interval (optimizer steps) between the checkpoints to resume from, 0 to disable them.')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='seed of the initialization, the data order, the multi-scale sizes and the augmentations.')
     parser.add_argument('--momentum', default=0.9, type=float, 
                         help='Momentum value for optim')
     parser.add_argument('--weight_decay', default=5e-4, type=float, 
@@ -55,8 +67,28 @@ def parse_args():
                             default=10, help='interval between evaluations')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='use cuda.')
+    parser.add_argument('-dist', '--distributed', action='store_true', default=False,
+                        help='distributed data-parallel training, launched by torchrun.')
+    parser.add_argument('--sybn', action='store_true', default=False,
+                        help='use SyncBatchNorm in distributed training (GPU only).')
+    parser.add_argument('--ema', action='store_true', default=False,
+                        help='evaluate and save an exponential moving average of the weights.')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='use mixed precision training: fp16 with gradient scaling on GPU, bf16 on CPU.')
     parser.add_argument('--mosaic', action='store_true', default=False,
                         help='use mosaic augmentation.')
+    parser.add_argument('--image_cache', default=0., type=float,
+                        help='size (GB) of the decoded-image cache shared by the dataloader workers, 0 to disable it.')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='where to store the decoded-image cache, kept for the next runs. By default a directory of /dev/shm removed at the end of the run.')
+    parser.add_argument('--shard_dir', default=None, type=str,
+                        help='read the training set from the shards packed by make_shards.py.')
+    parser.add_argument('--val_shard_dir', default=None, type=str,
+                        help='read the validation set from the shards packed by make_shards.py.')
+    parser.add_argument('--native_eval', action='store_true', default=False,
+                        help='compute the COCO AP with utils.coco_map instead of pycocotools.')
+    parser.add_argument('--streaming_eval', action='store_true', default=False,
+                        help='match the detections as they arrive and print a running mAP, without keeping them.')
     parser.add_argument('--ciou_loss', action='store_true', default=False,
                         help='use ciou_loss.')
     parser.add_argument('--tfboard', action='store_true', default=False,
@@ -82,11 +114,23 @@ def train():
     else:
         hr = False
     
+    # distributed: one process per GPU, or several processes on CPU
+    local_rank = 0
+    if args.distributed:
+        local_rank = distributed.init_distributed(args.cuda)
+        print('use distributed training, rank %d / %d' % (distributed.get_rank(), distributed.get_world_size()))
+    world_size = distributed.get_world_size()
+
+    # the initialization, different in each process
+    random.seed(args.seed + distributed.get_rank())
+    np.random.seed(args.seed + distributed.get_rank())
+    torch.manual_seed(args.seed + distributed.get_rank())
+
     # cuda
     if args.cuda:
         print('use cuda')
         cudnn.benchmark = True
-        device = torch.device("cuda")
+        device = torch.device("cuda", local_rank)
     else:
         device = torch.device("cpu")
 
@@ -100,6 +144,13 @@ def train():
         val_size = [416, 416]
 
     cfg = train_cfg
+
+    # decoded-image cache, downscaled to the training size
+    image_cache = None
+    if args.image_cache > 0:
+        print('use the decoded-image cache ...')
+        image_cache = ImageCache(max_bytes=int(args.image_cache * 1024**3), max_size=train_size[0], cache_dir=args.cache_dir)
+
     # dataset and evaluator
     print("Setting Arguments.. : ", args)
     print("----------------------------------------------------------")
@@ -113,14 +164,18 @@ def train():
                                 img_size=train_size[0],
                                 transform=SSDAugmentation(train_size),
                                 base_transform=BaseTransform(train_size),
-                                mosaic=args.mosaic
+                                mosaic=args.mosaic,
+                                image_cache=image_cache,
+                                shard_dir=args.shard_dir
                                 )
 
         evaluator = VOCAPIEvaluator(data_root=data_dir,
                                     img_size=val_size,
                                     device=device,
                                     transform=BaseTransform(val_size),
-                                    labelmap=VOC_CLASSES
+                                    labelmap=VOC_CLASSES,
+                                    shard_dir=args.val_shard_dir,
+                                    streaming=args.streaming_eval
                                     )
 
     elif args.dataset == 'coco':
@@ -133,14 +188,20 @@ def train():
                     transform=SSDAugmentation(train_size),
                     base_transform=BaseTransform(train_size),
                     mosaic=args.mosaic,
-                    debug=args.debug)
+                    debug=args.debug,
+                    image_cache=image_cache,
+                    shard_dir=args.shard_dir)
 
 
         evaluator = COCOAPIEvaluator(
                         data_dir=data_dir,
                         img_size=val_size,
                         device=device,
-                        transform=BaseTransform(val_size)
+                        transform=BaseTransform(val_size),
+                        shard_dir=args.val_shard_dir,
+                        num_workers=args.num_workers,
+                        native=args.native_eval,
+                        streaming=args.streaming_eval
                         )
     
     else:
@@ -151,16 +212,6 @@ def train():
     print('The dataset size:', len(dataset))
     print("----------------------------------------------------------")
 
-    # dataloader
-    dataloader = torch.utils.data.DataLoader(
-                    dataset, 
-                    batch_size=args.batch_size, 
-                    shuffle=True, 
-                    collate_fn=detection_collate,
-                    num_workers=args.num_workers,
-                    pin_memory=True
-                    )
-
     # build model
     # # yolo_v3_plus series: yolo_v3_plus, yolo_v3_plus_x, yolo_v3_plus_large, yolo_v3_plus_medium, yolo_v3_plus_small
     if args.version == 'yolo_v3_plus':
@@ -220,8 +271,37 @@ def train():
     model = yolo_net
     model.to(device).train()
 
+    # build the grids of all the training sizes and of the evaluation size once
+    multi_sizes = [i * 32 for i in range(10, 20)] if args.multi_scale else None
+    yolo_net.precompute_grids([[s, s] for s in multi_sizes or []] + [val_size])
+
+    # dataloader
+    # the training targets are built by GTCollate in the workers, for the input size of each batch
+    # with shards, shuffle shard by shard to keep the reads local
+    # the order of an epoch and the augmentation of each image only depend on the seed and the epoch,
+    # whatever the dataloader worker, so that the training can be resumed
+    if args.shard_dir is not None:
+        sampler = ShardSampler(dataset.shards, num_replicas=world_size, rank=distributed.get_rank(), seed=args.seed)
+    else:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size,
+                                                                  rank=distributed.get_rank(), seed=args.seed)
+    batch_sampler = MultiScaleBatchSampler(
+                        sampler,
+                        batch_size=args.batch_size,
+                        input_size=train_size,
+                        sizes=multi_sizes,
+                        seed=args.seed
+                        )
+    dataloader = torch.utils.data.DataLoader(
+                    MultiScaleDataset(dataset), 
+                    batch_sampler=batch_sampler,
+                    collate_fn=tools.GTCollate(yolo_net.stride, anchor_size),
+                    num_workers=args.num_workers,
+                    pin_memory=True
+                    )
+
     # use tfboard
-    if args.tfboard:
+    if args.tfboard and distributed.is_main_process():
         print('use tensorboard')
         from torch.utils.tensorboard import SummaryWriter
         c_time = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(time.time()))
@@ -231,26 +311,86 @@ def train():
         writer = SummaryWriter(log_path)
     
     # keep training
+    checkpoint_path = os.path.join(path_to_save, 'last.pth')
+    if args.auto_resume and os.path.exists(checkpoint_path):
+        args.resume = checkpoint_path
+    checkpoint = None
     if args.resume is not None:
         print('keep training model: %s' % (args.resume))
-        model.load_state_dict(torch.load(args.resume, map_location=device))
+        checkpoint = load_checkpoint(args.resume, map_location=device)
+        model.load_state_dict(checkpoint['model'])
+        if 'epoch' not in checkpoint:
+            # only the weights
+            checkpoint = None
+
+    # EMA of the weights, kept by the main process which evaluates and saves it
+    ema = ModelEMA(yolo_net) if args.ema and distributed.is_main_process() else None
+
+    if args.distributed:
+        if args.sybn and args.cuda:
+            print('use SyncBatchNorm ...')
+            model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        elif args.sybn:
+            print('SyncBatchNorm only works on GPU, use BatchNorm.')
+        # the evaluation, set_grid and the checkpoints use yolo_net, the model without the DDP wrapper
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank] if args.cuda else None)
 
     # optimizer setup
-    base_lr = args.lr
+    # linear scaling rule: the total batch size is batch_size * world_size
+    base_lr = args.lr * world_size
     tmp_lr = base_lr
     optimizer = optim.SGD(model.parameters(), 
-                            lr=args.lr, 
+                            lr=base_lr, 
                             momentum=args.momentum,
                             weight_decay=args.weight_decay
                             )
 
+    # mixed precision: the GradScaler is a no-op when disabled, bf16 does not need it
+    if args.amp:
+        amp_dtype = torch.float16 if args.cuda else torch.bfloat16
+        print('use mixed precision training:', amp_dtype)
+    else:
+        amp_dtype = None
+    scaler = torch.amp.GradScaler('cuda', enabled=args.amp and args.cuda)
+
+    # the optimizer, the lr, the position in the data and the RNG states of a full checkpoint
+    start_epoch, start_iter = args.start_epoch, 0
+    if checkpoint is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        if ema is not None and checkpoint['ema'] is not None:
+            ema.ema.load_state_dict(checkpoint['ema'])
+            ema.updates = checkpoint['ema_updates']
+        tmp_lr = checkpoint['tmp_lr']
+        start_epoch, start_iter = checkpoint['epoch'], checkpoint['iter']
+        args.seed = sampler.seed = batch_sampler.seed = checkpoint['seed']
+        # the RNG states of all the processes, a single state in the checkpoints of older versions
+        rng = checkpoint['rng'] if isinstance(checkpoint['rng'], list) else [checkpoint['rng']]
+        if len(rng) == world_size:
+            set_rng_state(rng[distributed.get_rank()])
+        elif distributed.is_main_process():
+            set_rng_state(rng[0])
+        else:
+            # another world size: the other processes start new streams, different in each process
+            random.seed(args.seed + distributed.get_rank())
+            np.random.seed(args.seed + distributed.get_rank())
+            torch.manual_seed(args.seed + distributed.get_rank())
+        print('resume from epoch %d, iteration %d' % (start_epoch + 1, start_iter))
+
     max_epoch = cfg['max_epoch']
-    epoch_size = len(dataset) // args.batch_size
+    # optimizer steps per epoch of each process, the trailing partial group of
+    # batches included, the warmup lasts wp_epoch epochs whatever the world size
+    # and the gradient accumulation
+    epoch_size = (len(batch_sampler) + args.accumulate - 1) // args.accumulate
 
     # start training loop
     t0 = time.time()
 
-    for epoch in range(args.start_epoch, max_epoch):
+    for epoch in range(start_epoch, max_epoch):
+        # resuming in the middle of an epoch, the first start_iter batches were already trained
+        first_iter = start_iter if epoch == start_epoch else 0
+        sampler.set_epoch(epoch)
+        batch_sampler.set_epoch(epoch, first_iter)
 
         # use cos lr
         if args.cos and epoch > 20 and epoch <= max_epoch - 20:
@@ -262,90 +402,132 @@ def train():
             tmp_lr = 0.00001
             set_lr(optimizer, tmp_lr)
         
-        # use step lr
+        # use step lr, which was already applied when resuming in the middle of the epoch
         else:
-            if epoch in cfg['lr_epoch']:
+            if epoch in cfg['lr_epoch'] and first_iter == 0:
                 tmp_lr = tmp_lr * 0.1
                 set_lr(optimizer, tmp_lr)
     
 
-        for iter_i, (images, targets) in enumerate(dataloader):
+        for iter_i, (images, targets, size) in enumerate(dataloader, first_iter):
+            # the optimizer steps after every accumulate batches, and after the last batch of the epoch
+            step = iter_i // args.accumulate
+            last_batch = (iter_i + 1) % args.accumulate == 0 or iter_i + 1 == len(batch_sampler)
+            # number of batches accumulated in this step, fewer in the last step of the epoch
+            group_size = min(args.accumulate, len(batch_sampler) - step * args.accumulate)
+
             # WarmUp strategy for learning rate
             if not args.no_warm_up:
                 if epoch < args.wp_epoch:
-                    tmp_lr = base_lr * pow((iter_i+epoch*epoch_size)*1. / (args.wp_epoch*epoch_size), 4)
-                    # tmp_lr = 1e-6 + (base_lr-1e-6) * (iter_i+epoch*epoch_size) / (epoch_size * (args.wp_epoch))
+                    tmp_lr = base_lr * pow((step+epoch*epoch_size)*1. / (args.wp_epoch*epoch_size), 4)
+                    # tmp_lr = 1e-6 + (base_lr-1e-6) * (step+epoch*epoch_size) / (epoch_size * (args.wp_epoch))
                     set_lr(optimizer, tmp_lr)
 
-                elif epoch == args.wp_epoch and iter_i == 0:
+                elif epoch == args.wp_epoch and step == 0:
                     tmp_lr = base_lr
                     set_lr(optimizer, tmp_lr)
         
             # to device
-            images = images.to(device).float()
-
-            # multi-scale trick
-            if iter_i % 10 == 0 and iter_i > 0 and args.multi_scale:
-                # randomly choose a new size
-                size = random.randint(10, 19) * 32
-                train_size = [size, size]
-                model.set_grid(train_size)
-            if args.multi_scale:
-                # interpolate
-                images = torch.nn.functional.interpolate(images, size=train_size, mode='bilinear', align_corners=False)
-            
-            # make train label
-            targets = [label.tolist() for label in targets]
-            # vis_data(images, targets, train_size)
-            targets = tools.multi_gt_creator(train_size, yolo_net.stride, targets, anchor_size=anchor_size)
-            targets = torch.tensor(targets).float().to(device)
-
-            # forward and loss
-            conf_loss, cls_loss, txtytwth_loss, total_loss = model(images, target=targets)
-
-            # backprop
-            total_loss.backward()        
-            optimizer.step()
+            images = images.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+
+            # multi-scale trick: the size of each batch is chosen by the batch sampler,
+            # and the dataloader workers already resized its images to that size
+            if size != train_size:
+                train_size = size
+                yolo_net.set_grid(train_size)
+
+            # DDP all-reduces the gradients in the backward of the last accumulated batch only
+            sync = model.no_sync() if args.distributed and not last_batch else contextlib.nullcontext()
+            with sync:
+                # forward and loss
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=args.amp):
+                    conf_loss, cls_loss, txtytwth_loss, total_loss = model(images, target=targets)
+
+                # backprop, the gradient is the mean over the accumulated batches
+                scaler.scale(total_loss / group_size).backward()
+
+            if not last_batch:
+                continue
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
-
-            # display
-            if iter_i % 10 == 0:
+            if ema is not None:
+                ema.update(yolo_net)
+
+            # checkpoint, to resume after this step
+            if args.save_iter > 0 and (step + 1 + epoch * epoch_size) % args.save_iter == 0:
+                # the RNG states of all the processes, gathered by all of them
+                rng = distributed.all_gather_object(get_rng_state())
+                if distributed.is_main_process():
+                    save_checkpoint({'model': yolo_net.state_dict(),
+                                     'optimizer': optimizer.state_dict(),
+                                     'scaler': scaler.state_dict(),
+                                     'ema': ema.ema.state_dict() if ema is not None else None,
+                                     'ema_updates': ema.updates if ema is not None else 0,
+                                     'tmp_lr': tmp_lr,
+                                     'epoch': epoch,
+                                     'iter': iter_i + 1,
+                                     'seed': args.seed,
+                                     'rng': rng},
+                                    checkpoint_path)
+
+            # display, by optimizer steps
+            if step % 10 == 0 and distributed.is_main_process():
                 if args.tfboard:
                     # viz loss
-                    writer.add_scalar('object loss', conf_loss.item(), iter_i + epoch * epoch_size)
-                    writer.add_scalar('class loss', cls_loss.item(), iter_i + epoch * epoch_size)
-                    writer.add_scalar('local loss', txtytwth_loss.item(), iter_i + epoch * epoch_size)
+                    writer.add_scalar('object loss', conf_loss.item(), step + epoch * epoch_size)
+                    writer.add_scalar('class loss', cls_loss.item(), step + epoch * epoch_size)
+                    writer.add_scalar('local loss', txtytwth_loss.item(), step + epoch * epoch_size)
                 
                 t1 = time.time()
                 print('[Epoch %d/%d][Iter %d/%d][lr %.6f]'
                     '[Loss: obj %.2f || cls %.2f || bbox %.2f || total %.2f || size %d || time: %.2f]'
-                        % (epoch+1, max_epoch, iter_i, epoch_size, tmp_lr,
+                        % (epoch+1, max_epoch, step, epoch_size, tmp_lr,
                             conf_loss.item(), cls_loss.item(), txtytwth_loss.item(), total_loss.item(), train_size[0], t1-t0),
                         flush=True)
 
-                t0 = time.time()
-
-        # evaluation
-        if (epoch + 1) % args.eval_epoch == 0:
-            model.trainable = False
-            model.set_grid(val_size)
-            model.eval()
+                if image_cache is not None:
+                    stats = image_cache.stats()
+                    print('[Image cache][hit rate %.2f || evictions %d || %.2f GB]'
+                          % (stats['hit_rate'], stats['evictions'], stats['bytes'] / 1024**3), flush=True)
 
-            # evaluate
-            evaluator.evaluate(model)
+                t0 = time.time()
 
-            # convert to training mode.
-            model.trainable = True
-            model.set_grid(train_size)
-            model.train()
+        # evaluation, by the main process only
+        if (epoch + 1) % args.eval_epoch == 0 and distributed.is_main_process():
+            if ema is not None:
+                # the EMA model is always in eval mode, only its grid changes
+                ema.ema.set_grid(val_size)
+                evaluator.evaluate(ema.ema)
+            else:
+                yolo_net.trainable = False
+                yolo_net.set_grid(val_size)
+                yolo_net.eval()
+
+                # evaluate
+                evaluator.evaluate(yolo_net)
+
+                # convert to training mode.
+                yolo_net.trainable = True
+                yolo_net.set_grid(train_size)
+                yolo_net.train()
 
         # save model
-        if (epoch + 1) % 10 == 0:
+        if (epoch + 1) % 10 == 0 and distributed.is_main_process():
             print('Saving state, epoch:', epoch + 1)
-            torch.save(model.state_dict(), os.path.join(path_to_save, 
+            torch.save((ema.ema if ema is not None else yolo_net).state_dict(), os.path.join(path_to_save, 
                         args.version + '_' + repr(epoch + 1) + '.pth')
                         )  
 
+        # the other processes wait for the evaluation
+        distributed.synchronize()
+
+    if image_cache is not None:
+        image_cache.close()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
+
 
 def set_lr(optimizer, lr):
     for param_group in optimizer.param_groups:
@@ -1,2 +1,4 @@
 from .augmentations import SSDAugmentation
-from .modules import *
\ No newline at end of file
+from .modules import *
+from .nms import BatchedNMS
+from .ema import ModelEMA
@@ -269,7 +269,7 @@ class RandomSampleCrop(object):
         height, width, _ = image.shape
         while True:
             # randomly choose a mode
-            mode = random.choice(self.sample_options)
+            mode = self.sample_options[random.randint(len(self.sample_options))]
             if mode is None:
                 return image, boxes, labels
 
@@ -445,12 +445,14 @@ class SSDAugmentation(object):
             Expand(self.mean),
             RandomSampleCrop(),
             RandomMirror(),
-            ToPercentCoords(),
-            Resize(self.size),
-            Normalize(self.mean, self.std)
+            ToPercentCoords()
         ])
+        self.normalize = Normalize(self.mean, self.std)
 
-    def __call__(self, img, boxes, labels):
+    def __call__(self, img, boxes, labels, size=None):
+        # size: the input size of this image, self.size by default
         img, boxes, labels, scale, offset = self.zeropad(img, boxes, labels)
         img, boxes, labels = self.augment(img, boxes, labels)
+        img, boxes, labels = Resize(self.size if size is None else size)(img, boxes, labels)
+        img, boxes, labels = self.normalize(img, boxes, labels)
         return img, boxes, labels, scale, offset
\ No newline at end of file
@@ -0,0 +1,45 @@
+import os
+import random
+import numpy as np
+import torch
+
+
+def save_checkpoint(state, path):
+    """
+    Saves state to path atomically: it is written to a temporary file which is
+    then renamed to path, so that path always holds a complete checkpoint,
+    even if the process is killed while saving.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, map_location=None):
+    """
+    Loads a checkpoint of save_checkpoint, or a bare state_dict of the model,
+    as saved every 10 epochs by train.py, returned as {'model': state_dict}.
+    """
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if 'model' not in checkpoint:
+        checkpoint = {'model': checkpoint}
+
+    return checkpoint
+
+
+def get_rng_state():
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
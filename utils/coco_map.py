@@ -0,0 +1,170 @@
+"""
+COCO box AP computed with NumPy, without pycocotools.
+
+coco_map() gives the AP@[.5:.95] and the AP50 of COCOeval.summarize() (area
+'all', 100 detections per image), with the same greedy matching: the
+detections of an image are matched by decreasing score to the free ground
+truth box of highest IoU, crowd boxes last and never consumed. The matching
+is vectorized across the IoU thresholds and the categories are evaluated in
+parallel by a process pool.
+"""
+import multiprocessing as mp
+import numpy as np
+
+
+# the thresholds of COCOeval's Params
+IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+REC_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+
+
+def box_iou_xywh(dt_boxes, gt_boxes, gt_crowd):
+    """
+        Input: dt_boxes -> [x, y, w, h], size=[D, 4]
+               gt_boxes -> [x, y, w, h], size=[G, 4]
+               gt_crowd -> bool, size=[G], the IoU with a crowd box is the
+                           intersection over the area of the detection
+        Output: IoU matrix -> size=[D, G], like pycocotools' maskUtils.iou
+    """
+    dx, dy, dw, dh = [t[:, None] for t in dt_boxes.T]
+    gx, gy, gw, gh = [t[None, :] for t in gt_boxes.T]
+    iw = np.minimum(dw + dx, gw + gx) - np.maximum(dx, gx)
+    ih = np.minimum(dh + dy, gh + gy) - np.maximum(dy, gy)
+    inter = iw * ih
+    da = dw * dh
+    union = np.where(gt_crowd[None, :], da, da + gw * gh - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = inter / union
+
+    return np.where((iw > 0) & (ih > 0), iou, 0.)
+
+
+def match_image(ious, gt_crowd, iou_thrs=IOU_THRESHOLDS):
+    """
+    Greedy matching of COCOeval.evaluateImg at all the IoU thresholds at once.
+        ious: [D, G] IoU of the detections sorted by decreasing score with the
+              ground truth boxes, the crowd boxes last
+    Returns the [T, D] bool masks of the matched detections, and of the
+    detections matched to a crowd box, which are ignored.
+    """
+    T = len(iou_thrs)
+    D, G = ious.shape
+    dt_matched = np.zeros([T, D], dtype=bool)
+    dt_ignored = np.zeros([T, D], dtype=bool)
+    if G == 0:
+        return dt_matched, dt_ignored
+    thrs = np.minimum(iou_thrs, 1 - 1e-10)[:, None]
+    gt_free = np.ones([T, G], dtype=bool)
+    rows = np.arange(T)
+    # a detection below the lowest threshold with all the boxes can not be matched
+    for d in np.nonzero(ious.max(1) >= thrs.min())[0]:
+        valid = (gt_free | gt_crowd) & (ious[d] >= thrs)
+        # the best non-crowd box if there is one, else the best crowd box,
+        # the last one on ties like COCOeval
+        best = np.where(valid & ~gt_crowd, ious[d], -1.)
+        use_crowd = best.max(1) < 0
+        best[use_crowd] = np.where(valid[use_crowd] & gt_crowd, ious[d], -1.)
+        m = G - 1 - np.argmax(best[:, ::-1], axis=1)
+        t = rows[best[rows, m] >= 0]
+        dt_matched[t, d] = True
+        dt_ignored[t, d] = gt_crowd[m[t]]
+        gt_free[t, m[t]] = False
+
+    return dt_matched, dt_ignored
+
+
+def evaluate_category(task):
+    """
+    Returns the [T, R] precision of COCOeval.accumulate() for one category, or
+    None if it has no non-crowd ground truth box.
+    """
+    dt_imgs, dt_boxes, dt_scores, gt_imgs, gt_boxes, gt_crowd, max_dets = task
+    num_gt = int(np.count_nonzero(~gt_crowd))
+    if num_gt == 0:
+        return None
+
+    # by image, then by decreasing score, stable like COCOeval's mergesort
+    order = np.lexsort((-dt_scores, dt_imgs))
+    dt_imgs, dt_boxes, dt_scores = dt_imgs[order], dt_boxes[order], dt_scores[order]
+    # the max_dets highest-scoring detections of each image
+    starts = np.searchsorted(dt_imgs, dt_imgs, side='left')
+    keep = np.arange(len(dt_imgs)) - starts < max_dets
+    dt_imgs, dt_boxes, dt_scores = dt_imgs[keep], dt_boxes[keep], dt_scores[keep]
+    # by image, the crowd boxes last
+    order = np.lexsort((gt_crowd, gt_imgs))
+    gt_imgs, gt_boxes, gt_crowd = gt_imgs[order], gt_boxes[order], gt_crowd[order]
+
+    T = len(IOU_THRESHOLDS)
+    tps = np.zeros([T, len(dt_imgs)], dtype=bool)
+    fps = np.ones([T, len(dt_imgs)], dtype=bool)
+    # only the images with both detections and ground truth need a matching
+    img_ids = np.intersect1d(dt_imgs, gt_imgs)
+    dt_starts, dt_ends = np.searchsorted(dt_imgs, img_ids, 'left'), np.searchsorted(dt_imgs, img_ids, 'right')
+    gt_starts, gt_ends = np.searchsorted(gt_imgs, img_ids, 'left'), np.searchsorted(gt_imgs, img_ids, 'right')
+    for ds, de, gs, ge in zip(dt_starts, dt_ends, gt_starts, gt_ends):
+        ious = box_iou_xywh(dt_boxes[ds:de], gt_boxes[gs:ge], gt_crowd[gs:ge])
+        matched, ignored = match_image(ious, gt_crowd[gs:ge])
+        tps[:, ds:de] = matched & ~ignored
+        fps[:, ds:de] = ~matched & ~ignored
+
+    # all the images, by decreasing score
+    order = np.argsort(-dt_scores, kind='mergesort')
+    tp_sum = np.cumsum(tps[:, order], axis=1).astype(dtype=np.float64)
+    fp_sum = np.cumsum(fps[:, order], axis=1).astype(dtype=np.float64)
+    rc = tp_sum / num_gt
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    # the precision envelope, non-increasing with the recall
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+    precision = np.zeros([T, len(REC_THRESHOLDS)])
+    for t in range(T):
+        inds = np.searchsorted(rc[t], REC_THRESHOLDS, side='left')
+        valid = inds < len(dt_scores)
+        precision[t, valid] = pr[t, inds[valid]]
+
+    return precision
+
+
+def coco_map(dets, gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd, img_ids, cat_ids, max_dets=100, workers=None):
+    """
+    COCO AP of the detections on the images img_ids.
+        dets: (N, 7) [image_id, x, y, w, h, score, category_id], e.g. COCOResults.array()
+        gt_img_ids, gt_cat_ids, gt_boxes ([x, y, w, h]), gt_crowd: the ground truth boxes
+        cat_ids: the categories, those without ground truth are not counted
+        workers: size of the process pool, all the CPUs by default, 0 to run in this process
+    Returns:
+        ap50_95 (float), ap50 (float), -1 if no category has ground truth
+    """
+    img_ids = np.unique(img_ids)
+    dets = np.asarray(dets, dtype=np.float64)
+    dets = dets[np.isin(dets[:, 0], img_ids)]
+    keep = np.isin(gt_img_ids, img_ids)
+    gt_img_ids, gt_cat_ids = np.asarray(gt_img_ids)[keep], np.asarray(gt_cat_ids)[keep]
+    gt_boxes, gt_crowd = np.asarray(gt_boxes, dtype=np.float64)[keep], np.asarray(gt_crowd, dtype=bool)[keep]
+
+    # split by category, keeping the order of the rows
+    dt_order = np.argsort(dets[:, 6], kind='stable')
+    dets = dets[dt_order]
+    gt_order = np.argsort(gt_cat_ids, kind='stable')
+    gt_img_ids, gt_cat_ids, gt_boxes, gt_crowd = gt_img_ids[gt_order], gt_cat_ids[gt_order], gt_boxes[gt_order], gt_crowd[gt_order]
+    tasks = []
+    for cat_id in cat_ids:
+        ds, de = np.searchsorted(dets[:, 6], cat_id, 'left'), np.searchsorted(dets[:, 6], cat_id, 'right')
+        gs, ge = np.searchsorted(gt_cat_ids, cat_id, 'left'), np.searchsorted(gt_cat_ids, cat_id, 'right')
+        tasks.append((dets[ds:de, 0], dets[ds:de, 1:5], dets[ds:de, 5],
+                      gt_img_ids[gs:ge], gt_boxes[gs:ge], gt_crowd[gs:ge], max_dets))
+
+    if workers is None:
+        workers = mp.cpu_count()
+    if workers > 0:
+        with mp.Pool(min(workers, len(tasks))) as pool:
+            precisions = pool.map(evaluate_category, tasks)
+    else:
+        precisions = [evaluate_category(task) for task in tasks]
+
+    precisions = [p for p in precisions if p is not None]
+    if len(precisions) == 0:
+        return -1., -1.
+    # [K, T, R]
+    precisions = np.stack(precisions)
+
+    return float(np.mean(precisions)), float(np.mean(precisions[:, 0]))
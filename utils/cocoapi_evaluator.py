@@ -1,21 +1,57 @@
 import json
-import tempfile
+import time
 
-from pycocotools.cocoeval import COCOeval
+try:
+    from pycocotools.cocoeval import COCOeval
+except:
+    print('It seems that you do not install cocoapi ...')
+    pass
 from torch.autograd import Variable
+from utils.coco_map import coco_map
+from utils.streaming_map import StreamingMAP
 
 from data.cocodataset import *
 from data import *
 
 
-import json
-import tempfile
+class COCOResults():
+    """
+    Detections in the [image_id, x, y, w, h, score, category_id] rows that
+    COCO.loadRes() takes as an Nx7 array, accumulated into a preallocated
+    array that doubles its capacity when it is full.
+    """
+    def __init__(self, capacity=1 << 16):
+        self.data = np.empty([capacity, 7], dtype=np.float64)
+        self.size = 0
 
-from pycocotools.cocoeval import COCOeval
-from torch.autograd import Variable
+    def __len__(self):
+        return self.size
 
-from data.cocodataset import *
-from data import *
+    def append(self, image_id, bboxes, scores, category_ids):
+        """
+        bboxes: (N, 4) [x1, y1, x2, y2] in the pixels of the image
+        scores: (N,) and category_ids: (N,) the COCO category ids
+        """
+        n = len(bboxes)
+        if self.size + n > len(self.data):
+            data = np.empty([max(2 * len(self.data), self.size + n), 7], dtype=np.float64)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        rows = self.data[self.size:self.size + n]
+        rows[:, 0] = image_id
+        rows[:, 1:3] = bboxes[:, :2]
+        rows[:, 3:5] = bboxes[:, 2:] - bboxes[:, :2]
+        rows[:, 5] = scores
+        rows[:, 6] = category_ids
+        self.size += n
+
+    def array(self):
+        return self.data[:self.size]
+
+    def to_json(self):
+        """The detections in the COCO json format, e.g. for the test-dev server."""
+        return [{"image_id": int(row[0]), "category_id": int(row[6]), "bbox": row[1:5].tolist(),
+                 "score": float(row[5])} for row in self.array()]
 
 
 class COCOAPIEvaluator():
@@ -24,7 +60,7 @@ class COCOAPIEvaluator():
     All the data in the val2017 dataset are processed \
     and evaluated by COCO API.
     """
-    def __init__(self, data_dir, img_size, device, testset=False, transform=None):
+    def __init__(self, data_dir, img_size, device, testset=False, transform=None, shard_dir=None, batch_size=32, num_workers=4, native=False, streaming=False):
         """
         Args:
             data_dir (str): dataset root directory
@@ -35,6 +71,18 @@ class COCOAPIEvaluator():
                 which is defined in the config file.
             nmsthre (float):
                 IoU threshold of non-max supression ranging from 0 to 1.
+            shard_dir (str):
+                if given, the images are read from the shards packed by make_shards.py.
+            batch_size (int):
+                number of images per forward. The letterboxed images of
+                transform.rect have different shapes, they are not batched.
+            num_workers (int):
+                number of dataloader workers decoding and preprocessing the images.
+            native (bool):
+                compute the AP with utils.coco_map instead of pycocotools' COCOeval.
+            streaming (bool):
+                match the detections as they arrive with utils.streaming_map
+                instead of keeping them, and print a running AP.
         """
         self.testset = testset
         if self.testset:
@@ -49,43 +97,67 @@ class COCOAPIEvaluator():
                                    img_size=img_size,
                                    json_file=json_file,
                                    transform=None,
-                                   name=name)
-        self.dataloader = torch.utils.data.DataLoader(
-                                    self.dataset, 
-                                    batch_size=1, 
-                                    shuffle=False, 
-                                    collate_fn=detection_collate,
-                                    num_workers=0)
+                                   name=name,
+                                   shard_dir=shard_dir)
+        self.class_ids = np.array(self.dataset.class_ids)
         self.img_size = img_size
         self.transform = transform
         self.device = device
+        self.native = native
+        self.streaming = streaming and not testset
+        self.batch_size = 1 if getattr(transform, 'rect', False) else batch_size
+        self.dataloader = torch.utils.data.DataLoader(
+                                    InferenceDataset(self.dataset, transform),
+                                    batch_size=self.batch_size,
+                                    shuffle=False,
+                                    collate_fn=inference_collate,
+                                    num_workers=num_workers,
+                                    pin_memory=torch.device(device).type == 'cuda')
+
+    def collect(self, detections, infos, ids, results):
+        """
+        Maps the detections of a batch back to their images and appends them
+        to results, a COCOResults, or a StreamingMAP that matches them.
+        """
+        for (bboxes, scores, cls_inds), (index, height, width, offset, scale) in zip(detections, infos):
+            id_ = int(self.dataset.ids[index])
+            ids.append(id_)
+            # map each detection back to the image, undoing the padding and the resize
+            bboxes = map_to_image(bboxes, offset, scale, height, width)
+            if isinstance(results, StreamingMAP):
+                results.update(id_, bboxes, scores, cls_inds)
+                continue
+            # object score * class score
+            results.append(id_, bboxes, scores, self.class_ids[cls_inds])
+
+    def ground_truth(self):
+        """
+        The image ids, category ids, [x, y, w, h] boxes and iscrowd flags of
+        all the ground truth boxes, from the annotation index of the dataset.
+        """
+        index = self.dataset.anno_index
+        img_ids = np.repeat(np.asarray(index.img_ids), np.diff(index.offsets))
+        cat_ids = np.asarray(index.cat_ids)[np.asarray(index.cat_inds, dtype=np.int64)]
 
-    def preprocess(self, img, height, width):
-        # zero padding
-        if height > width:
-            img_ = np.zeros([height, height, 3])
-            delta_w = height - width
-            left = delta_w // 2
-            img_[:, left:left+width, :] = img
-            offset = np.array([[ left / height, 0.,  left / height, 0.]])
-
-        elif height < width:
-            img_ = np.zeros([width, width, 3])
-            delta_h = width - height
-            top = delta_h // 2
-            img_[top:top+height, :, :] = img
-            offset = np.array([[0.,    top / width, 0.,    top / width]])
-        
-        else:
-            img_ = img
-            offset = np.zeros([1, 4])
+        return img_ids, cat_ids, np.asarray(index.boxes, dtype=np.float64), np.asarray(index.iscrowd, dtype=bool)
 
-        return img_, offset
+    def streaming_map(self):
+        """A StreamingMAP on the ground truth of the dataset, with the class indexes as labels."""
+        img_ids, cat_ids, boxes, iscrowd = self.ground_truth()
+        # [x, y, w, h] -> [x1, y1, x2, y2]
+        boxes[:, 2:] += boxes[:, :2]
+
+        return StreamingMAP(len(self.class_ids), img_ids, np.searchsorted(self.class_ids, cat_ids),
+                            boxes, iscrowd, metric='coco')
 
     def evaluate(self, model):
         """
         COCO average precision (AP) Evaluation. Iterate inference on the test dataset
         and the results are evaluated by COCO API.
+
+        The images are decoded and preprocessed by the dataloader workers, and
+        the mapping of the detections of a batch to the COCO format runs on the
+        host while the device runs the forward of the next batch.
         Args:
             model : model object
         Returns:
@@ -94,74 +166,79 @@ class COCOAPIEvaluator():
         """
         model.eval()
         ids = []
-        data_dict = []
+        results = self.streaming_map() if self.streaming else COCOResults()
         num_images = len(self.dataset)
         print('total number of images: %d' % (num_images))
 
-        # start testing
-        for index in range(num_images): # all the data in val2017
-            if index % 500 == 0:
-                print('[Eval: %d / %d]'%(index, num_images))
+        # the forward returns the decoded boxes and class scores, NMS is run below
+        deploy = model.deploy
+        model.deploy = True
+        try:
+            pending = None
+            t0 = time.time()
+            # start testing
+            for iter_i, (x, infos) in enumerate(self.dataloader): # all the data in val2017
+                if iter_i % max(1, 500 // self.batch_size) == 0:
+                    print('[Eval: %d / %d]'%(iter_i * self.batch_size, num_images))
+                    if self.streaming and iter_i > 0:
+                        print('[Eval] running ap50_95 / ap50: %.4f / %.4f' % tuple(results.compute()[k] for k in ['map', 'ap50']))
+
+                x = x.to(self.device, non_blocking=True)
+                with torch.no_grad():
+                    all_bbox, all_class = model(x)
+                    # the previous batch, while the device runs the forward of this one
+                    if pending is not None:
+                        self.collect(*pending, ids, results)
+                    # one NMS for the whole batch, the (bboxes, scores, cls_inds) of each image
+                    detections = list(zip(*model.batch_postprocess(all_bbox, all_class)))
+                pending = (detections, infos)
+            if pending is not None:
+                self.collect(*pending, ids, results)
+        finally:
+            model.deploy = deploy
+        t = time.time() - t0
+        print('[Eval] %d images in %.1f s: %.1f images/s' % (num_images, t, num_images / t))
 
-            img, id_ = self.dataset.pull_image(index)  # load a batch
-            height, width, _ = img.shape
+        annType = ['segm', 'bbox', 'keypoints']
 
-            img, _, _, scale, offset = self.transform(img)
+        if self.streaming:
+            summary = results.compute()
+            ap50_95, ap50 = summary['map'], summary['ap50']
+            print('ap50_95 : ', ap50_95)
+            print('ap50 : ', ap50)
 
-            # img_, offset = self.preprocess(img, height, width)
-                
-            x = torch.from_numpy(img[:, :, (2, 1, 0)]).permute(2, 0, 1)
-            x = x.unsqueeze(0).to(self.device)
-            
-            id_ = int(id_)
-            ids.append(id_)
-            with torch.no_grad():
-                outputs = model(x)
-                bboxes, scores, cls_inds = outputs
-                # scale each detection back up to the image
-                max_line = max(height, width)
-                # map the boxes to input image with zero padding
-                bboxes *= max_line
-                # map to the image without zero padding
-                bboxes -= (offset * max_line)
-
-            for i, box in enumerate(bboxes):
-                x1 = float(box[0])
-                y1 = float(box[1])
-                x2 = float(box[2])
-                y2 = float(box[3])
-                label = self.dataset.class_ids[int(cls_inds[i])]
-                
-                bbox = [x1, y1, x2 - x1, y2 - y1]
-                score = float(scores[i]) # object score * class score
-                A = {"image_id": id_, "category_id": label, "bbox": bbox,
-                     "score": score} # COCO json format
-                data_dict.append(A)
+            return ap50_95, ap50
 
-        annType = ['segm', 'bbox', 'keypoints']
+        if len(results) > 0 and self.native and not self.testset:
+            print('evaluating ......')
+            t0 = time.time()
+            ap50_95, ap50 = coco_map(results.array(), *self.ground_truth(), ids, self.class_ids)
+            print('[Eval] native AP in %.1f s' % (time.time() - t0))
+            print('ap50_95 : ', ap50_95)
+            print('ap50 : ', ap50)
+
+            return ap50_95, ap50
 
         # Evaluate the Dt (detection) json comparing with the ground truth
-        if len(data_dict) > 0:
+        if len(results) > 0:
             print('evaluating ......')
             cocoGt = self.dataset.coco
-            # workaround: temporarily write data to json file because pycocotools can't process dict in py36.
             if self.testset:
-                json.dump(data_dict, open('yolov2_2017.json', 'w'))
-                cocoDt = cocoGt.loadRes('yolov2_2017.json')
-            else:
-                _, tmp = tempfile.mkstemp()
-                json.dump(data_dict, open(tmp, 'w'))
-                cocoDt = cocoGt.loadRes(tmp)
+                # the json file for the test server
+                with open('yolov2_2017.json', 'w') as f:
+                    json.dump(results.to_json(), f)
+            # the Nx7 array, without a json round trip
+            cocoDt = cocoGt.loadRes(results.array())
             cocoEval = COCOeval(self.dataset.coco, cocoDt, annType[1])
             cocoEval.params.imgIds = ids
             cocoEval.evaluate()
             cocoEval.accumulate()
             cocoEval.summarize()
 
-            ap50, ap50_95 = cocoEval.stats[0], cocoEval.stats[1]
+            ap50_95, ap50 = cocoEval.stats[0], cocoEval.stats[1]
             print('ap50_95 : ', ap50_95)
             print('ap50 : ', ap50)
 
-            return ap50, ap50_95
+            return ap50_95, ap50
         else:
             return 0, 0
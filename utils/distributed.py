@@ -0,0 +1,56 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(cuda=False):
+    """
+    Joins the process group set up by torch.distributed.run (torchrun), which
+    passes RANK, WORLD_SIZE and LOCAL_RANK in the environment. The backend is
+    nccl on GPU and gloo on CPU. Returns the local rank.
+    """
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if cuda:
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl' if cuda else 'gloo', init_method='env://')
+
+    return local_rank
+
+
+def is_dist_avail_and_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size():
+    if not is_dist_avail_and_initialized():
+        return 1
+    return dist.get_world_size()
+
+
+def get_rank():
+    if not is_dist_avail_and_initialized():
+        return 0
+    return dist.get_rank()
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def synchronize():
+    """ Barrier between all the processes, when training is distributed. """
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def all_gather_object(obj):
+    """
+    The picklable obj of every process, in the order of the ranks. It must be
+    called by all the processes when training is distributed.
+    """
+    if get_world_size() == 1:
+        return [obj]
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+
+    return objs
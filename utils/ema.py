@@ -0,0 +1,43 @@
+import math
+from copy import deepcopy
+import torch
+
+
+class ModelEMA(object):
+    """
+    Exponential moving average of the weights and the BN statistics of a model.
+
+    The decay ramps up from 0 to decay with the number of updates, so that the
+    first updates, when the weights are still far from good, are not averaged
+    over a long horizon. The EMA model is a copy of the model, always in eval
+    mode and not trainable: call set_grid() on it before evaluating it at
+    another input size than the training one.
+
+    Args:
+        model: YOLOv3Plus or YOLOv3Slim, without the DDP wrapper
+        decay (float): final decay of the average
+        ramp (float): number of updates of the ramp, the decay reaches 63% of decay after ramp updates
+        updates (int): number of updates already done, to resume the ramp
+    """
+    def __init__(self, model, decay=0.9999, ramp=2000, updates=0):
+        self.ema = deepcopy(model).eval()
+        self.ema.trainable = False
+        self.updates = updates
+        self.final_decay = decay
+        self.ramp = ramp
+        for p in self.ema.parameters():
+            p.requires_grad_(False)
+        # the float tensors of the state dict, averaged in place
+        self.ema_tensors = [v for v in self.ema.state_dict().values() if v.dtype.is_floating_point]
+
+    def decay(self, updates):
+        return self.final_decay * (1 - math.exp(-updates / self.ramp))
+
+    def update(self, model):
+        self.updates += 1
+        d = self.decay(self.updates)
+        with torch.no_grad():
+            model_tensors = [v.detach() for v in model.state_dict().values() if v.dtype.is_floating_point]
+            # ema = d * ema + (1 - d) * model, for all the tensors at once
+            torch._foreach_mul_(self.ema_tensors, d)
+            torch._foreach_add_(self.ema_tensors, model_tensors, alpha=1. - d)
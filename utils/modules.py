@@ -95,3 +95,58 @@ class BottleneckCSP(nn.Module):
         y1 = self.cv3(self.m(self.cv1(x)))
         y2 = self.cv2(x)
         return self.cv4(self.act(self.bn(torch.cat((y1, y2), dim=1))))
+
+
+def fuse_conv_and_bn(conv, bn):
+    """
+        Folds bn into the weights of conv, and returns the fused nn.Conv2d with a bias.
+        conv may also be a part of the input channels of bn, like the cv2 and cv3
+        of BottleneckCSP whose outputs are concatenated before bn: bn is then the
+        BatchNorm2d of the corresponding channels only.
+    """
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                      bias=True).to(conv.weight.device)
+
+    # w = w * gamma / std,  b = (b - mean) * gamma / std + beta
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+
+    return fused
+
+
+def split_bn(bn, start, end):
+    """ The BatchNorm2d of the channels [start, end) of bn. """
+    part = nn.BatchNorm2d(end - start, eps=bn.eps).to(bn.weight.device)
+    with torch.no_grad():
+        part.weight.copy_(bn.weight[start:end])
+        part.bias.copy_(bn.bias[start:end])
+        part.running_mean.copy_(bn.running_mean[start:end])
+        part.running_var.copy_(bn.running_var[start:end])
+
+    return part
+
+
+def fuse_modules(model):
+    """
+        Folds every BatchNorm2d of model into the conv before it, in place, for inference:
+        - Conv2d followed by BatchNorm2d in a nn.Sequential (Conv, Conv_BN_LeakyReLU ...)
+        - the bn of BottleneckCSP applied to cat(cv3(...), cv2(x))
+    """
+    for m in model.modules():
+        if isinstance(m, nn.Sequential):
+            for i in range(len(m) - 1):
+                if isinstance(m[i], nn.Conv2d) and isinstance(m[i + 1], nn.BatchNorm2d):
+                    m[i] = fuse_conv_and_bn(m[i], m[i + 1])
+                    m[i + 1] = nn.Identity()
+        elif isinstance(getattr(m, 'bn', None), nn.BatchNorm2d) and \
+             isinstance(getattr(m, 'cv2', None), nn.Conv2d) and isinstance(getattr(m, 'cv3', None), nn.Conv2d):
+            c_ = m.cv3.out_channels
+            m.cv3 = fuse_conv_and_bn(m.cv3, split_bn(m.bn, 0, c_))
+            m.cv2 = fuse_conv_and_bn(m.cv2, split_bn(m.bn, c_, 2 * c_))
+            m.bn = nn.Identity()
+
+    return model
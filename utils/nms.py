@@ -0,0 +1,186 @@
+import torch
+
+
+def box_iou(bboxes_a, bboxes_b, diou=False):
+    """
+        Input: bboxes_a -> [xmin, ymin, xmax, ymax], size=[..., N, 4]
+               bboxes_b -> [xmin, ymin, xmax, ymax], size=[..., M, 4]
+
+        Output: IoU (or DIoU) matrix -> size=[..., N, M]
+    """
+    ax1, ay1, ax2, ay2 = [t[..., :, None] for t in bboxes_a.unbind(-1)]
+    bx1, by1, bx2, by2 = [t[..., None, :] for t in bboxes_b.unbind(-1)]
+
+    iw = (torch.min(ax2, bx2) - torch.max(ax1, bx1)).clamp_(min=1e-28)
+    ih = (torch.min(ay2, by2) - torch.max(ay1, by1)).clamp_(min=1e-28)
+    inter = iw.mul_(ih)
+    iou = inter / ((ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - inter)
+
+    if diou:
+        # the length of diagonal line of the smallest enclosing box
+        C = (torch.max(ax2, bx2) - torch.min(ax1, bx1))**2 + (torch.max(ay2, by2) - torch.min(ay1, by1))**2
+        # the distance between two center points
+        D = ((ax1 + ax2 - bx1 - bx2) / 2.)**2 + ((ay1 + ay2 - by1 - by2) / 2.)**2
+        iou = iou - D / (C + 1e-20)
+
+    return iou
+
+
+def cluster_nms(iou, nms_thresh, keep=None):
+    """
+        Matrix NMS over boxes already sorted by decreasing score. A box can
+        only be suppressed by a higher-scoring box which is kept itself, so
+        iterating the upper-triangular IoU matrix to a fixed point gives
+        exactly the greedy NMS result (Cluster-NMS, Zheng et al.). It takes
+        as many iterations as the longest chain of suppressions, each one a
+        matmul over the whole matrix, so it is only used on small groups.
+        Input:
+            iou : [..., N, N] IoU (or DIoU) matrix of the sorted boxes
+            keep : [..., N] bool mask of the boxes not suppressed yet
+        Output:
+            keep : [..., N] bool mask
+    """
+    # overlap[i, j] = 1 if box i (higher score) overlaps box j too much
+    overlap = (iou > nms_thresh).triu_(diagonal=1).to(iou.dtype)
+    if keep is None:
+        keep = torch.ones(iou.shape[:-1], dtype=torch.bool, device=iou.device)
+    candidates = keep
+    for _ in range(iou.size(-1)):
+        # count the kept boxes suppressing each box with a (batched) matmul
+        new_keep = candidates & (torch.matmul(keep[..., None, :].to(iou.dtype), overlap)[..., 0, :] == 0)
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+
+    return keep
+
+
+def greedy_nms(bboxes, alive, nms_thresh, diou=False, block_size=16):
+    """
+        Greedy NMS over boxes already sorted by decreasing score, for all the
+        groups at once, block by block: the first block_size candidates of
+        each group are resolved among themselves by cluster_nms(), then the
+        kept ones suppress the other candidates of their group. No candidate
+        precedes the block, so this is exactly the greedy NMS result, with
+        one IoU row per examined box instead of the full IoU matrix, and a
+        fixed point over block_size boxes only. The candidates are compacted
+        as they get suppressed.
+        Input:
+            bboxes : [G, N, 4] sorted boxes of each group
+            alive : [G, N] bool mask of the candidates (False on the padding)
+        Output:
+            keep : [G, N] bool mask
+    """
+    G, N = alive.shape
+    device = alive.device
+    keep = torch.zeros_like(alive)
+    # position of each candidate in bboxes, while they are compacted
+    inds = torch.arange(N, device=device).expand(G, N)
+    rows = torch.arange(G, device=device)[:, None]
+    while True:
+        counts = alive.sum(1)
+        width = int(counts.max())
+        if width == 0:
+            break
+        if width <= alive.size(1) * 7 // 8:
+            # compact the candidates of each group to the left, in order
+            rank = torch.cumsum(alive, 1) - 1
+            g, p = torch.nonzero(alive, as_tuple=True)
+            compact_inds = inds.new_zeros([G, width])
+            compact_inds[g, rank[g, p]] = inds[g, p]
+            compact_bboxes = bboxes.new_zeros([G, width, 4])
+            compact_bboxes[g, rank[g, p]] = bboxes[g, p]
+            inds, bboxes = compact_inds, compact_bboxes
+            alive = torch.arange(width, device=device)[None, :] < counts[:, None]
+
+        # the first block_size candidates of each group
+        rank = torch.cumsum(alive, 1) - 1
+        in_block = alive & (rank < block_size)
+        g, p = torch.nonzero(in_block, as_tuple=True)
+        size = min(block_size, width)
+        block_inds = torch.zeros([G, size], dtype=torch.long, device=device)
+        block_inds[g, rank[g, p]] = p
+        valid = torch.arange(size, device=device)[None, :] < counts.clamp(max=size)[:, None]
+        block = bboxes[rows, block_inds]
+
+        block_keep = cluster_nms(box_iou(block, block, diou), nms_thresh, valid)
+        keep[g, inds[g, p]] = block_keep[g, rank[g, p]]
+        alive = alive & ~in_block
+        # the kept boxes of the block, first in each group
+        num_kept = block_keep.sum(1)
+        kept_inds = torch.sort(block_keep.to(torch.uint8), dim=1, descending=True, stable=True)[1][:, :int(num_kept.max())]
+        kept = torch.gather(block, 1, kept_inds[..., None].expand(-1, -1, 4))
+        kept_valid = torch.arange(kept.size(1), device=device)[None, :] < num_kept[:, None]
+        alive &= ~((box_iou(kept, bboxes, diou) > nms_thresh) & kept_valid[..., None]).any(1)
+
+    return keep
+
+
+def batched_nms(bboxes, scores, labels, nms_thresh, diou=False, block_size=16):
+    """
+        Class-aware NMS without a loop over the classes.
+        Boxes are grouped by class into a padded [num_groups, group_size, 4]
+        tensor, so that all the classes are suppressed at once: by
+        cluster_nms() on the whole IoU matrices when the groups have at most
+        block_size boxes, else by greedy_nms(), whose fixed points are over
+        block_size boxes only, the long chains of suppressions of clustered
+        boxes making the fixed point of a large group slow.
+        Input:
+            bboxes : [N, 4] containing [xmin, ymin, xmax, ymax]
+            scores : [N]
+            labels : [N]
+        Output:
+            keep : LongTensor of kept indices
+    """
+    if bboxes.numel() == 0:
+        return torch.zeros(0, dtype=torch.long, device=bboxes.device)
+
+    # sort by score, then group by class (the sort is stable)
+    order = torch.argsort(scores, descending=True)
+    order = order[torch.sort(labels[order], stable=True)[1]]
+    _, counts = torch.unique_consecutive(labels[order], return_counts=True)
+    num_groups, group_size = counts.numel(), int(counts.max())
+
+    # position of each sorted box inside the padded tensor
+    starts = torch.cumsum(counts, dim=0) - counts
+    group_inds = torch.repeat_interleave(torch.arange(num_groups, device=bboxes.device), counts)
+    pos_inds = torch.arange(order.numel(), device=bboxes.device) - starts[group_inds]
+
+    # the zero-sized padding boxes never overlap anything
+    padded_bboxes = bboxes.new_zeros([num_groups, group_size, 4])
+    padded_bboxes[group_inds, pos_inds] = bboxes[order]
+
+    if group_size <= block_size:
+        keep = cluster_nms(box_iou(padded_bboxes, padded_bboxes, diou), nms_thresh)
+    else:
+        alive = torch.zeros([num_groups, group_size], dtype=torch.bool, device=bboxes.device)
+        alive[group_inds, pos_inds] = True
+        keep = greedy_nms(padded_bboxes, alive, nms_thresh, diou, block_size)
+
+    return order[keep[group_inds, pos_inds]]
+
+
+def nms(bboxes, scores, nms_thresh, diou=False, block_size=16):
+    """
+        Class-agnostic NMS.
+        Input:
+            bboxes : [N, 4] containing [xmin, ymin, xmax, ymax]
+            scores : [N]
+        Output:
+            keep : LongTensor of kept indices
+    """
+    labels = torch.zeros(bboxes.size(0), dtype=torch.long, device=bboxes.device)
+
+    return batched_nms(bboxes, scores, labels, nms_thresh, diou, block_size)
+
+
+class BatchedNMS(object):
+    """
+        Device-resident class-aware NMS, used as the nms_processor of YOLO.
+    """
+    def __init__(self, diou=False, block_size=16):
+        self.diou = diou
+        self.block_size = block_size
+
+    def __call__(self, bboxes, scores, labels, nms_thresh):
+        return batched_nms(bboxes, scores, labels, nms_thresh, self.diou, self.block_size)
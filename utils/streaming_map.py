@@ -0,0 +1,133 @@
+"""
+Streaming mAP: the detections of each image are matched to its ground truth
+as soon as they arrive, and only kept as per-class histograms of the scores
+of the TPs and of the FPs.
+"""
+import numpy as np
+
+from utils.coco_map import IOU_THRESHOLDS, REC_THRESHOLDS, box_iou_xywh
+from utils.coco_map import match_image as coco_match_image
+from utils.voc_map import voc_ap
+from utils.voc_map import match_image as voc_match_image
+
+
+class StreamingMAP(object):
+    """
+    mAP accumulator whose memory does not depend on the size of the dataset:
+    update() matches the detections of one image and adds them to the
+    [T, num_classes, num_bins] histograms, compute() can be called at any
+    time for a running estimate over the images seen so far.
+
+    metric: 'voc07' (11-point) or 'voc' (area), matched like voc_eval() at IoU
+            0.5 with the difficult boxes ignored, or 'coco', matched like
+            COCOeval at IoU .5:.95 with the crowd boxes ignored and the
+            max_dets highest-scoring detections of each image and class.
+    The detections are ranked by their score bin of width 1 / num_bins: the
+    APs are those of voc_map() / coco_map() when no two detections of a class
+    share a bin, otherwise the detections of a bin make a single point of the
+    PR curve instead of one point each in an arbitrary order, so it is an
+    estimate of the AP that differs from theirs on ties.
+
+    The ground truth boxes are given once, as gt_imgs (image id of each box),
+    gt_labels (class index), gt_boxes ([x1, y1, x2, y2]) and gt_ignore
+    (difficult or crowd). update() must be called for every evaluated image,
+    even without detection, to count its ground truth.
+    """
+    def __init__(self, num_classes, gt_imgs, gt_labels, gt_boxes, gt_ignore, metric='voc07', num_bins=1000, max_dets=100):
+        assert metric in ['voc07', 'voc', 'coco']
+        order = np.argsort(gt_imgs, kind='stable')
+        self.gt_imgs = np.asarray(gt_imgs)[order]
+        self.gt_labels = np.asarray(gt_labels, dtype=np.int64)[order]
+        self.gt_boxes = np.asarray(gt_boxes, dtype=np.float64)[order]
+        self.gt_ignore = np.asarray(gt_ignore, dtype=bool)[order]
+        self.num_classes = num_classes
+        self.metric = metric
+        self.num_bins = num_bins
+        self.max_dets = max_dets
+        self.iou_thrs = IOU_THRESHOLDS if metric == 'coco' else np.array([0.5])
+
+        T = len(self.iou_thrs)
+        self.tp = np.zeros([T, num_classes, num_bins], dtype=np.int64)
+        self.fp = np.zeros([T, num_classes, num_bins], dtype=np.int64)
+        # number of non-ignored ground truth boxes of each class, in the images seen so far
+        self.npos = np.zeros(num_classes, dtype=np.int64)
+        self.num_images = 0
+
+    def match(self, dt_boxes, gt_boxes, gt_ignore):
+        """
+        The [T, D] bool masks of the TPs and FPs of the detections of one
+        class in one image, sorted by decreasing score.
+        """
+        if self.metric == 'coco':
+            # the crowd boxes last
+            order = np.argsort(gt_ignore, kind='stable')
+            gt_boxes, gt_ignore = gt_boxes[order], gt_ignore[order]
+            dt_xywh = np.concatenate([dt_boxes[:, :2], dt_boxes[:, 2:] - dt_boxes[:, :2]], axis=1)
+            gt_xywh = np.concatenate([gt_boxes[:, :2], gt_boxes[:, 2:] - gt_boxes[:, :2]], axis=1)
+            matched, ignored = coco_match_image(box_iou_xywh(dt_xywh, gt_xywh, gt_ignore), gt_ignore, self.iou_thrs)
+            return matched & ~ignored, ~matched & ~ignored
+        tp, fp = voc_match_image(dt_boxes, gt_boxes, gt_ignore)
+        return tp[None], fp[None]
+
+    def update(self, image_id, boxes, scores, labels):
+        """
+        boxes: [N, 4] [x1, y1, x2, y2], scores: [N], labels: [N] class indexes
+        of the detections of the image image_id.
+        """
+        s, e = np.searchsorted(self.gt_imgs, image_id, 'left'), np.searchsorted(self.gt_imgs, image_id, 'right')
+        gt_labels, gt_boxes, gt_ignore = self.gt_labels[s:e], self.gt_boxes[s:e], self.gt_ignore[s:e]
+        self.npos += np.bincount(gt_labels[~gt_ignore], minlength=self.num_classes)
+        self.num_images += 1
+
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        scores, labels = np.asarray(scores, dtype=np.float64), np.asarray(labels, dtype=np.int64)
+        bins = np.clip((scores * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        for k in np.unique(labels):
+            d = np.nonzero(labels == k)[0]
+            # by decreasing score
+            d = d[np.argsort(-scores[d], kind='stable')]
+            if self.metric == 'coco':
+                d = d[:self.max_dets]
+            g = gt_labels == k
+            tp, fp = self.match(boxes[d], gt_boxes[g], gt_ignore[g])
+            t, i = np.nonzero(tp)
+            np.add.at(self.tp[:, k], (t, bins[d][i]), 1)
+            t, i = np.nonzero(fp)
+            np.add.at(self.fp[:, k], (t, bins[d][i]), 1)
+
+    def compute(self):
+        """
+        Returns a dict of
+            aps: [num_classes] AP of each class (AP@[.5:.95] for coco), -1
+                 for the classes without ground truth yet
+            map: the mean AP of the classes with ground truth
+            ap50: the mean AP at IoU 0.5
+        """
+        T = len(self.iou_thrs)
+        # from the highest score bin down
+        tp = np.cumsum(self.tp[..., ::-1], axis=-1).astype(np.float64)
+        fp = np.cumsum(self.fp[..., ::-1], axis=-1).astype(np.float64)
+        has_dets = (self.tp + self.fp)[..., ::-1] > 0
+        aps = -np.ones([T, self.num_classes])
+        for k in np.nonzero(self.npos > 0)[0]:
+            for t in range(T):
+                # one point of the PR curve per non-empty bin
+                tp_k, fp_k = tp[t, k][has_dets[t, k]], fp[t, k][has_dets[t, k]]
+                rec = tp_k / float(self.npos[k])
+                prec = tp_k / np.maximum(tp_k + fp_k, np.finfo(np.float64).eps)
+                if self.metric == 'coco':
+                    # the 101-point interpolation of COCOeval.accumulate()
+                    prec = np.maximum.accumulate(prec[::-1])[::-1]
+                    inds = np.searchsorted(rec, REC_THRESHOLDS, side='left')
+                    q = np.zeros(len(REC_THRESHOLDS))
+                    q[inds < len(prec)] = prec[inds[inds < len(prec)]]
+                    aps[t, k] = np.mean(q)
+                else:
+                    aps[t, k] = voc_ap(rec, prec, self.metric == 'voc07')
+
+        valid = self.npos > 0
+        if not valid.any():
+            return {'aps': aps.mean(0), 'map': -1., 'ap50': -1.}
+        return {'aps': np.where(valid, aps.mean(0), -1.),
+                'map': float(aps[:, valid].mean()),
+                'ap50': float(aps[0, valid].mean())}
@@ -0,0 +1,195 @@
+"""
+VOC AP computed in memory, without the per-class text files.
+
+voc_map() gives the APs of VOCAPIEvaluator.voc_eval() on the files written by
+write_voc_results_file(): the detections are quantized like their text
+('{:.3f}' scores, '{:.1f}' 1-based boxes) and sorted the same way, so the
+APs are identical, for the VOC07 11-point and the area metrics. The ground
+truth is grouped by image once per class, the overlaps of all the detections
+are computed at once and the classes are evaluated in parallel by a process
+pool.
+"""
+import multiprocessing as mp
+import numpy as np
+
+
+def voc_ap(rec, prec, use_07_metric=True):
+    """ ap = voc_ap(rec, prec, [use_07_metric])
+    Compute VOC AP given precision and recall.
+    If use_07_metric is true, uses the
+    VOC 07 11 point method (default:True).
+    """
+    if use_07_metric:
+        # 11 point metric
+        ap = 0.
+        for t in np.arange(0., 1.1, 0.1):
+            if np.sum(rec >= t) == 0:
+                p = 0
+            else:
+                p = np.max(prec[rec >= t])
+            ap = ap + p / 11.
+    else:
+        # correct AP calculation
+        # first append sentinel values at the end
+        mrec = np.concatenate(([0.], rec, [1.]))
+        mpre = np.concatenate(([0.], prec, [0.]))
+
+        # compute the precision envelope
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+
+        # to calculate area under PR curve, look for points
+        # where X axis (recall) changes value
+        i = np.where(mrec[1:] != mrec[:-1])[0]
+
+        # and sum (\Delta recall) * prec
+        ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+    return ap
+
+
+def quantize_dets(dets):
+    """
+    The (scores, boxes) of the (N, 5) float32 [x1, y1, x2, y2, score] detections
+    as read back from their text file: '{:.3f}' scores and '{:.1f}' boxes + 1.
+    Both products are exact in float64, so rint rounds them like the text.
+    """
+    scores = np.rint(dets[:, 4].astype(np.float64) * 1000) / 1000
+    boxes = np.rint((dets[:, :4] + 1).astype(np.float64) * 10) / 10
+
+    return scores, boxes
+
+
+def match_image(dt_boxes, gt_boxes, gt_difficult, ovthresh=0.5):
+    """
+    Matching of voc_eval() for the detections of one image and one class.
+        dt_boxes: [D, 4] sorted by decreasing score, gt_boxes: [G, 4]
+    Returns the [D] bool masks of the TPs and of the FPs, the detections
+    matched to a difficult box are neither.
+    """
+    D = len(dt_boxes)
+    if len(gt_boxes) == 0:
+        return np.zeros(D, dtype=bool), np.ones(D, dtype=bool)
+    BBGT = gt_boxes[None, :, :]
+    bb = dt_boxes[:, None, :]
+    ixmin = np.maximum(BBGT[..., 0], bb[..., 0])
+    iymin = np.maximum(BBGT[..., 1], bb[..., 1])
+    ixmax = np.minimum(BBGT[..., 2], bb[..., 2])
+    iymax = np.minimum(BBGT[..., 3], bb[..., 3])
+    inters = np.maximum(ixmax - ixmin, 0.) * np.maximum(iymax - iymin, 0.)
+    uni = ((bb[..., 2] - bb[..., 0]) * (bb[..., 3] - bb[..., 1]) +
+           (BBGT[..., 2] - BBGT[..., 0]) *
+           (BBGT[..., 3] - BBGT[..., 1]) - inters)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlaps = inters / uni
+    jmax = np.argmax(overlaps, axis=1)
+    matched = np.max(overlaps, axis=1) > ovthresh
+    # the first detection of each non-difficult box is a TP, the next ones are FPs
+    cand = np.nonzero(matched & ~gt_difficult[jmax])[0]
+    tp = np.zeros(D, dtype=bool)
+    tp[cand[np.unique(jmax[cand], return_index=True)[1]]] = True
+    fp = ~matched | (matched & ~gt_difficult[jmax] & ~tp)
+
+    return tp, fp
+
+
+def evaluate_class(task, chunk_size=1 << 15):
+    """
+    Returns the (rec, prec, ap) of voc_eval() for one class, or -1s if it has
+    no detection.
+    """
+    dt_imgs, dt_scores, dt_boxes, gt_imgs, gt_boxes, gt_difficult, ovthresh, use_07_metric = task
+    if len(dt_scores) == 0:
+        return -1., -1., -1.
+    npos = int(np.count_nonzero(~gt_difficult))
+
+    # sort by confidence
+    sorted_ind = np.argsort(-dt_scores)
+    dt_imgs, BB = dt_imgs[sorted_ind], dt_boxes[sorted_ind]
+
+    # the ground truth of each image, [gs, ge) of the detection's image
+    order = np.argsort(gt_imgs, kind='stable')
+    gt_imgs, gt_boxes, gt_difficult = gt_imgs[order], gt_boxes[order], gt_difficult[order]
+    gs = np.searchsorted(gt_imgs, dt_imgs, 'left')
+    ge = np.searchsorted(gt_imgs, dt_imgs, 'right')
+    max_gt = int((ge - gs).max()) if len(gt_imgs) > 0 else 0
+
+    # the best overlap of each detection, in chunks of [chunk_size, max_gt]
+    nd = len(dt_imgs)
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.zeros(nd, dtype=np.int64)
+    for start in range(0, nd if max_gt > 0 else 0, chunk_size):
+        s, e = start, min(start + chunk_size, nd)
+        inds = gs[s:e, None] + np.arange(max_gt)[None, :]
+        valid = inds < ge[s:e, None]
+        BBGT = gt_boxes[np.minimum(inds, len(gt_boxes) - 1)]
+        bb = BB[s:e, None, :]
+        # same operations as voc_eval, for the same overlaps
+        ixmin = np.maximum(BBGT[..., 0], bb[..., 0])
+        iymin = np.maximum(BBGT[..., 1], bb[..., 1])
+        ixmax = np.minimum(BBGT[..., 2], bb[..., 2])
+        iymax = np.minimum(BBGT[..., 3], bb[..., 3])
+        iw = np.maximum(ixmax - ixmin, 0.)
+        ih = np.maximum(iymax - iymin, 0.)
+        inters = iw * ih
+        uni = ((bb[..., 2] - bb[..., 0]) * (bb[..., 3] - bb[..., 1]) +
+               (BBGT[..., 2] - BBGT[..., 0]) *
+               (BBGT[..., 3] - BBGT[..., 1]) - inters)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            overlaps = np.where(valid, inters / uni, -np.inf)
+        has_gt = valid[:, 0]
+        ovmax[s:e][has_gt] = np.max(overlaps[has_gt], axis=1)
+        jmax[s:e] = gs[s:e] + np.argmax(overlaps, axis=1)
+
+    # go down dets and mark TPs and FPs: the first detection matched to a
+    # non-difficult box is a TP, the next ones are FPs
+    tp = np.zeros(nd)
+    fp = np.zeros(nd)
+    matched = ovmax > ovthresh
+    fp[~matched] = 1.
+    cand = np.nonzero(matched)[0]
+    cand = cand[~gt_difficult[jmax[cand]]]
+    first = cand[np.unique(jmax[cand], return_index=True)[1]]
+    fp[cand] = 1.
+    fp[first] = 0.
+    tp[first] = 1.
+
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+
+    return rec, prec, ap
+
+
+def voc_map(all_boxes, gt_imgs, gt_labels, gt_boxes, gt_difficult, ovthresh=0.5, use_07_metric=True, workers=None):
+    """
+    VOC AP of each class.
+        all_boxes: all_boxes[cls][image] = N x 5 float32 array of detections in
+                   (x1, y1, x2, y2, score), like VOCAPIEvaluator.all_boxes
+        gt_imgs, gt_labels, gt_boxes ([xmin, ymin, xmax, ymax] of the XML
+        files), gt_difficult: the ground truth boxes of the images
+        workers: size of the process pool, all the CPUs by default, 0 to run in this process
+    Returns:
+        the list of the (rec, prec, ap) of each class
+    """
+    gt_imgs, gt_labels = np.asarray(gt_imgs), np.asarray(gt_labels)
+    gt_boxes, gt_difficult = np.asarray(gt_boxes, dtype=np.float64), np.asarray(gt_difficult, dtype=bool)
+    tasks = []
+    for j, cls_boxes in enumerate(all_boxes):
+        # in the order of the text file: by image, then in the order of the detections
+        dets = [np.asarray(d, dtype=np.float32).reshape(-1, 5) for d in cls_boxes]
+        dt_imgs = np.repeat(np.arange(len(dets)), [len(d) for d in dets])
+        dt_scores, dt_boxes = quantize_dets(np.concatenate(dets, axis=0))
+        g = gt_labels == j
+        tasks.append((dt_imgs, dt_scores, dt_boxes, gt_imgs[g], gt_boxes[g], gt_difficult[g], ovthresh, use_07_metric))
+
+    if workers is None:
+        workers = mp.cpu_count()
+    if workers > 0:
+        with mp.Pool(min(workers, len(tasks))) as pool:
+            return pool.map(evaluate_class, tasks)
+    return [evaluate_class(task) for task in tasks]
@@ -8,7 +8,9 @@ import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
 from torch.autograd import Variable
-from data import VOCDetection
+from data import VOCDetection, VOCAnnotationIndex, map_to_image
+from utils.voc_map import voc_ap, voc_map
+from utils.streaming_map import StreamingMAP
 import sys
 import os
 import time
@@ -23,7 +25,7 @@ else:
 
 class VOCAPIEvaluator():
     """ VOC AP Evaluation class """
-    def __init__(self, data_root, img_size, device, transform, labelmap, set_type='test', year='2007', display=False):
+    def __init__(self, data_root, img_size, device, transform, labelmap, set_type='test', year='2007', display=False, shard_dir=None, in_memory=True, streaming=False):
         self.data_root = data_root
         self.img_size = img_size
         self.device = device
@@ -32,6 +34,10 @@ class VOCAPIEvaluator():
         self.set_type = set_type
         self.year = year
         self.display = display
+        # evaluate the detections in memory (utils.voc_map), or through the devkit text files
+        self.in_memory = in_memory
+        # match the detections as they arrive (utils.streaming_map), without keeping them
+        self.streaming = streaming
 
         # path
         self.devkit_path = data_root + 'VOC' + year
@@ -43,12 +49,15 @@ class VOCAPIEvaluator():
         # dataset
         self.dataset = VOCDetection(root=data_root, img_size=None,
                                     image_sets=[('2007', set_type)],
-                                    transform=transform
+                                    transform=transform,
+                                    shard_dir=shard_dir
                                     )
 
     def evaluate(self, net):
         net.eval()
         num_images = len(self.dataset)
+        if self.streaming:
+            return self.evaluate_streaming(net)
         # all detections are collected into:
         #    all_boxes[cls][image] = N x 5 array of detections in
         #    (x1, y1, x2, y2, score)
@@ -63,15 +72,11 @@ class VOCAPIEvaluator():
 
             x = Variable(im.unsqueeze(0)).to(self.device)
             t0 = time.time()
-            # forward
-            bboxes, scores, cls_inds = net(x)
+            # forward, the detections of the only image
+            bboxes, scores, cls_inds = [out[0] for out in net(x)]
             detect_time = time.time() - t0
-            # scale each detection back up to the image
-            max_line = max(h, w)
-            # map the boxes to input image with zero padding
-            bboxes *= max_line
-            # map to the image without zero padding
-            bboxes -= (offset * max_line)
+            # map each detection back to the image, undoing the padding and the resize
+            bboxes = map_to_image(bboxes, offset, scale, h, w)
 
             for j in range(len(self.labelmap)):
                 inds = np.where(cls_inds == j)[0]
@@ -92,7 +97,10 @@ class VOCAPIEvaluator():
             pickle.dump(self.all_boxes, f, pickle.HIGHEST_PROTOCOL)
 
         print('Evaluating detections')
-        self.evaluate_detections(self.all_boxes)
+        if self.in_memory:
+            self.evaluate_in_memory(self.all_boxes)
+        else:
+            self.evaluate_detections(self.all_boxes)
 
         print('Mean AP: ', self.map)
   
@@ -147,7 +155,7 @@ class VOCAPIEvaluator():
             with open(filename, 'wt') as f:
                 for im_ind, index in enumerate(self.dataset.ids):
                     dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
+                    if len(dets) == 0:
                         continue
                     # the VOCdevkit expects 1-based indices
                     for k in range(dets.shape[0]):
@@ -202,32 +210,7 @@ class VOCAPIEvaluator():
         If use_07_metric is true, uses the
         VOC 07 11 point method (default:True).
         """
-        if use_07_metric:
-            # 11 point metric
-            ap = 0.
-            for t in np.arange(0., 1.1, 0.1):
-                if np.sum(rec >= t) == 0:
-                    p = 0
-                else:
-                    p = np.max(prec[rec >= t])
-                ap = ap + p / 11.
-        else:
-            # correct AP calculation
-            # first append sentinel values at the end
-            mrec = np.concatenate(([0.], rec, [1.]))
-            mpre = np.concatenate(([0.], prec, [0.]))
-
-            # compute the precision envelope
-            for i in range(mpre.size - 1, 0, -1):
-                mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
-
-            # to calculate area under PR curve, look for points
-            # where X axis (recall) changes value
-            i = np.where(mrec[1:] != mrec[:-1])[0]
-
-            # and sum (\Delta recall) * prec
-            ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
-        return ap
+        return voc_ap(rec, prec, use_07_metric)
 
 
     def voc_eval(self, detpath, classname, cachedir, ovthresh=0.5, use_07_metric=True):
@@ -262,7 +245,7 @@ class VOCAPIEvaluator():
         for imagename in imagenames:
             R = [obj for obj in recs[imagename] if obj['name'] == classname]
             bbox = np.array([x['bbox'] for x in R])
-            difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
+            difficult = np.array([x['difficult'] for x in R]).astype(bool)
             det = [False] * len(R)
             npos = npos + sum(~difficult)
             class_recs[imagename] = {'bbox': bbox,
@@ -338,6 +321,73 @@ class VOCAPIEvaluator():
         return rec, prec, ap
 
 
+    def ground_truth(self):
+        """
+        The image indexes, labels, [xmin, ymin, xmax, ymax] boxes (1-based, like
+        in the XML files) and difficult flags of the objects of the dataset.
+        """
+        index = self.dataset.anno_index
+        if index is None:
+            index = VOCAnnotationIndex([self.dataset._annopath % img_id for img_id in self.dataset.ids],
+                                       {cls: i for i, cls in enumerate(self.labelmap)})
+        gt_imgs = np.repeat(np.arange(len(index)), np.diff(index.offsets))
+
+        return gt_imgs, np.asarray(index.labels), np.asarray(index.boxes, dtype=np.float64) + 1, np.asarray(index.difficult)
+
+    def evaluate_in_memory(self, all_boxes, use_07=True):
+        """
+        Same APs as evaluate_detections(), without the text files, see utils.voc_map.
+        """
+        print('VOC07 metric? ' + ('Yes' if use_07 else 'No'))
+        if not os.path.isdir(self.output_dir):
+            os.mkdir(self.output_dir)
+        t0 = time.time()
+        results = voc_map(all_boxes, *self.ground_truth(), ovthresh=0.5, use_07_metric=use_07)
+        aps = []
+        for cls, (rec, prec, ap) in zip(self.labelmap, results):
+            aps += [ap]
+            print('AP for {} = {:.4f}'.format(cls, ap))
+            with open(os.path.join(self.output_dir, cls + '_pr.pkl'), 'wb') as f:
+                pickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
+        self.map = np.mean(aps)
+        print('Mean AP = {:.4f} ({:.2f} s)'.format(self.map, time.time() - t0))
+
+
+    def evaluate_streaming(self, net, log_interval=500):
+        """
+        VOC07 mAP accumulated image by image, with a running estimate every
+        log_interval images. The detections are not kept, so neither
+        detections.pkl nor the PR curves are written.
+        """
+        num_images = len(self.dataset)
+        gt_imgs, gt_labels, gt_boxes, gt_difficult = self.ground_truth()
+        # the detections are not shifted to 1-based boxes, so neither is the ground truth
+        accumulator = StreamingMAP(len(self.labelmap), gt_imgs, gt_labels, gt_boxes - 1, gt_difficult, metric='voc07')
+
+        for i in range(num_images):
+            im, gt, h, w, offset, scale = self.dataset.pull_item(i)
+
+            x = Variable(im.unsqueeze(0)).to(self.device)
+            t0 = time.time()
+            # forward, the detections of the only image
+            bboxes, scores, cls_inds = [out[0] for out in net(x)]
+            detect_time = time.time() - t0
+            # map each detection back to the image, undoing the padding and the resize
+            bboxes = map_to_image(bboxes, offset, scale, h, w)
+            accumulator.update(i, bboxes, scores, cls_inds)
+
+            if i % 500 == 0:
+                print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1, num_images, detect_time))
+            if (i + 1) % log_interval == 0:
+                print('running mAP over {:d} images: {:.4f}'.format(i + 1, accumulator.compute()['map']))
+
+        results = accumulator.compute()
+        for cls, ap in zip(self.labelmap, results['aps']):
+            print('AP for {} = {:.4f}'.format(cls, ap))
+        self.map = results['map']
+        print('Mean AP: ', self.map)
+
+
     def evaluate_detections(self, box_list):
         self.write_voc_results_file(box_list)
         self.do_python_eval()